@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+
+'''
+An end-to-end benchmark of grading throughput. It sets up a throwaway
+grading environment (database, caches, scene index and submissions
+directory) with a synthetic template, asset directory and stub FOSSSim and
+oracle programs, then submits as N fake students at once, each through
+grader.py exactly as a student would, and reports submissions per minute
+and the latency of each stage of grading.
+
+    python benchmark.py [-n <students>] [-c <concurrent students>]
+                        [-s <scenes>] [-u <template sources>]
+                        [-w <workers>] [-d <directory>] [-j]
+
+-w grades through that many job_queue.py workers (GRADER_DISTRIBUTED)
+instead of in the graders. The environment is made in a temporary directory
+that is removed afterwards, unless given with -d, where it is kept.
+
+The stubs are tuned through the environment, so that the same settings
+reach every process:
+
+    BENCH_STUDENT_SECONDS   CPU seconds the stub FOSSSim spends per scene
+    BENCH_OUTPUT_BYTES      bytes of output it writes per scene
+    BENCH_CRASH_RATE        the fraction of scenes it crashes on
+    BENCH_ORACLE_SECONDS    CPU seconds the stub oracle spends per scene
+    BENCH_FAIL_RATE         the fraction of scenes the oracle fails
+
+Every student's sources differ, so no build or verdict is reused from a
+cache; a run against a kept directory (-d) measures warm caches for the
+students submitted before.
+'''
+
+import datetime
+import json
+import math
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import func
+
+STUDENTS = 8
+CONCURRENCY = 4
+SCENES = 20
+
+# translation units in the template besides main.cpp, so that builds take
+# a realistic while.
+TEMPLATE_SOURCES = 8
+
+STUDENT_SECONDS = float(os.environ.get("BENCH_STUDENT_SECONDS", 0.2))
+OUTPUT_BYTES = int(os.environ.get("BENCH_OUTPUT_BYTES", 1 << 20))
+CRASH_RATE = float(os.environ.get("BENCH_CRASH_RATE", 0.0))
+ORACLE_SECONDS = float(os.environ.get("BENCH_ORACLE_SECONDS", 0.1))
+FAIL_RATE = float(os.environ.get("BENCH_FAIL_RATE", 0.1))
+
+GRADER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "grader.py")
+JOB_QUEUE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_queue.py")
+
+ASSIGNMENT_NAME = "t1m1d1"
+
+TOP_CMAKELISTS = '''\
+cmake_minimum_required(VERSION 3.5)
+project(FOSSSim CXX)
+add_subdirectory(FOSSSim)
+'''
+
+FOSSSIM_CMAKELISTS = '''\
+file(GLOB SOURCES *.cpp)
+add_executable(FOSSSim ${SOURCES})
+'''
+
+STUB_MAIN = r'''
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <ctime>
+
+int student_variant();
+
+static double setting(const char* name, double fallback)
+{
+    const char* value = getenv(name);
+    return value ? atof(value) : fallback;
+}
+
+static double now()
+{
+    timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + t.tv_nsec * 1e-9;
+}
+
+int main(int argc, char** argv)
+{
+    const char* scene = 0;
+    const char* output = 0;
+    for (int i = 1; i + 1 < argc; ++i) {
+        if (!strcmp(argv[i], "-s")) scene = argv[i + 1];
+        if (!strcmp(argv[i], "-o")) output = argv[i + 1];
+    }
+    if (!scene || !output) return 2;
+
+    unsigned seed = student_variant();
+    for (const char* c = scene; *c; ++c) seed = seed * 31 + *c;
+    srand(seed);
+
+    double end = now() + setting("BENCH_STUDENT_SECONDS", 0.2);
+    volatile double sink = 0;
+    while (now() < end)
+        for (int i = 0; i < 10000; ++i) sink += i * 0.5;
+
+    if (rand() / (double) RAND_MAX < setting("BENCH_CRASH_RATE", 0.0)) abort();
+
+    FILE* out = fopen(output, "w");
+    if (!out) return 3;
+    char line[64];
+    long remaining = (long) setting("BENCH_OUTPUT_BYTES", 1 << 20);
+    for (long step = 0; remaining > 0; ++step) {
+        int n = snprintf(line, sizeof line, "%ld %d %f\n", step, rand(), (double) sink);
+        if (n > remaining) n = remaining;
+        fwrite(line, 1, n, out);
+        remaining -= n;
+    }
+    fclose(out);
+    return 0;
+}
+'''
+
+STUB_HELPER = r'''
+#include <algorithm>
+#include <map>
+#include <sstream>
+#include <string>
+#include <vector>
+
+std::string helper_{0}(const std::vector<double>& values)
+{{
+    std::map<std::string, std::vector<double> > groups;
+    for (size_t i = 0; i < values.size(); ++i) {{
+        std::ostringstream key;
+        key << "group" << i % {1};
+        groups[key.str()].push_back(values[i]);
+    }}
+    std::ostringstream out;
+    for (std::map<std::string, std::vector<double> >::iterator it = groups.begin();
+         it != groups.end(); ++it) {{
+        std::sort(it->second.begin(), it->second.end());
+        out << it->first << " " << it->second.size() << "\n";
+    }}
+    return out.str();
+}}
+'''
+
+STUB_STUDENT = '''
+// fake student {0}
+int student_variant() {{ return {0}; }}
+'''
+
+STUB_ORACLE = '''#!{python}
+import hashlib
+import os
+import random
+import sys
+import time
+
+args = sys.argv
+scene = args[args.index("-s") + 1]
+output = args[args.index("-i") + 1]
+
+digest = hashlib.sha1(scene.encode("utf-8"))
+with open(output, "rb") as f:
+    for block in iter(lambda: f.read(1 << 16), b""):
+        digest.update(block)
+
+end = time.time() + float(os.environ.get("BENCH_ORACLE_SECONDS", 0.1))
+while time.time() < end:
+    pass
+
+failed = random.Random(digest.hexdigest()).random() < float(os.environ.get("BENCH_FAIL_RATE", 0.1))
+print("Overall success: " + ("Failed" if failed else "Passed"))
+'''
+
+STUB_SCENE = '''<scene>
+  <!-- benchmark scene {0} -->
+  <duration time="{1}"/>
+  <particle m="1" px="{0}" py="0" vx="0" vy="1" fixed="0"/>
+</scene>
+'''
+
+def write_file(path, contents, mode=0o644):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(path, mode)
+
+def make_environment(directory, students, scenes, template_sources):
+    '''
+    Writes the template, scenes, oracle and student folders into directory.
+    Returns the paths of the template, asset directory, oracle and student
+    folders.
+    '''
+    template = os.path.join(directory, "template")
+    write_file(os.path.join(template, "CMakeLists.txt"), TOP_CMAKELISTS)
+    write_file(os.path.join(template, "FOSSSim", "CMakeLists.txt"), FOSSSIM_CMAKELISTS)
+    write_file(os.path.join(template, "FOSSSim", "main.cpp"), STUB_MAIN)
+    for i in range(template_sources):
+        write_file(os.path.join(template, "FOSSSim", "helper{}.cpp".format(i)),
+                   STUB_HELPER.format(i, i + 2))
+    write_file(os.path.join(template, "Creative", "README"), "")
+
+    assets = os.path.join(directory, "assets")
+    for i in range(scenes):
+        write_file(os.path.join(assets, "scene{:03}.xml".format(i)), STUB_SCENE.format(i, 1 + i % 5))
+
+    oracle = os.path.join(directory, "oracle")
+    write_file(oracle, STUB_ORACLE.format(python=sys.executable), 0o755)
+
+    folders = []
+    for i in range(students):
+        folder = os.path.join(directory, "students", student_uni(i))
+        write_file(os.path.join(folder, "FOSSSim", "student.cpp"), STUB_STUDENT.format(i))
+        write_file(os.path.join(folder, "Creative", "README"), "")
+        folders.append(folder)
+
+    return template, assets, oracle, folders
+
+def student_uni(i):
+    return "bench{:04}".format(i)
+
+def configure(directory, workers):
+    '''
+    Points the grader at the benchmark's directory. Must happen before
+    models and friends are imported, here and in every grader started.
+    '''
+    os.environ["GRADER_DATABASE"] = os.path.join(directory, "testgrade.db")
+    os.environ["GRADER_BUILD_CACHE"] = os.path.join(directory, "build_cache")
+    os.environ["GRADER_VERDICT_CACHE"] = os.path.join(directory, "verdict_cache")
+    os.environ["GRADER_SCENE_INDEX"] = os.path.join(directory, "scene_index")
+    # a budget of its own, so real graders on the host don't skew it, or it them.
+    os.environ["GRADER_CPU_BUDGET"] = os.path.join(directory, "cpu_budget")
+    # never hand the submissions to a grading daemon that happens to run.
+    os.environ["GRADER_SOCKET"] = os.path.join(directory, "no_daemon.sock")
+    if workers:
+        os.environ["GRADER_DISTRIBUTED"] = "1"
+
+    for name, value in [("BENCH_STUDENT_SECONDS", STUDENT_SECONDS),
+                        ("BENCH_OUTPUT_BYTES", OUTPUT_BYTES),
+                        ("BENCH_CRASH_RATE", CRASH_RATE),
+                        ("BENCH_ORACLE_SECONDS", ORACLE_SECONDS),
+                        ("BENCH_FAIL_RATE", FAIL_RATE)]:
+        os.environ[name] = str(value)
+
+def define_benchmark_assignment(template, assets, oracle):
+    import models
+    from define_assignment import define_assignment
+    from models import AssignmentAssetDirectory, Session, Assignment
+
+    models.main()
+
+    ses = Session()
+    exists = ses.query(Assignment).filter(Assignment.theme == 1)\
+                                  .filter(Assignment.milestone == 1)\
+                                  .filter(Assignment.deliverable == 1).count()
+    ses.close()
+    if exists:
+        return
+
+    now = datetime.datetime.now()
+    define_assignment(theme=1, milestone=1, deliverable=1,
+                      oracle_path=oracle,
+                      template_path=template,
+                      start_date=now - datetime.timedelta(days=1),
+                      due_date=now + datetime.timedelta(days=1),
+                      assignment_asset_directories=[
+                          AssignmentAssetDirectory(path=assets, graded=True, hidden=False)])
+
+def submit(directory, folder, uni):
+    '''
+    Submits folder as uni through grader.py, answering its questions.
+    Returns uni, whether grader.py succeeded and the seconds it took.
+    '''
+    log_path = os.path.join(directory, "logs", uni + ".log")
+    started = time.time()
+    with open(log_path, 'w') as log:
+        grader = subprocess.Popen([sys.executable, GRADER_PATH, folder, uni],
+                                  cwd=directory,
+                                  stdin=subprocess.PIPE,
+                                  stdout=log,
+                                  stderr=subprocess.STDOUT)
+        grader.communicate("{}\ny\n".format(ASSIGNMENT_NAME).encode('utf-8'))
+    return uni, grader.returncode == 0, time.time() - started
+
+def start_workers(directory, workers):
+    '''
+    Starts job_queue.py in a process group of its own, so that its workers
+    can be interrupted along with it (see stop_workers).
+    '''
+    log = open(os.path.join(directory, "logs", "workers.log"), 'w')
+    return subprocess.Popen([sys.executable, JOB_QUEUE_PATH, str(workers)],
+                            cwd=directory, stdout=log, stderr=subprocess.STDOUT,
+                            preexec_fn=os.setsid)
+
+def stop_workers(worker_process):
+    os.killpg(worker_process.pid, signal.SIGINT)
+    worker_process.wait()
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p * len(values))) - 1)]
+
+def run_benchmark(directory, students, concurrency, scenes, template_sources, workers):
+    template, assets, oracle, folders = make_environment(directory, students, scenes,
+                                                         template_sources)
+    define_benchmark_assignment(template, assets, oracle)
+
+    # made up front: graders racing to create them would fail.
+    for path in ["logs", os.path.join("submissions", "t1m1")]:
+        if not os.path.isdir(os.path.join(directory, path)):
+            os.makedirs(os.path.join(directory, path))
+
+    worker_process = start_workers(directory, workers) if workers else None
+
+    started = time.time()
+    started_utc = datetime.datetime.utcnow()
+    try:
+        pool = ThreadPool(concurrency)
+        outcomes = pool.map(lambda i: submit(directory, folders[i], student_uni(i)),
+                            range(students))
+        pool.close()
+        elapsed = time.time() - started
+    finally:
+        if worker_process is not None:
+            stop_workers(worker_process)
+
+    return results(outcomes, elapsed, started_utc)
+
+def results(outcomes, elapsed, since):
+    from perf_report import STAGES, PERCENTILES, percentiles, submission_latency
+    from models import Session, Submission, TestSceneRun
+
+    ses = Session()
+    submissions = ses.query(Submission).filter(Submission.submission_time >= since)
+
+    def latency(column):
+        values = percentiles(ses.query(column).filter(Submission.submission_time >= since))
+        values = dict(("p{:g}".format(p * 100), values[p]) for p in PERCENTILES)
+        values["mean"] = ses.query(func.avg(column)).filter(Submission.submission_time >= since).scalar()
+        return values
+
+    stages = dict((stage, latency(getattr(Submission, stage))) for stage in STAGES)
+    stages["submission"] = latency(submission_latency())
+
+    scene_durations = [d for (d,) in ses.query(TestSceneRun.duration)
+                                        .join(Submission, TestSceneRun.submission_id == Submission.id)
+                                        .filter(Submission.submission_time >= since)
+                                        .filter(TestSceneRun.duration != None)]
+    runs = ses.query(TestSceneRun).join(Submission, TestSceneRun.submission_id == Submission.id)\
+                                  .filter(Submission.submission_time >= since)\
+                                  .filter(TestSceneRun.superseded == False)
+    passed = runs.filter(TestSceneRun.success == True).count()
+    total = runs.count()
+
+    client_times = [seconds for _, succeeded, seconds in outcomes if succeeded]
+    graded = submissions.count()
+    ses.close()
+
+    return {
+        "students": len(outcomes),
+        "failed_graders": [uni for uni, succeeded, _ in outcomes if not succeeded],
+        "submissions": graded,
+        "elapsed": elapsed,
+        "submissions_per_minute": graded * 60.0 / elapsed if elapsed > 0 else None,
+        "scene_runs": total,
+        "scene_runs_passed": passed,
+        "grader_time": dict(("p{:g}".format(p * 100), percentile(client_times, p))
+                            for p in PERCENTILES),
+        "scene_time": dict(("p{:g}".format(p * 100), percentile(scene_durations, p))
+                           for p in PERCENTILES),
+        "stages": stages
+    }
+
+def print_results(r):
+    from perf_report import STAGES, PERCENTILES, print_table, seconds
+
+    print("{} submissions from {} students in {:.1f}s: {:.1f} submissions/minute".format(
+        r["submissions"], r["students"], r["elapsed"], r["submissions_per_minute"] or 0.0))
+    print("{} of {} scene runs passed".format(r["scene_runs_passed"], r["scene_runs"]))
+    if r["failed_graders"]:
+        print("grader.py failed for: {}".format(", ".join(r["failed_graders"])))
+    print("")
+
+    keys = ["p{:g}".format(p * 100) for p in PERCENTILES]
+    rows = [[stage, seconds(r["stages"][stage]["mean"])] + [seconds(r["stages"][stage][k]) for k in keys]
+            for stage in STAGES + ["submission"]]
+    rows.append(["grader.py", "-"] + [seconds(r["grader_time"][k]) for k in keys])
+    rows.append(["scene", "-"] + [seconds(r["scene_time"][k]) for k in keys])
+    print_table(["stage", "mean"] + keys, rows)
+
+def usage():
+    print("Usage: {} [-n <students>] [-c <concurrent students>] [-s <scenes>] "
+          "[-u <template sources>] [-w <workers>] [-d <directory>] [-j]".format(sys.argv[0]))
+    sys.exit(0)
+
+def main():
+    args = sys.argv[1:]
+    students = STUDENTS
+    concurrency = CONCURRENCY
+    scenes = SCENES
+    template_sources = TEMPLATE_SOURCES
+    workers = 0
+    directory = None
+    as_json = False
+
+    while args:
+        option = args.pop(0)
+        if option == '-j':
+            as_json = True
+        elif option == '-d' and args:
+            directory = os.path.abspath(args.pop(0))
+        elif option in ('-n', '-c', '-s', '-u', '-w') and args:
+            value = int(args.pop(0))
+            if option == '-n':
+                students = value
+            elif option == '-c':
+                concurrency = value
+            elif option == '-s':
+                scenes = value
+            elif option == '-u':
+                template_sources = value
+            else:
+                workers = value
+        else:
+            usage()
+
+    keep = directory is not None
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="grader-benchmark-")
+    elif not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    configure(directory, workers)
+    try:
+        r = run_benchmark(directory, students, concurrency, scenes, template_sources, workers)
+    finally:
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if as_json:
+        json.dump(r, sys.stdout, indent=2, sort_keys=True)
+        print("")
+    else:
+        print_results(r)
+
+if __name__ == '__main__':
+    main()
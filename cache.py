@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+'''
+Content-addressed caches that let the grader skip work it has already done
+for byte-identical inputs.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from uuid import uuid4
+
+BUILD_CACHE_DIRECTORY = os.environ.get("GRADER_BUILD_CACHE", "./build_cache")
+VERDICT_CACHE_DIRECTORY = os.environ.get("GRADER_VERDICT_CACHE", "./verdict_cache")
+
+# verdicts older than this, or beyond this much disk, are evicted, oldest
+# first. eviction runs at most once per VERDICT_EVICTION_INTERVAL.
+VERDICT_CACHE_MAX_AGE = 30 * 24 * 60 * 60 # seconds
+VERDICT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+VERDICT_EVICTION_INTERVAL = 60 * 60 # seconds
+
+# top-level folders of the template that never affect the FOSSSim binary, or
+# whose contents are taken from the submission instead.
+TEMPLATE_EXCLUDED = ['FOSSSim', 'Creative', 'build']
+
+_digest_lock = threading.Lock()
+_file_digests = {}
+_toolchain_signature = None
+
+def sha1_of(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def file_digest(path):
+    '''
+    The SHA-1 of the contents of the file at path. Digests are remembered
+    for as long as the file's size and modification time stay the same.
+    '''
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime)
+
+    with _digest_lock:
+        digest = _file_digests.get(memo_key)
+    if digest is not None:
+        return digest
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    with _digest_lock:
+        _file_digests[memo_key] = digest
+    return digest
+
+def walk_files(root, exclude=()):
+    '''
+    Yields the path of every file under root relative to root, in a stable
+    order, skipping the top-level entries named in exclude.
+    '''
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if dirpath == root:
+            dirnames[:] = [d for d in dirnames if d not in exclude]
+            filenames = [f for f in filenames if f not in exclude]
+
+        for filename in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, filename), root)
+
+def tree_digest(root, exclude=()):
+    '''
+    A digest of the names and contents of every file under root.
+    '''
+    parts = []
+    for relpath in walk_files(root, exclude):
+        parts += [relpath, file_digest(os.path.join(root, relpath))]
+    return sha1_of(*parts)
+
+def tree_stat_signature(root, exclude=()):
+    '''
+    A digest of the names, sizes and modification times of every file under
+    root. Much cheaper than tree_digest, since no file is read.
+    '''
+    parts = []
+    for relpath in walk_files(root, exclude):
+        st = os.stat(os.path.join(root, relpath))
+        parts += [relpath, str(st.st_size), repr(st.st_mtime)]
+    return sha1_of(*parts)
+
+def toolchain_signature():
+    '''
+    The version banners of cmake and the C++ compiler; a build is only
+    reused with the toolchain it was made with.
+    '''
+    global _toolchain_signature
+
+    if _toolchain_signature is None:
+        banners = []
+        for command in (['cmake', '--version'], ['c++', '--version']):
+            try:
+                banners.append(subprocess.check_output(command).decode('utf-8', 'replace'))
+            except (OSError, subprocess.CalledProcessError) as e:
+                banners.append("{}: {}".format(command[0], e))
+        _toolchain_signature = sha1_of(*banners)
+
+    return _toolchain_signature
+
+def atomic_copy(src, dst):
+    '''
+    Copies src to dst such that concurrent readers see either no file or the
+    whole file.
+    '''
+    tmp = "{}.{}.tmp".format(dst, uuid4().hex)
+    shutil.copy2(src, tmp)
+    os.rename(tmp, dst)
+
+class BuildCache(object):
+    '''
+    FOSSSim binaries keyed by everything that goes into building them: the
+    template tree, the submission's FOSSSim sources, the toolchain and the
+    CMake flags.
+    '''
+    def __init__(self, directory=BUILD_CACHE_DIRECTORY):
+        self.directory = directory
+
+    def _path(self, *parts):
+        path = os.path.join(self.directory, *parts)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass # created concurrently
+        return path
+
+    def template_digest(self, template_path):
+        '''
+        tree_digest of the template, recomputed only when a stat of the tree
+        shows it has changed.
+        '''
+        signature = tree_stat_signature(template_path, TEMPLATE_EXCLUDED)
+        record_path = self._path("templates", sha1_of(os.path.abspath(template_path)) + ".json")
+
+        if os.path.isfile(record_path):
+            with open(record_path) as f:
+                record = json.load(f)
+            if record.get("signature") == signature:
+                return record["digest"]
+
+        record = {"signature": signature,
+                  "digest": tree_digest(template_path, TEMPLATE_EXCLUDED)}
+
+        tmp = "{}.{}.tmp".format(record_path, uuid4().hex)
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.rename(tmp, record_path)
+
+        return record["digest"]
+
+    def key(self, template_path, submission_folder, cmake_flags):
+        return sha1_of(self.template_digest(template_path),
+                       tree_digest(os.path.join(submission_folder, 'FOSSSim')),
+                       toolchain_signature(),
+                       cmake_flags)
+
+    def lookup(self, key):
+        '''
+        The path of the cached binary for key, or None.
+        '''
+        path = os.path.join(self.directory, "binaries", key[:2], key)
+        if os.path.isfile(path):
+            return path
+        return None
+
+    def store(self, key, binary_path):
+        atomic_copy(binary_path, self._path("binaries", key[:2], key))
+
+class VerdictCache(object):
+    '''
+    Scene verdicts keyed by the digests of the student binary, the scene file
+    and the oracle (and the limits they ran under, and the reference output
+    and tolerance a comparator judged by), so that a change to any of them
+    never hits a stale entry. Only passes and failures are cached;
+    crashes and timeouts may depend on the state of the machine.
+    '''
+    def __init__(self, directory=VERDICT_CACHE_DIRECTORY):
+        self.directory = directory
+
+    def key(self, binary_path, scene_path, oracle_path, limits, scene_digest=None,
+            comparison=None):
+        '''
+        scene_digest, if given, is trusted as the digest of the scene file
+        instead of reading it (see scene_index.py). comparison is the
+        signature of the references.ReferenceComparator the scene is run
+        with, if any.
+        '''
+        return sha1_of(file_digest(binary_path),
+                       scene_digest or file_digest(scene_path),
+                       file_digest(oracle_path),
+                       str(limits),
+                       comparison or "")
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        '''
+        The cached True or False for key, or None on a miss.
+        '''
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                success = json.load(f)["success"]
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        try:
+            os.utime(path, None) # keep recently used verdicts the longest
+        except OSError:
+            pass
+
+        return success
+
+    def put(self, key, success):
+        if success not in (True, False):
+            return
+
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass # created concurrently
+
+        tmp = "{}.{}.tmp".format(path, uuid4().hex)
+        with open(tmp, 'w') as f:
+            json.dump({"success": success}, f)
+        os.rename(tmp, path)
+
+    def evict(self, max_age=VERDICT_CACHE_MAX_AGE, max_bytes=VERDICT_CACHE_MAX_BYTES):
+        '''
+        Removes entries older than max_age seconds, then the least recently
+        used ones until the cache fits in max_bytes.
+        '''
+        now = time.time()
+        entries = []
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+
+        for mtime, size, path in entries:
+            if now - mtime <= max_age and total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def maybe_evict(self):
+        '''
+        Runs evict if no process has done so in the last
+        VERDICT_EVICTION_INTERVAL.
+        '''
+        marker = os.path.join(self.directory, ".last_eviction")
+        try:
+            if time.time() - os.stat(marker).st_mtime < VERDICT_EVICTION_INTERVAL:
+                return
+        except OSError:
+            if not os.path.isdir(self.directory):
+                return
+
+        with open(marker, 'w'):
+            pass
+        self.evict()
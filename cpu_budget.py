@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+'''
+A host-wide budget of CPU tokens, shared by every grader process on the
+machine, in the spirit of GNU make's jobserver. Compiling a submission takes
+up to COMPILE_TOKENS tokens and runs make with that many jobs; running a
+test scene takes one. Work waits for a token instead of piling onto a busy
+machine, so the work in flight matches the cores there are.
+
+Each token is a lock file in CPU_BUDGET_DIRECTORY, held with flock, so the
+tokens of a grader that dies are released with it. Token i stands for core
+i: with GRADER_PIN_CORES=1, whatever runs under tokens is pinned to their
+cores with taskset.
+
+When LOAD_AWARE, fewer tokens are handed out while the load average shows
+work outside the budget (other users, or graders not using it), down to
+one. The load average trails by about a minute, so the budget's own share
+of it is worked out the same way: the tokens held are averaged over time
+like the kernel averages runnable processes, in a file of
+CPU_BUDGET_DIRECTORY that every grader updates as it takes tokens, and
+only the rest of the load counts against the budget.
+
+    python cpu_budget.py
+
+shows which tokens are held.
+'''
+
+import fcntl
+import math
+import os
+import tempfile
+import time
+from distutils.spawn import find_executable
+from multiprocessing import cpu_count
+
+# tokens in the budget; 0 turns it off, leaving compiles and scenes unbounded.
+CPU_TOKENS = int(os.environ.get("GRADER_CPU_TOKENS", cpu_count()))
+
+# the most tokens a single compile takes.
+COMPILE_TOKENS = int(os.environ.get("GRADER_COMPILE_TOKENS", CPU_TOKENS))
+
+# must be the same for every grader on the machine, and local to it.
+CPU_BUDGET_DIRECTORY = os.environ.get("GRADER_CPU_BUDGET",
+                                      os.path.join(tempfile.gettempdir(), "grader_cpu_budget"))
+
+PIN_CORES = os.environ.get("GRADER_PIN_CORES", "") == "1"
+LOAD_AWARE = os.environ.get("GRADER_LOAD_AWARE", "1") == "1"
+
+# how often a process waiting for tokens looks for free ones, in seconds.
+TOKEN_POLL_INTERVAL = 0.2
+
+# the time constant of the 1-minute load average, in seconds.
+LOAD_AVERAGE_PERIOD = 60.0
+
+class Tokens(object):
+    '''
+    Tokens held by this process, released on exit from a with block. A
+    process outside the budget holds none, and count is None.
+    '''
+    def __init__(self, held):
+        self.held = held # (fd, slot) pairs
+
+    @property
+    def count(self):
+        return len(self.held) if self.held else None
+
+    def cores(self):
+        return sorted(slot % cpu_count() for fd, slot in self.held)
+
+    def pin(self, args):
+        '''
+        args, run on the cores of the tokens if PIN_CORES.
+        '''
+        if not PIN_CORES or not self.held or find_executable("taskset") is None:
+            return args
+        return ["taskset", "-c", ",".join(str(c) for c in self.cores())] + list(args)
+
+    def make_args(self):
+        '''
+        The command to run make with as many jobs as there are tokens.
+        '''
+        jobs = "-j" if self.count is None else "-j{}".format(self.count)
+        return self.pin(["make", jobs])
+
+    def release(self):
+        for fd, slot in self.held:
+            os.close(fd)
+        self.held = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def _open_shared(name, flags):
+    '''
+    Opens a file of CPU_BUDGET_DIRECTORY, which every grader may use.
+    '''
+    if not os.path.isdir(CPU_BUDGET_DIRECTORY):
+        try:
+            os.makedirs(CPU_BUDGET_DIRECTORY)
+            # graders may run as different users.
+            os.chmod(CPU_BUDGET_DIRECTORY, 0o1777)
+        except OSError:
+            pass # created concurrently
+
+    fd = os.open(os.path.join(CPU_BUDGET_DIRECTORY, name), flags | os.O_CREAT, 0o666)
+    # the processes started under a token would hold its lock on past its
+    # release.
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    try:
+        os.fchmod(fd, 0o666)
+    except OSError:
+        pass # someone else's
+    return fd
+
+def _open_slot(slot):
+    return _open_shared("token{}".format(slot), os.O_RDONLY)
+
+def _read_load(fd, now):
+    '''
+    The average number of tokens held, folded up to now, from the load file
+    open at fd; None if it's empty.
+    '''
+    try:
+        then, average, held = [float(v) for v in os.read(fd, 128).split()]
+    except ValueError:
+        return None
+    decay = math.exp(-max(0.0, now - then) / LOAD_AVERAGE_PERIOD)
+    return held + (average - held) * decay
+
+def budget_load(busy):
+    '''
+    What the budget adds to the 1-minute load average, now that busy tokens
+    are held: the number held, averaged over time as the kernel does. The
+    count is only sampled as tokens are taken (see record_load), so tokens
+    released since make it err on the high side, and the limit on the
+    generous one.
+    '''
+    fd = _open_shared("load", os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        average = _read_load(fd, time.time())
+    finally:
+        os.close(fd)
+    return float(busy) if average is None else average
+
+def record_load(held):
+    '''
+    Records that held tokens are held from now on, for budget_load.
+    '''
+    fd = _open_shared("load", os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        now = time.time()
+        average = _read_load(fd, now)
+        if average is None:
+            average = float(held)
+
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, "{} {} {}".format(now, average, held).encode('ascii'))
+    finally:
+        os.close(fd)
+
+def token_limit(busy):
+    '''
+    How many tokens may be held at once, given that busy of them are.
+    '''
+    if not LOAD_AWARE:
+        return CPU_TOKENS
+
+    # each held token is about one runnable process; the rest of the load
+    # comes from outside the budget.
+    outside = max(0.0, os.getloadavg()[0] - budget_load(busy))
+    return max(1, min(CPU_TOKENS, int(cpu_count() - outside)))
+
+def try_acquire(wanted):
+    '''
+    Takes up to wanted free tokens without waiting, as long as the host
+    stays within token_limit. Returns the Tokens, which may be none.
+    '''
+    held = []
+    busy = 0
+    for slot in range(CPU_TOKENS):
+        fd = _open_slot(slot)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            busy += 1
+            continue
+
+        if len(held) < wanted:
+            held.append((fd, slot))
+        else:
+            os.close(fd) # only counted
+
+    allowed = max(0, min(wanted, token_limit(busy) - busy))
+    for fd, slot in held[allowed:]:
+        os.close(fd)
+    if LOAD_AWARE and allowed:
+        record_load(busy + allowed)
+    return Tokens(held[:allowed])
+
+def acquire_tokens(wanted=1):
+    '''
+    Waits until at least one token is free, and returns Tokens holding up
+    to wanted of them.
+    '''
+    if CPU_TOKENS <= 0:
+        return Tokens([])
+
+    wanted = max(1, wanted)
+    while True:
+        tokens = try_acquire(wanted)
+        if tokens.held:
+            return tokens
+        time.sleep(TOKEN_POLL_INTERVAL)
+
+def main():
+    held = []
+    for slot in range(CPU_TOKENS):
+        fd = _open_slot(slot)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            held.append(slot)
+        finally:
+            os.close(fd)
+
+    print("{} of {} tokens held: {}".format(len(held), CPU_TOKENS,
+                                            ", ".join(str(s) for s in held) or "none"))
+    print("Load-aware limit: {}".format(token_limit(len(held))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+'''
+The student-facing end of grading_daemon.py: hands a submission to the
+grading service and relays the terminal to and from it. The grader's exit
+status comes last, as EXIT_MARKER, the status and a newline.
+'''
+
+import json
+import os
+import select
+import socket
+import sys
+
+GRADER_SOCKET = os.environ.get("GRADER_SOCKET", "./grader.sock")
+
+# what the grader's exit status follows; never part of what it prints.
+EXIT_MARKER = b"\0exit "
+
+def daemon_available(socket_path=GRADER_SOCKET):
+    return os.path.exists(socket_path)
+
+def exit_status_frame(code):
+    return EXIT_MARKER + str(code).encode('ascii') + b"\n"
+
+def split_output(data):
+    '''
+    Splits what the service sent into what to print, the exit status it
+    holds (or None), and what to keep for later: the start of an exit
+    status frame whose end hasn't come yet.
+    '''
+    printed = b""
+    status = None
+    while True:
+        start = data.find(EXIT_MARKER)
+        if start < 0:
+            break
+        end = data.find(b"\n", start)
+        if end < 0:
+            return printed + data[:start], status, data[start:]
+
+        printed += data[:start]
+        try:
+            status = int(data[start + len(EXIT_MARKER):end])
+        except ValueError:
+            pass
+        data = data[end + 1:]
+
+    # the marker may be cut short at the end.
+    for length in range(min(len(EXIT_MARKER) - 1, len(data)), 0, -1):
+        if EXIT_MARKER.startswith(data[-length:]):
+            return printed + data[:-length], status, data[-length:]
+    return printed + data, status, b""
+
+def submit_to_daemon(uni, original_folder, socket_path=GRADER_SOCKET):
+    '''
+    Asks the grading service to process the submission, and relays stdin and
+    stdout to it until it's done. Returns the grader's exit status, which is
+    1 if it never came. Raises socket.error if the service can't be
+    reached.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+
+    request = {"uni": uni, "folder": os.path.abspath(original_folder)}
+    sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+    sources = [sock, stdin]
+    pending = b""
+    status = None
+
+    try:
+        while True:
+            readable, _, _ = select.select(sources, [], [])
+
+            if stdin in readable:
+                data = os.read(stdin, 4096)
+                if data:
+                    sock.sendall(data)
+                else:
+                    sock.shutdown(socket.SHUT_WR)
+                    sources.remove(stdin)
+
+            if sock in readable:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                printed, received, pending = split_output(pending + data)
+                if received is not None:
+                    status = received
+                if printed:
+                    os.write(stdout, printed)
+    finally:
+        sock.close()
+
+    if pending:
+        os.write(stdout, pending)
+    return 1 if status is None else status
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from models import Assignment, AssignmentAssetDirectory, Session
+from references import precompute_references
 import dateutil.parser
 
 def define_asset_directory():
@@ -66,6 +67,8 @@ def define_assignment(theme=None, milestone=None, deliverable=None,
 
     session.commit()
 
+    precompute_references(assignment)
+
 DEFAULT_ASSET_DIRECTORY        = "/home/cs4167/assets/t{0}m{1}/Deliverable{2}/"
 DEFAULT_HIDDEN_ASSET_DIRECTORY = "/home/cs4167/grading/hiddenassets/t{0}m{1}/Deliverable{2}/"
 
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+'''
+Exports submissions with the results of their test scenes, for audits and
+grade disputes, in constant memory: rows are read from the database in
+chunks of EXPORT_CHUNK_SIZE and written out as they come.
+
+    python export.py [-f jsonl|csv|parquet] [-o <output file>]
+                     [-a <assignment name>] [-u <student uni>]
+                     [-s <submitted at or after>] [-e <submitted before>]
+
+jsonl (the default) writes one submission per line, with its runs in a
+list. csv and parquet write one row per run, the columns of its submission
+repeated on each; a submission without runs takes one row with empty run
+columns. Runs superseded by a regrade are left out. parquet needs pyarrow, and an output file; the others write to
+stdout without one. Times are parsed with dateutil, and compared to
+submission times as stored (in UTC).
+'''
+
+import csv
+import datetime
+import json
+import sys
+from collections import OrderedDict
+
+import dateutil.parser
+from sqlalchemy import Boolean, DateTime, Float, Integer, and_
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from json_interface import DateEncoder
+from models import Assignment, Session, Student, Submission, TestSceneRun
+
+# rows fetched from the database at a time, and rows per parquet row group.
+EXPORT_CHUNK_SIZE = 1000
+
+FORMATS = ['jsonl', 'csv', 'parquet']
+
+SUBMISSION_COLUMNS = [
+    ("submission_id",       Submission.id),
+    ("theme",               Assignment.theme),
+    ("milestone",           Assignment.milestone),
+    ("deliverable",         Assignment.deliverable),
+    ("uni",                 Student.uni),
+    ("submission_time",     Submission.submission_time),
+    ("passed_count",        Submission.passed_count),
+    ("total_count",         Submission.total_count),
+    ("graded_passed_count", Submission.graded_passed_count),
+    ("graded_total_count",  Submission.graded_total_count),
+    ("difficulty_rating",   Submission.difficulty_rating),
+    ("fun_rating",          Submission.fun_rating),
+    ("frustration_rating",  Submission.frustration_rating),
+    ("days_spent_on",       Submission.days_spent_on),
+    ("comments",            Submission.comments),
+    ("prepare_time",        Submission.prepare_time),
+    ("compile_time",        Submission.compile_time),
+    ("test_time",           Submission.test_time),
+    ("persist_time",        Submission.persist_time),
+]
+
+RUN_COLUMNS = [
+    ("run_id",              TestSceneRun.id),
+    ("scene_path",          TestSceneRun.scene_path),
+    ("run_time",            TestSceneRun.run_time),
+    ("success",             TestSceneRun.success),
+    ("verdict",             TestSceneRun.verdict),
+    ("graded",              TestSceneRun.graded),
+    ("duration",            TestSceneRun.duration),
+    ("student_wall_time",   TestSceneRun.student_wall_time),
+    ("student_user_time",   TestSceneRun.student_user_time),
+    ("student_system_time", TestSceneRun.student_system_time),
+    ("student_max_rss",     TestSceneRun.student_max_rss),
+    ("oracle_wall_time",    TestSceneRun.oracle_wall_time),
+    ("oracle_user_time",    TestSceneRun.oracle_user_time),
+    ("oracle_system_time",  TestSceneRun.oracle_system_time),
+    ("oracle_max_rss",      TestSceneRun.oracle_max_rss),
+    ("scene_digest",        TestSceneRun.scene_digest),
+    ("oracle_digest",       TestSceneRun.oracle_digest),
+]
+
+def export_rows(ses, assignment=None, uni=None, start=None, end=None):
+    '''
+    The submissions matching the filters joined with their runs, as tuples
+    of SUBMISSION_COLUMNS then RUN_COLUMNS, ordered by submission and run,
+    and fetched EXPORT_CHUNK_SIZE at a time.
+    '''
+    columns = [c for name, c in SUBMISSION_COLUMNS + RUN_COLUMNS]
+    query = ses.query(*columns)\
+               .select_from(Submission)\
+               .join(Assignment, Submission.assignment_id == Assignment.id)\
+               .join(Student, Submission.student_id == Student.id)\
+               .outerjoin(TestSceneRun, and_(TestSceneRun.submission_id == Submission.id,
+                                             TestSceneRun.superseded == False))
+
+    if assignment is not None:
+        query = query.filter(Submission.assignment_id == assignment.id)
+    if uni is not None:
+        query = query.filter(Student.uni == uni)
+    if start is not None:
+        query = query.filter(Submission.submission_time >= start)
+    if end is not None:
+        query = query.filter(Submission.submission_time < end)
+
+    return query.order_by(Submission.id, TestSceneRun.id).yield_per(EXPORT_CHUNK_SIZE)
+
+def split_row(row):
+    '''
+    The submission and run of a row as dicts; the run is None for a
+    submission without runs.
+    '''
+    count = len(SUBMISSION_COLUMNS)
+    submission = OrderedDict(zip([name for name, c in SUBMISSION_COLUMNS], row[:count]))
+    run = OrderedDict(zip([name for name, c in RUN_COLUMNS], row[count:]))
+    if run["run_id"] is None:
+        run = None
+    return submission, run
+
+def write_jsonl(rows, out):
+    '''
+    Writes one line per submission, with its runs. Returns the number of
+    submissions written.
+    '''
+    written = 0
+    current = None
+    for row in rows:
+        submission, run = split_row(row)
+        if current is None or current["submission_id"] != submission["submission_id"]:
+            if current is not None:
+                out.write(json.dumps(current, cls=DateEncoder) + "\n")
+                written += 1
+            current = submission
+            current["runs"] = []
+        if run is not None:
+            current["runs"].append(run)
+
+    if current is not None:
+        out.write(json.dumps(current, cls=DateEncoder) + "\n")
+        written += 1
+    return written
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def write_csv(rows, out):
+    '''
+    Writes a header and one line per row. Returns the number of rows
+    written.
+    '''
+    writer = csv.writer(out)
+    writer.writerow([name for name, c in SUBMISSION_COLUMNS + RUN_COLUMNS])
+
+    written = 0
+    for row in rows:
+        writer.writerow([_csv_value(v) for v in row])
+        written += 1
+    return written
+
+def _arrow_type(column):
+    column_type = column.property.columns[0].type
+    if isinstance(column_type, Boolean):
+        return pyarrow.bool_()
+    if isinstance(column_type, Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, Float):
+        return pyarrow.float64()
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp('us')
+    return pyarrow.string()
+
+def write_parquet(rows, path):
+    '''
+    Writes the rows to a parquet file at path, one row group per
+    EXPORT_CHUNK_SIZE rows. Returns the number of rows written.
+    '''
+    columns = SUBMISSION_COLUMNS + RUN_COLUMNS
+    schema = pyarrow.schema([pyarrow.field(name, _arrow_type(c)) for name, c in columns])
+    writer = pyarrow.parquet.ParquetWriter(path, schema)
+
+    def write_chunk(chunk):
+        arrays = [pyarrow.array([row[i] for row in chunk], type=schema[i].type)
+                  for i in range(len(columns))]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    written = 0
+    chunk = []
+    try:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == EXPORT_CHUNK_SIZE:
+                write_chunk(chunk)
+                written += len(chunk)
+                chunk = []
+        if chunk:
+            write_chunk(chunk)
+            written += len(chunk)
+    finally:
+        writer.close()
+    return written
+
+def usage():
+    print("Usage: {} [-f jsonl|csv|parquet] [-o <output file>]\n"
+          "       [-a <assignment name>] [-u <student uni>]\n"
+          "       [-s <submitted at or after>] [-e <submitted before>]".format(sys.argv[0]))
+    sys.exit(0)
+
+def main():
+    args = sys.argv[1:]
+    output_format = 'jsonl'
+    output_path = None
+    assignment_name = None
+    uni = None
+    start = None
+    end = None
+
+    while args:
+        option = args.pop(0)
+        if option == '-f' and args and args[0] in FORMATS:
+            output_format = args.pop(0)
+        elif option == '-o' and args:
+            output_path = args.pop(0)
+        elif option == '-a' and args:
+            assignment_name = args.pop(0)
+        elif option == '-u' and args:
+            uni = args.pop(0)
+        elif option == '-s' and args:
+            start = dateutil.parser.parse(args.pop(0))
+        elif option == '-e' and args:
+            end = dateutil.parser.parse(args.pop(0))
+        else:
+            usage()
+
+    if output_format == 'parquet':
+        if pyarrow is None:
+            print("Exporting to parquet needs pyarrow.")
+            sys.exit(1)
+        if output_path is None:
+            print("Exporting to parquet needs an output file (-o).")
+            sys.exit(1)
+
+    ses = Session()
+
+    assignment = None
+    if assignment_name is not None:
+        assignment = next((a for a in ses.query(Assignment) if a.name() == assignment_name), None)
+        if assignment is None:
+            print("No assignment named '{}'.".format(assignment_name))
+            sys.exit(1)
+
+    rows = export_rows(ses, assignment, uni, start, end)
+
+    if output_format == 'parquet':
+        written = write_parquet(rows, output_path)
+        sys.stderr.write("Exported {} rows to '{}'.\n".format(written, output_path))
+        return
+
+    write = write_jsonl if output_format == 'jsonl' else write_csv
+    if output_path is None:
+        write(rows, sys.stdout)
+        return
+
+    with open(output_path, 'wb') as out:
+        written = write(rows, out)
+    sys.stderr.write("Exported {} {} to '{}'.\n".format(
+        written, "submissions" if output_format == 'jsonl' else "rows", output_path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+'''
+The grades of every student on every assignment, computed with a few
+aggregate queries instead of loading each student's submissions and runs.
+
+    python gradebook.py [-j] [-a <assignment name>] [<output filepath>]
+
+writes the gradebook as CSV (or JSON with -j) to the file, or to stdout.
+'''
+
+import csv
+import json
+import sys
+from collections import OrderedDict
+
+from sqlalchemy import Float, case, cast, func
+
+from models import Assignment, Session, Student, Submission, TestSceneRun
+
+FIELDS = ["uni", "assignment", "submissions", "latest_grade", "best_grade",
+          "latest_passed", "latest_total", "latest_submission_time"]
+
+def submission_grades(ses):
+    '''
+    A subquery of the passed and total runs and the grade of every
+    submission. Submissions without runs (creative scenes) have no grade.
+    '''
+    runs = ses.query(TestSceneRun.submission_id.label("submission_id"),
+                     func.count(TestSceneRun.id).label("total"),
+                     func.sum(case([(TestSceneRun.success == True, 1)], else_=0)).label("passed"))\
+              .filter(TestSceneRun.superseded == False)\
+              .group_by(TestSceneRun.submission_id)\
+              .subquery()
+
+    return ses.query(Submission.id.label("id"),
+                     Submission.student_id.label("student_id"),
+                     Submission.assignment_id.label("assignment_id"),
+                     Submission.submission_time.label("submission_time"),
+                     runs.c.passed.label("passed"),
+                     runs.c.total.label("total"),
+                     (cast(runs.c.passed, Float) / runs.c.total).label("grade"))\
+              .outerjoin(runs, runs.c.submission_id == Submission.id)\
+              .subquery()
+
+def compute_gradebook(ses, assignments=None):
+    '''
+    A dict with FIELDS for every student and every assignment (or the given
+    ones), in order of uni and assignment. The latest submission is the one
+    Student.grade_on would grade; a student without submissions gets 0.0,
+    as there.
+    '''
+    if assignments is None:
+        assignments = ses.query(Assignment).order_by(Assignment.theme,
+                                                     Assignment.milestone,
+                                                     Assignment.deliverable).all()
+    students = ses.query(Student).order_by(Student.uni).all()
+
+    grades = submission_grades(ses)
+
+    # submission ids grow with submission_time, so the latest is the max.
+    summaries = ses.query(grades.c.student_id.label("student_id"),
+                          grades.c.assignment_id.label("assignment_id"),
+                          func.count(grades.c.id).label("submissions"),
+                          func.max(grades.c.id).label("latest_id"),
+                          func.max(grades.c.grade).label("best_grade"))\
+                   .group_by(grades.c.student_id, grades.c.assignment_id)\
+                   .subquery()
+
+    latest = grades.alias("latest")
+    query = ses.query(summaries.c.student_id,
+                      summaries.c.assignment_id,
+                      summaries.c.submissions,
+                      summaries.c.best_grade,
+                      latest.c.grade,
+                      latest.c.passed,
+                      latest.c.total,
+                      latest.c.submission_time)\
+               .join(latest, latest.c.id == summaries.c.latest_id)
+
+    assignment_ids = [a.id for a in assignments]
+    if assignment_ids:
+        query = query.filter(summaries.c.assignment_id.in_(assignment_ids))
+
+    found = {}
+    for (student_id, assignment_id, submissions, best_grade,
+         grade, passed, total, submission_time) in query:
+        found[(student_id, assignment_id)] = {
+            "submissions": submissions,
+            "latest_grade": grade,
+            "best_grade": best_grade,
+            "latest_passed": passed,
+            "latest_total": total,
+            "latest_submission_time": submission_time
+        }
+
+    gradebook = []
+    for student in students:
+        for assignment in assignments:
+            row = {"uni": student.uni, "assignment": assignment.name()}
+            row.update(found.get((student.id, assignment.id), {
+                "submissions": 0,
+                "latest_grade": 0.0,
+                "best_grade": 0.0,
+                "latest_passed": None,
+                "latest_total": None,
+                "latest_submission_time": None
+            }))
+            gradebook.append(row)
+
+    return gradebook
+
+def write_csv(gradebook, out):
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    for row in gradebook:
+        writer.writerow(["" if row[f] is None else row[f] for f in FIELDS])
+
+def write_json(gradebook, out):
+    def serialize(value):
+        return value.isoformat() if hasattr(value, "isoformat") else value
+
+    json.dump([OrderedDict((f, serialize(row[f])) for f in FIELDS) for row in gradebook],
+              out, indent=2)
+    out.write("\n")
+
+def usage():
+    print("Usage: {} [-j] [-a <assignment name>] [<output filepath>]".format(sys.argv[0]))
+    sys.exit(0)
+
+def main():
+    args = sys.argv[1:]
+    as_json = False
+    assignment_name = None
+
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option == '-j':
+            as_json = True
+        elif option == '-a' and args:
+            assignment_name = args.pop(0)
+        else:
+            usage()
+
+    ses = Session()
+
+    assignments = None
+    if assignment_name is not None:
+        assignments = [a for a in ses.query(Assignment) if a.name() == assignment_name]
+        if not assignments:
+            print("No assignment named '{}'.".format(assignment_name))
+            sys.exit(1)
+
+    gradebook = compute_gradebook(ses, assignments)
+    write = write_json if as_json else write_csv
+
+    if args:
+        with open(args[0], 'w') as out:
+            write(gradebook, out)
+    else:
+        write(gradebook, sys.stdout)
+
+if __name__ == '__main__':
+    main()
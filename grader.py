@@ -4,21 +4,77 @@ import datetime
 import os
 import sys
 import glob
+import shutil
+import socket
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 from contextlib import contextmanager
-from distutils.dir_util import copy_tree, remove_tree
+from distutils.dir_util import remove_tree
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from uuid import uuid4
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from cache import BuildCache, VerdictCache, file_digest
+from cpu_budget import acquire_tokens, COMPILE_TOKENS
+from daemon_client import daemon_available, submit_to_daemon
+from references import reference_comparator
+from sandbox import ProcessGroup
+from storage import archive_submission
+from warm_build import warm_build, WARM_BUILD_DIRECTORY
+from workspace import materialize_template, copy_folder
 from models import (Assignment, 
                     Submission, 
                     Student, 
                     Session, 
                     TestSceneRun,
-                    CREATIVE_SCENE)
+                    LatestSubmission,
+                    GradingJob,
+                    CREATIVE_SCENE,
+                    BUILD_JOB,
+                    DONE,
+                    JOB_FAILED,
+                    PASSED,
+                    FAILED,
+                    TIMEOUT,
+                    OOM,
+                    SKIPPED,
+                    retry_on_lock)
 
 # the width of the terminal output. things are left-padded
 # to hit this target width.
 MAIN_WIDTH = 72
 
+# the number of test scenes run at the same time. every scene runs in its own
+# scratch directory, so this is only bounded by the cores of the grading box.
+TEST_WORKERS = int(os.environ.get("GRADER_TEST_WORKERS", cpu_count()))
+
+# if set, submissions are built and tested by job_queue.py workers instead
+# of by the grader itself.
+DISTRIBUTED = os.environ.get("GRADER_DISTRIBUTED", "") == "1"
+
+# how often the results of workers are checked for, in seconds.
+RESULT_POLL_INTERVAL = 0.5
+
+# if set, submission folders are packed into storage.py's blob store as soon
+# as they're recorded, and removed, after the student has their result.
+# otherwise they stay until storage.py pack (run from cron, say) packs them.
+ARCHIVE_SUBMISSIONS = os.environ.get("GRADER_ARCHIVE", "") == "1"
+
+# if set, that many of the quickest scenes are run before the others are
+# started, as a smoke test.
+SMOKE_SCENES = int(os.environ.get("GRADER_SMOKE_SCENES", 0))
+
+# if set, and the first that many scenes run all fail, the remaining scenes
+# are skipped and count as failed. at most SMOKE_SCENES, nothing else has
+# been started by then.
+FAIL_FAST_SCENES = int(os.environ.get("GRADER_FAIL_FAST", 0))
+
 VALID_SCENE_EXTENSIONS = ['.xml']
 VALID_MOVIE_EXTENSIONS = ['.mpeg', '.mpg', '.mov', '.mkv', '.avi', '.mp4']
 
@@ -41,6 +97,9 @@ def chdir(d):
 
 SUBMISSIONS_DIRECTORY = "./submissions"
 
+# part of the build cache key, so a change here invalidates cached builds.
+CMAKE_FLAGS = "-DCMAKE_BUILD_TYPE=Release"
+
 def bold(s):
     return "\033[1m{0}\033[0m".format(s)
 
@@ -98,39 +157,85 @@ def get_submission_folder_path(assignment, uni):
 
 def prepare_submission_folder(original_folder, submission_folder, assignment):
     '''
-    Copies all the files into the submission folder, to prepare for
-    compilation and testing.
+    Puts all the files into the submission folder, to prepare for
+    compilation and testing. Template files share their contents with the
+    template; only the student's folders are really copied.
     '''
     if not os.path.exists(assignment.template_path):
         fatal("Couldn't find assignment starter code at '{}'.".format(assignment.template_path))
 
-    copy_tree(assignment.template_path, submission_folder)
-    os.system("chmod -R 777 " + submission_folder)
-    copy_tree(os.path.join(original_folder, 'FOSSSim'), 
-              os.path.join(submission_folder, 'FOSSSim'))
+    materialize_template(assignment.template_path, submission_folder)
+    copy_folder(os.path.join(original_folder, 'FOSSSim'), 
+                os.path.join(submission_folder, 'FOSSSim'))
 
-    copy_tree(os.path.join(original_folder, 'Creative'), 
-              os.path.join(submission_folder, 'Creative'))
+    copy_folder(os.path.join(original_folder, 'Creative'), 
+                os.path.join(submission_folder, 'Creative'))
 
-def compile_submission(submission_folder):
+def build_submission(submission_folder, template_path=None):
+    '''
+    Builds the submission. Returns the path of its FOSSSim binary, and None
+    or a message explaining why it couldn't be built. If template_path is
+    given and identical sources were built before, the cached binary is
+    reused instead of running the toolchain; otherwise the submission is
+    built in a warm build of the template (see warm_build.py).
+    '''
     build_folder = os.path.join(submission_folder, 'build/')
     if not os.path.exists(build_folder):
         os.mkdir(build_folder)
         if not os.path.exists(build_folder):
-            fatal("Build directory was not correctly copied into the submission folder.")
-
-    with chdir(build_folder):
-        os.system('cmake -DCMAKE_BUILD_TYPE=Release ..')
-        compilation_result = os.system('make -j')
+            return None, "Build directory was not correctly copied into the submission folder."
+
+    expected_binary_path = os.path.abspath(os.path.join(build_folder, "FOSSSim", "FOSSSim"))
+
+    cache_key = None
+    if template_path is not None:
+        cache = BuildCache()
+        cache_key = cache.key(template_path, submission_folder, CMAKE_FLAGS)
+
+        cached_binary = cache.lookup(cache_key)
+        if cached_binary is not None:
+            print("Reusing the build of a previous submission with identical sources.")
+            if not os.path.isdir(os.path.dirname(expected_binary_path)):
+                os.mkdir(os.path.dirname(expected_binary_path))
+            shutil.copy2(cached_binary, expected_binary_path)
+            return expected_binary_path, None
+
+    binary_path = None
+    if template_path is not None and WARM_BUILD_DIRECTORY:
+        binary_path, error = warm_build(template_path, submission_folder, CMAKE_FLAGS,
+                                        expected_binary_path)
+        if error is not None:
+            return None, error
+
+    # no warm build could be made; build the submission on its own.
+    if binary_path is None:
+        with chdir(build_folder):
+            os.system('cmake {} ..'.format(CMAKE_FLAGS))
+            with acquire_tokens(COMPILE_TOKENS) as tokens:
+                compilation_result = os.system(' '.join(tokens.make_args()))
 
         if compilation_result > 0:
-            fatal_cancel(submission_folder, "Compilation failed.")
+            return None, "Compilation failed."
 
-        expected_binary_path = os.path.abspath(os.path.join("./FOSSSim", "FOSSSim"))
         if not os.path.isfile(expected_binary_path):
-            fatal_cancel(submission_folder, "Binary executable wasn't found in '{0}'.".format(expected_binary_path))
+            return None, "Binary executable wasn't found in '{0}'.".format(expected_binary_path)
+
+    if cache_key is not None:
+        cache.store(cache_key, expected_binary_path)
+
+    return expected_binary_path, None
+
+def compile_submission(submission_folder, template_path=None):
+    '''
+    Builds the submission (see build_submission) and returns the path of its
+    FOSSSim binary, or cancels the submission if it can't be built.
+    '''
+    binary_path, error = build_submission(submission_folder, template_path)
+    if binary_path is None:
+        fatal_cancel(submission_folder, error)
+
+    return binary_path
 
-    return expected_binary_path
 def shorten_test_path(path):
     return '/'.join(path.split('/')[-3:])
 
@@ -148,32 +253,217 @@ def print_result(result):
         sys.stdout.write(bold(green("[ OK ]\n")))
     elif result is False:
         sys.stdout.write(bold(  red("[FAIL]\n")))
+    elif result == TIMEOUT:
+        sys.stdout.write(bold(  red("[TIME]\n")))
+    elif result == OOM:
+        sys.stdout.write(bold(  red("[OOM ]\n")))
+    elif result == SKIPPED:
+        sys.stdout.write(bold(      "[SKIP]\n"))
     elif result is None:
         sys.stdout.write(bold(      "[N/A ]\n"))
 
-def run_tests(submission_executable, assignment, hashstr):
-    tests = assignment.tests()
-    runs = []
-
+def print_results_header():
     print("")
     print("=" * MAIN_WIDTH)
     print("  Test Results:")
     print("=" * MAIN_WIDTH)
     print("")
 
-    for t in tests:
-        print_test(t.filepath)
+def print_outcome(path, result, log):
+    '''
+    Prints the result of one test scene, along with what its run had to say.
+    '''
+    print_test(path)
+
+    if result is None:
+        sys.stdout.write(log)
+        print("Couldn't determine result of test '{0}'.".format(path.split('/')[-1]))
+    else:
+        print_result(result)
+        sys.stdout.write(log)
 
-        result = t.run(submission_executable, assignment.oracle_path, hashstr)
+    sys.stdout.flush()
 
-        if result is None:
-            print("Couldn't determine result of test '{0}'.".format(t.filepath.split('/')[-1]))
+def scene_run_of(path, result, graded=True, usage=None):
+    '''
+    The TestSceneRun recording the result of a test scene, or None if the
+    result couldn't be determined.
+    '''
+    if result is None:
+        return None
+    elif result in (TIMEOUT, OOM, SKIPPED):
+        return TestSceneRun(path=path, success=False, verdict=result, graded=graded, usage=usage)
+    else:
+        return TestSceneRun(path=path, success=result, graded=graded, usage=usage)
+
+def result_of_verdict(verdict):
+    '''
+    The inverse of scene_run_of: the result a stored verdict stands for.
+    '''
+    if verdict == PASSED:
+        return True
+    elif verdict == FAILED:
+        return False
+    else:
+        return verdict
+
+def scene_runner(submission_executable, assignment, hashstr, cache=None, group=None):
+    '''
+    A function that runs one TestScene of the assignment against the
+    submission and returns its result, whatever it printed and the resources
+    it used (see TestScene.run). Its processes belong to group, if given.
+    '''
+    limits = assignment.scene_limits()
+
+    def run_test(t):
+        log = StringIO()
+        usage = {}
+        started = time.time()
+        comparator = reference_comparator(t, assignment.oracle_path,
+                                          assignment.reference_tolerance,
+                                          assignment.reference_layout)
+        result = t.run(submission_executable, assignment.oracle_path, hashstr,
+                       out=log, limits=limits, cache=cache, comparator=comparator,
+                       usage=usage, group=group)
+        usage["duration"] = time.time() - started
+        # what it was graded with, for regrade.py.
+        usage["scene_digest"] = t.digest()
+        if os.path.isfile(assignment.oracle_path):
+            usage["oracle_digest"] = file_digest(assignment.oracle_path)
+        return result, log.getvalue(), usage
+
+    return run_test
+
+def order_by_history(assignment, tests):
+    '''
+    The tests, quickest first by how long they took on recent submissions.
+    Tests never timed keep their order, after the others.
+    '''
+    durations = assignment.scene_durations()
+    timed = sorted((t for t in tests if t.filepath in durations),
+                   key=lambda t: durations[t.filepath])
+    return timed + [t for t in tests if t.filepath not in durations]
+
+def should_fail_fast(results):
+    '''
+    Whether the FAIL_FAST_SCENES first determined results all failed.
+    Undetermined ones aren't counted either way, just as they aren't in the
+    totals of a submission, so the skipped scenes only ever stand in for
+    failures.
+    '''
+    determined = [r for r in results if r is not None]
+    return (FAIL_FAST_SCENES > 0 and len(determined) == FAIL_FAST_SCENES
+            and not any(r is True for r in determined))
+
+def run_tests(submission_executable, assignment, hashstr, workers=None):
+    '''
+    Runs every test scene of the assignment, up to `workers` at a time,
+    quickest first (see order_by_history), and prints the results in that
+    order. The SMOKE_SCENES first are run before the others are started;
+    if the FAIL_FAST_SCENES first all fail, the rest are skipped, and the
+    processes of scenes already started are killed.
+    '''
+    if workers is None:
+        workers = TEST_WORKERS
+
+    tests = order_by_history(assignment, assignment.tests())
+    runs = []
+    results = []
+
+    print_results_header()
+
+    cache = VerdictCache()
+    group = ProcessGroup()
+    run_test = scene_runner(submission_executable, assignment, hashstr, cache, group)
+
+    def run_batch(batch):
+        '''
+        Runs the batch of tests, and returns False if it was cut short
+        because the submission failed fast.
+        '''
+        pool = None
+        if workers > 1 and len(batch) > 1:
+            pool = ThreadPool(min(workers, len(batch)))
+            outcomes = pool.imap(run_test, batch)
         else:
-            print_result(result)
-            runs.append(TestSceneRun(path=t.filepath, success=result))
+            outcomes = (run_test(t) for t in batch)
+
+        try:
+            for t in batch:
+                result, log, usage = next(outcomes)
+                print_outcome(t.filepath, result, log)
+                results.append(result)
+
+                run = scene_run_of(t.filepath, result, t.graded, usage)
+                if run is not None:
+                    runs.append(run)
+
+                if should_fail_fast(results):
+                    # the pool's threads can't be stopped, only what they run.
+                    group.stop()
+                    return False
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        return True
+
+    if run_batch(tests[:SMOKE_SCENES]):
+        run_batch(tests[SMOKE_SCENES:])
+
+    skipped = tests[len(results):]
+    if skipped:
+        print("")
+        print("The first {} scenes all failed, so the other {} were skipped.".format(
+            FAIL_FAST_SCENES, len(skipped)))
+        print("")
+        for t in skipped:
+            print_outcome(t.filepath, SKIPPED, "")
+            runs.append(scene_run_of(t.filepath, SKIPPED, t.graded))
+
+    cache.maybe_evict()
 
     return runs
 
+def run_tests_on_workers(ses, assignment, submission_folder):
+    '''
+    Has job_queue.py workers build the submission and run its test scenes,
+    possibly on several machines at once, and prints the results in scene
+    order as they come in. The submission folder must be visible to every
+    worker.
+    '''
+    build = GradingJob(BUILD_JOB, assignment, submission_folder)
+    ses.add(build)
+    ses.commit()
+
+    print("Waiting for a grading worker to build your submission...")
+
+    printed = 0
+    while True:
+        ses.expire_all()
+
+        if build.state == JOB_FAILED:
+            fatal_cancel(submission_folder, build.message or "Building failed.")
+
+        if build.state == DONE:
+            if printed == 0:
+                print_results_header()
+
+            scenes = build.scenes
+            while printed < len(scenes) and scenes[printed].state in (DONE, JOB_FAILED):
+                scene = scenes[printed]
+                print_outcome(scene.scene_path, result_of_verdict(scene.result), scene.message or "")
+                printed += 1
+
+            if printed == len(scenes):
+                break
+
+        time.sleep(RESULT_POLL_INTERVAL)
+
+    return ses.query(TestSceneRun).filter(TestSceneRun.job_id == build.id)\
+                                  .order_by(TestSceneRun.id)\
+                                  .all()
+
 def print_test_summary(results, last_submission=None):
     success = len([r for r in results if r.success])
     print("")
@@ -197,8 +487,7 @@ def print_test_summary(results, last_submission=None):
     if last_submission is not None:
         print("")
         print("Compare that to your last submission:")
-        print_passed(len(last_submission.passed_runs()),
-                     len(last_submission.test_runs))
+        print_passed(*last_submission.counts())
 
     print("")
 
@@ -270,8 +559,17 @@ def gather_question_responses(submission):
 
     submission.comments = get_comments()
 
-def perform_submission(ses, student, test_results, submission_folder, assignment):
+def perform_submission(ses, student, test_results, submission_folder, assignment,
+        stage_times=None):
+    '''
+    Records the submission and its test results, and returns it.
+    stage_times holds the seconds spent preparing, compiling and testing it
+    (see Submission).
+    '''
     submission = Submission(assignment=assignment, student=student)
+    submission.folder_name = os.path.basename(os.path.normpath(submission_folder))
+    for stage, seconds in (stage_times or {}).items():
+        setattr(submission, stage, seconds)
 
     if assignment.deliverable == CREATIVE_SCENE:
         try:
@@ -279,20 +577,41 @@ def perform_submission(ses, student, test_results, submission_folder, assignment
         except EOFError:
             cancel_submission(submission_folder)
 
-    ses.add(submission)
-    ses.commit()
+    submission.count_runs(test_results)
 
-    for t in test_results:
-        t.submission_id = submission.id
-        ses.add(t)
+    def record_submission():
+        # a rolled-back attempt leaves the ids of rows it inserted behind.
+        for row in [submission] + list(test_results):
+            if inspect(row).transient:
+                row.id = None
 
-    ses.commit()
+        ses.add(submission)
+        ses.flush()
+
+        for t in test_results:
+            t.submission_id = submission.id
+            ses.add(t)
+
+        LatestSubmission.record(ses, submission)
+
+        ses.commit()
+
+    started = time.time()
+    retry_on_lock(ses, record_submission)
+
+    def record_persist_time():
+        submission.persist_time = time.time() - started
+        ses.commit()
+
+    retry_on_lock(ses, record_persist_time)
 
     print("")
     print(bold("Your submission is complete with ID {}!\n".format(blue(submission.id))) + 
           "Keep track of this ID. If something goes wrong \n" +
           "with your submission, inform your TA of this number.")
 
+    return submission
+
 def locate_creative_files(student, assignment, submission_folder):
     match_str = "{uni}_t{theme}m{milestone}.*".format(
             uni=student.uni,
@@ -328,31 +647,72 @@ def locate_creative_files(student, assignment, submission_folder):
         print("")
 
 
-def submit_assignment(ses, student, original_folder, submission_folder, assignment):
-    prepare_submission_folder(original_folder, submission_folder, assignment)
+@contextmanager
+def unthrottled(student, assignment):
+    yield
 
+def submit_assignment(ses, student, original_folder, submission_folder, assignment,
+        throttle=unthrottled):
+    '''
+    Prepares, builds and tests the submission, then asks the student whether
+    to submit it. The preparing, building and testing happen inside
+    throttle(student, assignment), which may hold them back until the
+    machine has room for them.
+    '''
     results = []
-    if not assignment.is_creative_scene():
-        submission_executable = compile_submission(submission_folder)
-
-        try:
-            results = run_tests(submission_executable, assignment, uuid4().hex)
-        except:
-            print_fatal("Python Error while running tests.")
-            cancel_submission(submission_folder)
-            raise
+    stage_times = {}
+    with throttle(student, assignment):
+        started = time.time()
+        prepare_submission_folder(original_folder, submission_folder, assignment)
+        stage_times["prepare_time"] = time.time() - started
+
+        if not assignment.is_creative_scene() and DISTRIBUTED:
+            # the workers' building counts as testing.
+            started = time.time()
+            results = run_tests_on_workers(ses, assignment, submission_folder)
+            stage_times["test_time"] = time.time() - started
+        elif not assignment.is_creative_scene():
+            started = time.time()
+            submission_executable = compile_submission(submission_folder, assignment.template_path)
+            stage_times["compile_time"] = time.time() - started
+
+            started = time.time()
+            try:
+                results = run_tests(submission_executable, assignment, uuid4().hex)
+            except:
+                print_fatal("Python Error while running tests.")
+                cancel_submission(submission_folder)
+                raise
+            stage_times["test_time"] = time.time() - started
 
-        last_submission = ses.query(Submission).filter(Submission.student == student)\
-                                               .filter(Submission.assignment == assignment)\
-                                               .order_by(Submission.submission_time.desc())\
-                                               .first()
+    if not assignment.is_creative_scene():
+        last_submission = student.latest_submission_on(assignment)
         print_test_summary(results, last_submission)
     else:
         locate_creative_files(student, assignment, submission_folder)
 
     if user_wants_to_submit():
-        perform_submission(ses, student, results, submission_folder, assignment)
+        submission = perform_submission(ses, student, results, submission_folder, assignment,
+                                        stage_times)
+        if ARCHIVE_SUBMISSIONS:
+            # the student has everything they need by now.
+            sys.stdout.flush()
+            try:
+                archive_submission(ses, submission, submission_folder)
+            except (IOError, OSError) as e:
+                # the folder stays for storage.py pack to pick up later, by
+                # the submission's folder_name.
+                print("Couldn't archive the submission folder: {}".format(e))
     else:
+        # runs stored by workers belong to no submission now.
+        def delete_runs():
+            for r in results:
+                if r.id is not None:
+                    ses.delete(r)
+            ses.commit()
+
+        retry_on_lock(ses, delete_runs)
+
         cancel_submission(submission_folder)
 
 def get_assignment(ses):
@@ -367,18 +727,26 @@ def get_assignment(ses):
 def get_student_of_uni(ses, uni):
     student = ses.query(Student).filter(Student.uni == uni).first()
 
-    if student is None:
-        print("Creating student {}".format(uni))
+    def create_student():
         student = Student(uni)
         ses.add(student)
+        ses.commit()
+        return student
+
+    if student is None:
+        print("Creating student {}".format(uni))
         try:
-            ses.commit()
+            student = retry_on_lock(ses, create_student)
+        except IntegrityError:
+            # created by a concurrent submission; students.uni is unique.
+            ses.rollback()
+            student = ses.query(Student).filter(Student.uni == uni).first()
         except Exception:
             fatal("Failed to create new student with UNI {}.".format(uni))
 
     return student
 
-def process_submission(uni, original_folder):
+def process_submission(uni, original_folder, throttle=unthrottled):
     '''
     The main function, that takes a student's UNI and a path to the submitted
     folder, and runs test scenes, calculates a grade, and adds rows to the
@@ -394,7 +762,7 @@ def process_submission(uni, original_folder):
 
     submission_folder = os.path.abspath(get_submission_folder_path(assignment, uni))
 
-    submit_assignment(ses, student, original_folder, submission_folder, assignment)
+    submit_assignment(ses, student, original_folder, submission_folder, assignment, throttle)
 
 def cancel_submission(submission_folder):
     remove_tree(submission_folder)
@@ -402,6 +770,12 @@ def cancel_submission(submission_folder):
 
 
 def main():
+    if daemon_available():
+        try:
+            sys.exit(submit_to_daemon(sys.argv[2], sys.argv[1]))
+        except socket.error:
+            print("The grading service isn't responding; grading here instead.")
+
     process_submission(sys.argv[2], sys.argv[1])
 
 if __name__ == '__main__':
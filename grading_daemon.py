@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+'''
+A long-running grading service. It keeps the database engine, the catalog
+of current assignments and their scenes, and the grader's caches warm, and
+forks a grader for every student who connects through daemon_client.py,
+with the student's terminal relayed over the connection.
+
+Graders hold one of a bounded number of worker slots while they build and
+test, so that a deadline rush queues up instead of oversubscribing the
+machine. Slots are asked for and given back over a socketpair shared with
+the daemon, which hands them out with a FairShareScheduler and tells
+waiting students when to expect theirs.
+
+Anyone on the machine can connect, so a request is only served if the
+connecting user (by SO_PEERCRED) is the student it names, by login name,
+and owns the folder it hands in; only DAEMON_TRUSTED_UIDS may grade for
+someone else. The grader's exit status is sent back last (see
+daemon_client.py), so grader.py exits with it as if it had graded itself.
+
+Every grader, and every student binary it runs, runs as the daemon's user,
+not as the student's. The daemon must therefore run as a dedicated
+unprivileged user, one that owns nothing but the grading data: the
+database, the submissions directory and the caches. It refuses to run as
+root.
+'''
+
+import errno
+import json
+import os
+import pwd
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+
+import grader
+import models
+from cache import file_digest, toolchain_signature
+from daemon_client import GRADER_SOCKET, exit_status_frame
+from models import Assignment, Session
+from scene_index import find_scenes
+from scheduler import FairShareScheduler
+
+# graders building or testing at the same time. each one runs its scenes in
+# parallel already (see grader.TEST_WORKERS).
+DAEMON_WORKERS = int(os.environ.get("GRADER_DAEMON_WORKERS", max(1, cpu_count() // 4)))
+
+# connected students, whether or not they are building or testing.
+MAX_SESSIONS = 256
+
+# how often the assignment catalog and scene lists are reloaded, in seconds.
+CATALOG_REFRESH_INTERVAL = 60
+
+# how long a client gets to send its request, in seconds.
+REQUEST_TIMEOUT = 5
+
+# how often students waiting for a slot are told where they stand, in seconds.
+STATUS_INTERVAL = 30
+
+# users that may grade for any uni, besides root and the daemon's own user.
+DAEMON_TRUSTED_UIDS = [int(uid) for uid in os.environ.get("GRADER_DAEMON_TRUSTED_UIDS", "").split(",")
+                       if uid.strip()]
+
+# not exposed by every python's socket module.
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+def send_message(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode('utf-8'))
+
+def read_line(sock):
+    '''
+    Reads one line from sock a byte at a time, so that nothing after it is
+    consumed. Returns None if the connection closes first.
+    '''
+    line = b""
+    while not line.endswith(b"\n"):
+        byte = sock.recv(1)
+        if not byte:
+            return None
+        line += byte
+    return line.decode('utf-8')
+
+def peer_uid(conn):
+    '''
+    The uid of the process on the other end of a unix socket.
+    '''
+    credentials = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', credentials)
+    return uid
+
+def refusal(request, uid):
+    '''
+    None if the user with uid may have the request graded, otherwise why
+    not.
+    '''
+    uni = request.get("uni")
+    folder = request.get("folder")
+    if not isinstance(uni, basestring) or not isinstance(folder, basestring):
+        return "Malformed request."
+
+    if uid in [0, os.getuid()] + DAEMON_TRUSTED_UIDS:
+        return None
+
+    try:
+        account = pwd.getpwnam(uni)
+    except KeyError:
+        return "There's no account named '{}' on this machine.".format(uni)
+    if account.pw_uid != uid:
+        return "You can only submit as yourself."
+
+    try:
+        owner = os.stat(folder).st_uid
+    except OSError:
+        return "Couldn't find '{}'.".format(folder)
+    if owner != uid:
+        return "You can only submit a folder you own."
+
+    return None
+
+def read_request(conn):
+    '''
+    Reads the client's request, and returns it if its user may have it
+    graded. Otherwise tells the client why not, and returns None.
+    '''
+    try:
+        conn.settimeout(REQUEST_TIMEOUT)
+        line = read_line(conn)
+        conn.settimeout(None)
+        request = json.loads(line)
+        uid = peer_uid(conn)
+    except (socket.error, socket.timeout, TypeError, ValueError, struct.error):
+        return None
+
+    reason = refusal(request, uid) if isinstance(request, dict) else "Malformed request."
+    if reason is not None:
+        try:
+            conn.sendall((reason + "\n").encode('utf-8'))
+        except socket.error:
+            pass
+        return None
+
+    return request
+
+def slot_throttle(control):
+    '''
+    A throttle for grader.submit_assignment that holds a worker slot of the
+    daemon on the other end of control for as long as it's entered.
+    '''
+    messages = control.makefile('rb')
+
+    @contextmanager
+    def throttle(student, assignment):
+        deadline = None
+        if assignment.due_date is not None:
+            absolute_deadline = assignment.due_date + Assignment.get_late_window()
+            deadline = time.mktime(absolute_deadline.timetuple())
+
+        send_message(control, {"acquire": {"uni": student.uni,
+                                           "assignment_id": assignment.id,
+                                           "deadline": deadline}})
+        while True:
+            line = messages.readline()
+            if not line:
+                grader.fatal("Lost contact with the grading service.")
+
+            message = json.loads(line.decode('utf-8'))
+            if "go" in message:
+                break
+            if "status" in message:
+                print(message["status"])
+
+        try:
+            yield
+        finally:
+            send_message(control, {"release": True})
+
+    return throttle
+
+def run_grader(conn, control):
+    '''
+    Runs in a forked child: reads the client's request, and grades its
+    submission with the student's terminal on conn, then exits.
+    '''
+    code = 1
+    client = conn.fileno() # where the exit status goes
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        request = read_request(conn)
+        if request is None:
+            sys.exit(1)
+
+        for fd in (0, 1, 2):
+            os.dup2(conn.fileno(), fd)
+        conn.close()
+        client = 1
+
+        sys.stdin = os.fdopen(0, 'r')
+        sys.stdout = os.fdopen(1, 'w', 1)
+        sys.stderr = os.fdopen(2, 'w', 1)
+
+        # connections made before the fork belong to the daemon.
+        models.engine.dispose()
+
+        grader.process_submission(request["uni"], request["folder"],
+                                  throttle=slot_throttle(control))
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+    except Exception:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.write(client, exit_status_frame(code))
+        except (IOError, OSError):
+            pass # the client is gone
+        finally:
+            os._exit(code)
+
+class GraderChild(object):
+    '''
+    The daemon's view of one forked grader.
+    '''
+    def __init__(self, pid, control):
+        self.pid = pid
+        self.control = control
+        self.uni = None # known once it asks for a slot
+        self.pending = b""
+        self.waiting = False
+        self.holding = False
+        self.last_status = None
+
+class GradingDaemon(object):
+    def __init__(self, socket_path=GRADER_SOCKET, workers=DAEMON_WORKERS):
+        self.socket_path = socket_path
+        self.workers = workers
+        self.children = {} # control socket fileno -> GraderChild
+        self.scheduler = FairShareScheduler(workers)
+        self.catalog_time = 0
+
+    def log(self, msg):
+        print("[{}] {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), msg))
+        sys.stdout.flush()
+
+    def refresh_catalog(self):
+        '''
+        Reads the scene indexes of every current assignment, so that forked
+        graders inherit them, and warms the digests of their oracles.
+        '''
+        ses = Session()
+        try:
+            scenes = {}
+            for assignment in Assignment.get_current_assignments(ses):
+                for directory in assignment.directories:
+                    scenes[directory.path] = find_scenes(directory.path)
+
+                if assignment.oracle_path and os.path.isfile(assignment.oracle_path):
+                    file_digest(assignment.oracle_path)
+
+            models.preloaded_scenes.clear()
+            models.preloaded_scenes.update(scenes)
+        finally:
+            ses.close()
+
+        self.catalog_time = time.time()
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o777)
+        self.listener.listen(64)
+
+        toolchain_signature()
+        self.log("Listening on {} with {} workers.".format(self.socket_path, self.workers))
+
+        try:
+            while True:
+                if time.time() - self.catalog_time > CATALOG_REFRESH_INTERVAL:
+                    self.refresh_catalog()
+
+                sockets = [self.listener] + [c.control for c in self.children.values()]
+                readable, _, _ = select.select(sockets, [], [], 1.0)
+
+                for sock in readable:
+                    if sock is self.listener:
+                        self.accept()
+                    elif sock.fileno() in self.children:
+                        self.handle_control(self.children[sock.fileno()])
+
+                self.reap()
+                self.grant_slots()
+                self.announce_waiting()
+        finally:
+            self.listener.close()
+            os.remove(self.socket_path)
+
+    def accept(self):
+        '''
+        Forks a grader for a new connection; the request is read by the
+        grader, so that a slow client holds up no one else.
+        '''
+        conn, _ = self.listener.accept()
+
+        if len(self.children) >= MAX_SESSIONS:
+            conn.sendall(b"The grading service is full; try again in a minute.\n")
+            conn.close()
+            return
+
+        control, child_control = socket.socketpair()
+
+        pid = os.fork()
+        if pid == 0:
+            self.listener.close()
+            control.close()
+            for child in self.children.values():
+                child.control.close()
+            run_grader(conn, child_control)
+
+        conn.close()
+        child_control.close()
+
+        self.children[control.fileno()] = GraderChild(pid, control)
+        self.log("Grader {} started.".format(pid))
+
+    def handle_control(self, child):
+        try:
+            data = child.control.recv(4096)
+        except socket.error:
+            data = b""
+
+        if not data:
+            self.remove(child)
+            return
+
+        child.pending += data
+        while b"\n" in child.pending:
+            line, child.pending = child.pending.split(b"\n", 1)
+            message = json.loads(line.decode('utf-8'))
+
+            if "acquire" in message:
+                child.waiting = True
+                child.uni = message["acquire"].get("uni")
+                self.scheduler.submit(child.pid, child.uni, message["acquire"].get("deadline"))
+            elif "release" in message:
+                child.holding = False
+                self.scheduler.finish(child.pid)
+
+    def remove(self, child):
+        del self.children[child.control.fileno()]
+        child.control.close()
+        if child.waiting:
+            self.scheduler.cancel(child.pid)
+        if child.holding:
+            self.scheduler.finish(child.pid)
+
+    def child_of_pid(self, pid):
+        for child in self.children.values():
+            if child.pid == pid:
+                return child
+        return None
+
+    def grant_slots(self):
+        pid = self.scheduler.start_next()
+        while pid is not None:
+            child = self.child_of_pid(pid)
+            child.waiting = False
+            child.holding = True
+            try:
+                send_message(child.control, {"go": True})
+            except socket.error:
+                pass # it has exited; remove() will give the slot back.
+            pid = self.scheduler.start_next()
+
+    def announce_waiting(self):
+        now = time.time()
+
+        for child in self.children.values():
+            if not child.waiting:
+                continue
+            if child.last_status is not None and now - child.last_status < STATUS_INTERVAL:
+                continue
+
+            ahead = self.scheduler.position(child.pid)
+            minutes = max(1, int(round((self.scheduler.estimated_start(child.pid) - now) / 60.0)))
+            status = "Waiting for a free grader ({} submissions ahead of yours); " \
+                     "expected to start in about {} minute{}.".format(
+                             ahead, minutes, "" if minutes == 1 else "s")
+            try:
+                send_message(child.control, {"status": status})
+            except socket.error:
+                pass
+            child.last_status = now
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            self.log("Grader {} exited with status {}.".format(pid, status))
+
+def main():
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else GRADER_SOCKET
+
+    if os.getuid() == 0:
+        print("The grading daemon runs student binaries, so it won't run as root; "
+              "run it as a dedicated unprivileged user.")
+        sys.exit(1)
+
+    # so that the socket is removed on the way out.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    GradingDaemon(socket_path).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+'''
+Workers that grade submissions handed to them through the grading_jobs
+table (see grader.run_tests_on_workers). A submission starts as one build
+job; once built, it fans out into one scene job per test scene, so that its
+scenes run on every free worker at once. Results are written back as
+ordinary TestSceneRun rows.
+
+Workers may run on several machines, as long as they share the database
+and the submissions directory. The database must then be a server
+database, given by GRADER_DATABASE_URL: a SQLite file can't be shared
+between machines (see models.create_database_engine), so workers refuse
+one on a network filesystem. A worker leases a job for LEASE_DURATION
+and keeps renewing the lease while it works; if it dies, the lease runs out
+and another worker takes the job over, up to MAX_ATTEMPTS times.
+
+    python job_queue.py [number of worker processes]
+'''
+
+import datetime
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from multiprocessing import Process, cpu_count
+from uuid import uuid4
+
+from sqlalchemy import and_, case, inspect, or_
+from sqlalchemy.exc import OperationalError
+
+import grader
+import models
+from cache import VerdictCache
+from models import (Session,
+                    GradingJob,
+                    retry_on_lock,
+                    TestScene,
+                    BUILD_JOB,
+                    SCENE_JOB,
+                    QUEUED,
+                    LEASED,
+                    DONE,
+                    JOB_FAILED)
+
+LEASE_DURATION = datetime.timedelta(seconds=60)
+HEARTBEAT_INTERVAL = 20 # seconds
+MAX_ATTEMPTS = 3
+
+# how long an idle worker waits before looking for jobs again, in seconds.
+IDLE_POLL_INTERVAL = 1.0
+
+# how many jobs a worker tries to lease before concluding they're all taken.
+LEASE_CANDIDATES = 8
+
+def worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+def fail_abandoned_jobs(ses, now):
+    '''
+    Gives up on jobs whose lease ran out MAX_ATTEMPTS times.
+    '''
+    def give_up():
+        ses.query(GradingJob).filter(GradingJob.state == LEASED)\
+                             .filter(GradingJob.lease_expires < now)\
+                             .filter(GradingJob.attempts >= MAX_ATTEMPTS)\
+                             .update({GradingJob.state: JOB_FAILED,
+                                      GradingJob.message: "Gave up after {} attempts.".format(MAX_ATTEMPTS),
+                                      GradingJob.finished_time: now},
+                                     synchronize_session=False)
+        ses.commit()
+
+    retry_on_lock(ses, give_up)
+
+def lease_job(ses, owner):
+    '''
+    Leases the next available job to owner and returns it, or returns None
+    if there's none. Scene jobs go first, so that submissions already being
+    tested finish before new ones are built.
+    '''
+    now = datetime.datetime.utcnow()
+    fail_abandoned_jobs(ses, now)
+
+    available = or_(GradingJob.state == QUEUED,
+                    and_(GradingJob.state == LEASED, GradingJob.lease_expires < now))
+
+    candidates = ses.query(GradingJob.id).filter(available)\
+                                         .order_by(case([(GradingJob.kind == SCENE_JOB, 0)], else_=1),
+                                                   GradingJob.id)\
+                                         .limit(LEASE_CANDIDATES)\
+                                         .all()
+
+    for (job_id,) in candidates:
+        def lease():
+            # only one worker's update can match, whoever else is trying.
+            leased = ses.query(GradingJob).filter(GradingJob.id == job_id)\
+                                          .filter(available)\
+                                          .update({GradingJob.state: LEASED,
+                                                   GradingJob.lease_owner: owner,
+                                                   GradingJob.lease_expires: now + LEASE_DURATION,
+                                                   GradingJob.attempts: GradingJob.attempts + 1},
+                                                  synchronize_session=False)
+            ses.commit()
+            return leased
+
+        if retry_on_lock(ses, lease) == 1:
+            return ses.query(GradingJob).get(job_id)
+
+    return None
+
+class Heartbeat(threading.Thread):
+    '''
+    Renews the lease of a job for as long as it's being worked on.
+    '''
+    def __init__(self, job_id, owner):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.job_id = job_id
+        self.owner = owner
+        self.stopped = threading.Event()
+
+    def run(self):
+        ses = Session()
+
+        def renew():
+            ses.query(GradingJob).filter(GradingJob.id == self.job_id)\
+                                 .filter(GradingJob.lease_owner == self.owner)\
+                                 .update({GradingJob.lease_expires:
+                                              datetime.datetime.utcnow() + LEASE_DURATION},
+                                         synchronize_session=False)
+            ses.commit()
+
+        try:
+            while not self.stopped.wait(HEARTBEAT_INTERVAL):
+                retry_on_lock(ses, renew)
+        finally:
+            ses.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def finish_job(ses, job, owner, state, values=None, new_rows=None):
+    '''
+    Marks the job finished and adds new_rows, all in one transaction, unless
+    the lease has meanwhile gone to another worker. Returns whether it did.
+    '''
+    updates = {GradingJob.state: state,
+               GradingJob.finished_time: datetime.datetime.utcnow()}
+    updates.update(values or {})
+    new_rows = list(new_rows or [])
+
+    def finish():
+        finished = ses.query(GradingJob).filter(GradingJob.id == job.id)\
+                                        .filter(GradingJob.state == LEASED)\
+                                        .filter(GradingJob.lease_owner == owner)\
+                                        .update(updates, synchronize_session=False)
+        if finished != 1:
+            ses.rollback()
+            return False
+
+        for row in new_rows:
+            # a rolled-back attempt leaves the id it inserted behind.
+            if inspect(row).transient:
+                row.id = None
+            ses.add(row)
+
+        ses.commit()
+        return True
+
+    return retry_on_lock(ses, finish)
+
+def run_build_job(ses, job, owner):
+    assignment = job.assignment
+    binary_path, error = grader.build_submission(job.submission_folder, assignment.template_path)
+
+    if binary_path is None:
+        finish_job(ses, job, owner, JOB_FAILED, {GradingJob.message: error})
+        return
+
+    # queued in the same transaction that marks the build done, quickest
+    # first, as that's the order they're leased in.
+    scenes = [GradingJob(SCENE_JOB, assignment, job.submission_folder, job, t.filepath, t.graded)
+              for t in grader.order_by_history(assignment, assignment.tests())]
+
+    finish_job(ses, job, owner, DONE, {GradingJob.binary_path: binary_path}, scenes)
+
+def run_scene_job(ses, job, owner):
+    build = job.parent
+    run_test = grader.scene_runner(build.binary_path, build.assignment, uuid4().hex, VerdictCache())
+
+    result, log, usage = run_test(TestScene(job.scene_path))
+
+    new_rows = []
+    run = grader.scene_run_of(job.scene_path, result, job.graded, usage)
+    if run is not None:
+        run.job_id = build.id
+        new_rows.append(run)
+
+    finish_job(ses, job, owner, DONE,
+               {GradingJob.result: run.verdict if run is not None else None,
+                GradingJob.message: log},
+               new_rows)
+
+def work(owner=None):
+    '''
+    Leases and runs jobs until interrupted.
+    '''
+    if owner is None:
+        owner = worker_name()
+
+    ses = Session()
+
+    while True:
+        try:
+            job = lease_job(ses, owner)
+        except OperationalError:
+            # still locked after retrying; the worker just looks again later.
+            traceback.print_exc()
+            ses.rollback()
+            job = None
+
+        if job is None:
+            time.sleep(IDLE_POLL_INTERVAL)
+            continue
+
+        print("{} running {}".format(owner, job))
+        sys.stdout.flush()
+
+        heartbeat = Heartbeat(job.id, owner)
+        heartbeat.start()
+        try:
+            if job.kind == BUILD_JOB:
+                run_build_job(ses, job, owner)
+            else:
+                run_scene_job(ses, job, owner)
+        except Exception:
+            traceback.print_exc()
+            ses.rollback()
+
+            # let another attempt have it right away.
+            def release():
+                ses.query(GradingJob).filter(GradingJob.id == job.id)\
+                                     .filter(GradingJob.lease_owner == owner)\
+                                     .update({GradingJob.lease_expires: datetime.datetime.utcnow()},
+                                             synchronize_session=False)
+                ses.commit()
+
+            retry_on_lock(ses, release)
+        finally:
+            heartbeat.stop()
+
+def run_worker():
+    # connections made before the fork belong to the parent.
+    models.engine.dispose()
+    try:
+        work()
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else cpu_count()
+
+    database = models.sqlite_database_path()
+    if database is not None and models.on_network_filesystem(database):
+        print("The database '{}' is on a network filesystem, which SQLite can't be shared over; "
+              "point GRADER_DATABASE_URL at a server database instead.".format(database))
+        sys.exit(1)
+
+    workers = [Process(target=run_worker) for i in range(processes)]
+    for w in workers:
+        w.start()
+
+    try:
+        for w in workers:
+            w.join()
+    except KeyboardInterrupt:
+        for w in workers:
+            w.join()
+
+if __name__ == '__main__':
+    main()
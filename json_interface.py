@@ -2,6 +2,7 @@
 
 import json
 from models import Session, Assignment, AssignmentAssetDirectory
+from references import precompute_references
 import sys
 import json
 import datetime
@@ -34,7 +35,8 @@ def set_or_create_assignment(assignment_dict, session=None):
 
     existing = session.query(Assignment).get(assignment_dict.get('id', -1))
     if existing is None:
-        session.add(Assignment(**assignment_dict))
+        existing = Assignment(**assignment_dict)
+        session.add(existing)
         session.flush() # so that existing.id is defined.
     else:
         del assignment_dict['id']
@@ -45,6 +47,8 @@ def set_or_create_assignment(assignment_dict, session=None):
 
     session.commit()
 
+    return existing
+
 def set_or_create_assignment_asset_directory(parent_assignment, directory_dict, session=None):
     if session is None:
         session = Session()
@@ -65,11 +69,13 @@ def import_assignments(in_filepath):
     s = Session()
     obj = json.loads(open(in_filepath).read())
 
-    for assignment in obj:
-        set_or_create_assignment(assignment, s)
+    assignments = [set_or_create_assignment(assignment, s) for assignment in obj]
 
     s.commit()
 
+    for assignment in assignments:
+        precompute_references(assignment)
+
 def main():
     if len(sys.argv) < 2:
         print "Usage: {} <input JSON filepath>"
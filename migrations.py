@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+'''
+Brings an existing grading database up to the schema in models.py, in
+place. create_all only creates missing tables, so every column or index
+added to an existing table needs a migration here.
+
+The database remembers the last migration applied to it in the
+schema_version table. Each migration is also written so that running it
+again is harmless: DDL can't always be rolled back (SQLite commits before
+it), so an interrupted migration is simply run again.
+
+    python migrations.py
+
+upgrades ./testgrade.db (the same as python models.py). Stop the graders
+first; some migrations rewrite rows graders may be writing.
+'''
+
+import sys
+
+from sqlalchemy import Column, Integer, MetaData, Table, and_, func, inspect, or_, select
+
+from models import (Base,
+                    LatestSubmission,
+                    Student,
+                    Submission,
+                    TestSceneRun,
+                    PASSED,
+                    FAILED)
+
+schema_version = Table("schema_version", MetaData(), Column("version", Integer))
+
+def current_version(conn):
+    schema_version.create(conn, checkfirst=True)
+    version = conn.execute(select([func.max(schema_version.c.version)])).scalar()
+    return version or 0
+
+def set_version(conn, version):
+    conn.execute(schema_version.delete())
+    conn.execute(schema_version.insert().values(version=version))
+
+def add_missing_columns(conn, table_name, column_names):
+    '''
+    Adds the named columns of the table, as declared in models.py, to the
+    database if they aren't there yet.
+    '''
+    table = Base.metadata.tables[table_name]
+    existing = set(c["name"] for c in inspect(conn).get_columns(table_name))
+
+    for name in column_names:
+        if name in existing:
+            continue
+        column_type = table.c[name].type.compile(dialect=conn.dialect)
+        conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table_name, name, column_type))
+
+def create_missing_indexes(conn, table_name, index_names):
+    '''
+    Creates the named indexes of the table, as declared in models.py, that
+    the database doesn't have yet. Only the named ones: the others may be
+    on columns later migrations add.
+    '''
+    table = Base.metadata.tables[table_name]
+    existing = set(i["name"] for i in inspect(conn).get_indexes(table_name))
+
+    for index in table.indexes:
+        if index.name in index_names and index.name not in existing:
+            index.create(conn)
+
+def create_missing_tables(conn):
+    Base.metadata.create_all(conn)
+
+def add_assignment_limits(conn):
+    add_missing_columns(conn, "assignments",
+                        ["cpu_time_limit", "wall_time_limit", "memory_limit",
+                         "reference_tolerance"])
+
+def add_run_verdicts(conn):
+    add_missing_columns(conn, "test_scene_runs", ["verdict"])
+
+    runs = TestSceneRun.__table__
+    conn.execute(runs.update().where(and_(runs.c.verdict == None, runs.c.success == True))
+                              .values(verdict=PASSED))
+    conn.execute(runs.update().where(and_(runs.c.verdict == None, runs.c.success == False))
+                              .values(verdict=FAILED))
+
+def add_grading_jobs(conn):
+    create_missing_tables(conn)
+    add_missing_columns(conn, "test_scene_runs", ["job_id"])
+    add_missing_columns(conn, "grading_jobs", ["graded"])
+
+def rebuild_latest_submissions(conn, student_ids=None):
+    '''
+    Points latest_submissions at the latest submission of every student (or
+    of the given ones) to every assignment.
+    '''
+    latest = LatestSubmission.__table__
+    submissions = Submission.__table__
+
+    query = select([submissions.c.student_id,
+                    submissions.c.assignment_id,
+                    func.max(submissions.c.id)])\
+            .where(and_(submissions.c.student_id != None,
+                        submissions.c.assignment_id != None))\
+            .group_by(submissions.c.student_id, submissions.c.assignment_id)
+
+    if student_ids is None:
+        conn.execute(latest.delete())
+    else:
+        conn.execute(latest.delete().where(latest.c.student_id.in_(student_ids)))
+        query = query.where(submissions.c.student_id.in_(student_ids))
+
+    conn.execute(latest.insert().from_select(["student_id", "assignment_id", "submission_id"], query))
+
+def add_submission_counts(conn):
+    create_missing_tables(conn)
+    add_missing_columns(conn, "submissions",
+                        ["passed_count", "total_count", "graded_passed_count", "graded_total_count"])
+    add_missing_columns(conn, "test_scene_runs", ["graded"])
+
+    runs = TestSceneRun.__table__
+    submissions = Submission.__table__
+
+    def count_runs(*conditions):
+        return select([func.count(runs.c.id)])\
+               .where(and_(runs.c.submission_id == submissions.c.id, *conditions))\
+               .as_scalar()
+
+    # runs recorded before TestSceneRun.graded count as graded, as in
+    # Submission.count_runs.
+    graded = or_(runs.c.graded == None, runs.c.graded == True)
+
+    conn.execute(submissions.update().where(submissions.c.total_count == None)
+                                     .values(total_count=count_runs(),
+                                             passed_count=count_runs(runs.c.success == True),
+                                             graded_total_count=count_runs(graded),
+                                             graded_passed_count=count_runs(graded, runs.c.success == True)))
+
+    rebuild_latest_submissions(conn)
+
+def merge_duplicate_students(conn):
+    '''
+    Gives every uni a single students row, moving the submissions of the
+    others to the oldest one, so that students.uni can be unique.
+    '''
+    students = Student.__table__
+    submissions = Submission.__table__
+    latest = LatestSubmission.__table__
+
+    duplicates = conn.execute(select([students.c.uni, func.min(students.c.id)])
+                              .group_by(students.c.uni)
+                              .having(func.count(students.c.id) > 1)).fetchall()
+
+    for uni, kept_id in duplicates:
+        others = [row[0] for row in conn.execute(select([students.c.id])
+                                                 .where(and_(students.c.uni == uni,
+                                                             students.c.id != kept_id)))]
+
+        conn.execute(submissions.update().where(submissions.c.student_id.in_(others))
+                                         .values(student_id=kept_id))
+        conn.execute(latest.delete().where(latest.c.student_id.in_(others)))
+        conn.execute(students.delete().where(students.c.id.in_(others)))
+
+        rebuild_latest_submissions(conn, [kept_id])
+
+    create_missing_indexes(conn, "students", ["ix_students_uni"])
+
+def add_lookup_indexes(conn):
+    create_missing_indexes(conn, "assignment_asset_directories",
+                           ["ix_assignment_asset_directories_assignment"])
+    create_missing_indexes(conn, "submissions",
+                           ["ix_submissions_student_assignment_time", "ix_submissions_assignment_time"])
+    create_missing_indexes(conn, "test_scene_runs",
+                           ["ix_test_scene_runs_submission_success", "ix_test_scene_runs_job"])
+    create_missing_indexes(conn, "grading_jobs",
+                           ["ix_grading_jobs_state_kind", "ix_grading_jobs_parent"])
+
+def add_run_usage(conn):
+    add_missing_columns(conn, "test_scene_runs",
+                        ["student_wall_time", "student_user_time", "student_system_time",
+                         "student_max_rss", "oracle_wall_time", "oracle_user_time",
+                         "oracle_system_time", "oracle_max_rss"])
+
+def add_stage_times(conn):
+    add_missing_columns(conn, "submissions",
+                        ["prepare_time", "compile_time", "test_time", "persist_time"])
+    add_missing_columns(conn, "test_scene_runs", ["duration"])
+
+def add_submission_archives(conn):
+    create_missing_tables(conn)
+
+def add_run_digests(conn):
+    add_missing_columns(conn, "test_scene_runs", ["scene_digest", "oracle_digest"])
+
+def add_submission_folder_names(conn):
+    add_missing_columns(conn, "submissions", ["folder_name"])
+    create_missing_indexes(conn, "submissions", ["ix_submissions_folder_name"])
+
+def mark_superseded_runs(conn):
+    '''
+    Adds TestSceneRun.superseded, and sets it on every run of a submission
+    that regrade.py ran the same scene again for: all but the latest.
+    '''
+    add_missing_columns(conn, "test_scene_runs", ["superseded"])
+
+    runs = TestSceneRun.__table__
+    conn.execute(runs.update().where(runs.c.superseded == None).values(superseded=False))
+
+    latest = select([func.max(runs.c.id)])\
+             .where(runs.c.submission_id != None)\
+             .group_by(runs.c.submission_id, runs.c.scene_path)
+    conn.execute(runs.update().where(and_(runs.c.submission_id != None,
+                                          ~runs.c.id.in_(latest)))
+                              .values(superseded=True))
+
+def add_reference_layouts(conn):
+    add_missing_columns(conn, "assignments", ["reference_layout"])
+
+# (version, description, migration), in the order they're applied.
+MIGRATIONS = [
+    (1, "Add resource limits and reference tolerance to assignments", add_assignment_limits),
+    (2, "Add verdicts to test scene runs",                              add_run_verdicts),
+    (3, "Add the grading job queue",                                    add_grading_jobs),
+    (4, "Add run counts to submissions and latest submissions",        add_submission_counts),
+    (5, "Make student unis unique",                                     merge_duplicate_students),
+    (6, "Index submissions, test scene runs and grading jobs",         add_lookup_indexes),
+    (7, "Add resource usage to test scene runs",                        add_run_usage),
+    (8, "Add stage times to submissions and durations to runs",        add_stage_times),
+    (9, "Add the index of archived submission folders",                add_submission_archives),
+    (10, "Add scene and oracle digests to test scene runs",            add_run_digests),
+    (11, "Add folder names to submissions",                            add_submission_folder_names),
+    (12, "Mark test scene runs superseded by a regrade",               mark_superseded_runs),
+    (13, "Add reference output layouts to assignments",                add_reference_layouts),
+]
+
+def upgrade(engine, out=None):
+    '''
+    Applies every migration the database hasn't had yet. Returns the number
+    applied.
+    '''
+    if out is None:
+        out = sys.stdout
+
+    applied = 0
+    with engine.connect() as conn:
+        version = current_version(conn)
+
+        for number, description, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+
+            out.write("Migration {}: {}... ".format(number, description))
+            out.flush()
+
+            with conn.begin():
+                migrate(conn)
+                set_version(conn, number)
+
+            out.write("done.\n")
+            applied += 1
+
+    return applied
+
+def main():
+    from models import engine
+
+    if upgrade(engine) == 0:
+        print("The database is up to date.")
+
+if __name__ == '__main__':
+    main()
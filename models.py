@@ -2,69 +2,543 @@
 
 import datetime
 import os
+import random
+import re
+import shutil
+import signal
 import sys
-from subprocess import Popen, PIPE, STDOUT
-
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean, Text
-from sqlalchemy.orm import sessionmaker, relationship
+import tempfile
+import threading
+import time
+from subprocess import PIPE, STDOUT
+
+from sqlalchemy import create_engine, event, func, text, Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Float, Index
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, relationship, backref, object_session
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+
+from sandbox import (LimitedProcess,
+                     OutputTail,
+                     ResourceLimits,
+                     drain_fifo,
+                     release_fifo_reader,
+                     DEFAULT_CPU_TIME_LIMIT,
+                     DEFAULT_WALL_TIME_LIMIT,
+                     DEFAULT_MEMORY_LIMIT,
+                     TIMEOUT,
+                     OOM)
+from cache import file_digest
+from cpu_budget import acquire_tokens
+from scene_index import find_scenes
+
+# resolved once, so that a grader that has changed directories (to build,
+# say) still opens the same database when its pool makes a new connection.
+DATABASE_FILEPATH = os.path.abspath(os.environ.get("GRADER_DATABASE", "./testgrade.db"))
+
+# any SQLAlchemy URL, to use a database other than DATABASE_FILEPATH.
+DATABASE_URL = os.environ.get("GRADER_DATABASE_URL", "sqlite:///{0}".format(DATABASE_FILEPATH))
+
+# how long a connection waits for another's write lock before giving up,
+# in seconds.
+DATABASE_BUSY_TIMEOUT = 30
+
+# how often a write that still found the database locked is tried again,
+# waiting twice as long each time, from DATABASE_RETRY_DELAY seconds.
+DATABASE_LOCK_RETRIES = 5
+DATABASE_RETRY_DELAY = 0.5
+
+DATABASE_POOL_SIZE = 5
+
+# filesystems a SQLite database can't be shared over: their locks aren't
+# reliable, and WAL mode needs memory shared by every connection, which
+# processes on different machines can't have.
+NETWORK_FILESYSTEMS = ["nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs",
+                       "ceph", "glusterfs", "lustre", "fuse.sshfs"]
+
+# stored in TestSceneRun.verdict, along with sandbox.TIMEOUT and sandbox.OOM.
+# SKIPPED scenes weren't run, because the submission failed every scene it
+# was first tried on (see grader.FAIL_FAST_SCENES); they count as failed.
+PASSED = "PASSED"
+FAILED = "FAILED"
+SKIPPED = "SKIPPED"
+
+# how many of an assignment's latest submissions the mean durations of its
+# scenes are taken over (see Assignment.scene_durations).
+DURATION_HISTORY = 200
+
+# how a student's output reaches the oracle: through a FIFO while both run
+# at the same time, through a file in a memory-backed scratch directory, or
+# through a file in an ordinary scratch directory. the first two fall back
+# to the last when they aren't possible.
+FIFO_OUTPUT   = "fifo"
+MEMORY_OUTPUT = "memory"
+DISK_OUTPUT   = "disk"
+
+SCENE_OUTPUT_MODE = os.environ.get("GRADER_OUTPUT_MODE", FIFO_OUTPUT)
+
+MEMORY_SCRATCH_DIRECTORY = "/dev/shm"
+
+STREAM_UNSUPPORTED = "STREAM_UNSUPPORTED"
+
+# the lines an oracle gives its verdict with.
+ORACLE_PASSED = b"Overall success: Passed"
+ORACLE_FAILED = b"Overall success: Failed"
+
+# how long an oracle that has given its verdict may take to exit before it's
+# killed, in seconds.
+ORACLE_EXIT_GRACE = 5
+
+# what an oracle prints when it can't read its input from a FIFO: it tried
+# to seek in it (ESPIPE), or couldn't open it.
+FIFO_ERROR_MARKERS = ["Illegal seek", "ESPIPE", "Failed to open", "Could not open",
+                      "Cannot open", "Unable to open"]
+
+# oracles seen failing on a FIFO, which only get files from then on.
+_unstreamable_oracles = set()
+
+def filesystem_type(path):
+    '''
+    The type of the filesystem path is on, as /proc/mounts has it, or None
+    if that can't be told.
+    '''
+    path = os.path.realpath(path)
+    found, found_type = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces and such in mount points are octal escapes.
+                mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1])
+                inside = path == mount_point or \
+                         path.startswith(mount_point.rstrip("/") + "/")
+                if inside and len(mount_point) >= len(found):
+                    found, found_type = mount_point, fields[2]
+    except (IOError, OSError):
+        return None
+    return found_type
+
+def sqlite_database_path(url=DATABASE_URL):
+    '''
+    The file of the SQLite database at url, or None if it isn't one (or is
+    in memory).
+    '''
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite" or not url.database or url.database == ":memory:":
+        return None
+    return os.path.abspath(url.database)
+
+def on_network_filesystem(path):
+    return filesystem_type(os.path.dirname(path) or ".") in NETWORK_FILESYSTEMS
+
+def create_database_engine(url=DATABASE_URL):
+    '''
+    An engine for url. SQLite databases are put in WAL mode, so readers
+    never block the writer, and connections wait out each other's writes
+    for up to DATABASE_BUSY_TIMEOUT. A SQLite database on one of the
+    NETWORK_FILESYSTEMS is left in its own journal mode, as WAL there would
+    corrupt it or fail to lock; it's only safe for graders on one machine
+    at a time, and job_queue.py refuses it.
+    '''
+    if not url.startswith("sqlite"):
+        return create_engine(url, pool_size=DATABASE_POOL_SIZE)
 
-DATABASE_FILEPATH = "./testgrade.db"
+    path = sqlite_database_path(url)
+    use_wal = path is None or not on_network_filesystem(path)
 
-TEST_EXTENSION = ".xml"
+    # connections are handed between threads by the pool, never shared.
+    engine = create_engine(url, poolclass=QueuePool, pool_size=DATABASE_POOL_SIZE,
+                           connect_args={"timeout": DATABASE_BUSY_TIMEOUT,
+                                         "check_same_thread": False})
 
-engine = create_engine('sqlite:///{0}'.format(DATABASE_FILEPATH))
+    @event.listens_for(engine, "connect")
+    def configure_connection(connection, record):
+        cursor = connection.cursor()
+        if use_wal:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL") # safe in WAL mode
+        cursor.execute("PRAGMA busy_timeout={}".format(int(DATABASE_BUSY_TIMEOUT * 1000)))
+        cursor.close()
+
+    return engine
+
+engine = create_database_engine()
 Session = sessionmaker(bind=engine)
 
+def is_lock_error(e):
+    message = str(e).lower()
+    return "database is locked" in message or "database is busy" in message
+
+def retry_on_lock(ses, write):
+    '''
+    Calls write(), which makes changes in ses and commits them, and returns
+    what it returns. If the database is still locked by other writers after
+    DATABASE_BUSY_TIMEOUT, the changes are rolled back and write() is
+    called again, up to DATABASE_LOCK_RETRIES times.
+    '''
+    delay = DATABASE_RETRY_DELAY
+    for attempt in range(DATABASE_LOCK_RETRIES):
+        try:
+            return write()
+        except OperationalError as e:
+            if not is_lock_error(e) or attempt == DATABASE_LOCK_RETRIES - 1:
+                raise
+            ses.rollback()
+            time.sleep(delay * (1 + random.random()))
+            delay *= 2
+
 Base = declarative_base()
 
+# SceneEntries of asset directories, found ahead of time by a long-running
+# process (see grading_daemon.py) so that the graders it forks don't even
+# check the scene indexes again.
+preloaded_scenes = {}
+
 def bold(s):
     return "\033[1m{0}\033[0m".format(s)
 
+class OracleOutput(OutputTail):
+    '''
+    The output of an oracle, watched for its verdict: result becomes True or
+    False as soon as the oracle says whether the scene passed. From then on,
+    it has ORACLE_EXIT_GRACE seconds to exit.
+    '''
+    def __init__(self, oracle):
+        OutputTail.__init__(self, oracle.process.stdout)
+        self.oracle = oracle
+        self.result = None
+        self.timer = None
+        # the end of the previous chunk, in case a verdict spans two.
+        self.carried = b""
+
+    def received(self, chunk):
+        if self.result is not None:
+            return
+
+        window = self.carried + chunk
+        self.carried = window[-len(ORACLE_PASSED):]
+
+        passed = window.find(ORACLE_PASSED)
+        failed = window.find(ORACLE_FAILED)
+        if passed < 0 and failed < 0:
+            return
+
+        self.result = failed < 0 or 0 <= passed < failed
+
+        self.timer = threading.Timer(ORACLE_EXIT_GRACE, self.oracle.kill)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def finish(self):
+        '''
+        Waits for the oracle to exit, and returns the tail of its output.
+        '''
+        self.oracle.wait()
+        if self.timer is not None:
+            self.timer.cancel()
+        return self.text()
+
 class TestScene(object):
-    def __init__(self, filepath, graded=True, hidden=False):
+    def __init__(self, filepath, graded=True, hidden=False, entry=None):
         self.filepath = filepath
         self.graded = graded
         self.hidden = hidden
 
-    def run(self, submission_binary, oracle_binary, hashstr, output_file=None):
-        if output_file is None:
-            output_file = "./output_" + hashstr + ".bin"
+        # the SceneEntry of the scene file, if it came from a scene index.
+        self.entry = entry
+
+    def digest(self):
+        '''
+        The digest of the scene file, from its scene index when that is
+        still current.
+        '''
+        if self.entry is not None:
+            return self.entry.current_digest()
+        return file_digest(self.filepath)
+
+    def run(self, submission_binary, oracle_binary, hashstr, output_file=None,
+            scratch_dir=None, out=None, limits=None, cache=None,
+            output_mode=None, comparator=None, usage=None, group=None):
+        '''
+        Runs the submission on this scene and grades its output with the
+        oracle. Both processes run inside a private scratch directory
+        (created under scratch_dir), so several scenes may run at once.
+        Diagnostics are written to out, which defaults to stdout.
+
+        Returns True or False for a passed or failed scene, TIMEOUT or OOM if
+        either process was stopped by its ResourceLimits, and None if the
+        result couldn't be determined.
+
+        output_mode is one of FIFO_OUTPUT, MEMORY_OUTPUT or DISK_OUTPUT, and
+        defaults to SCENE_OUTPUT_MODE. Giving an output_file implies
+        DISK_OUTPUT.
+
+        If a VerdictCache is given, a verdict it already holds for the same
+        binary, scene, oracle and comparator is returned without running
+        anything.
 
-        residual_file = "./residual.txt"
+        comparator (a references.ReferenceComparator) may pass the output
+        without running the oracle; it needs an output file, so it implies
+        MEMORY_OUTPUT over FIFO_OUTPUT.
 
-        # run the submission binary to generate the output file
-        result_code = Popen([submission_binary, "-s", self.filepath, "-d", "0", "-o", output_file], stdout=PIPE, stderr=STDOUT).wait()
+        If usage is a dict, the resources used by the student binary and the
+        oracle (see LimitedProcess.usage) are added to it, with keys prefixed
+        by "student_" and "oracle_". It stays empty for a cached verdict.
+
+        Both processes belong to group (a sandbox.ProcessGroup) if one is
+        given; a result of a run whose group was stopped isn't cached.
+        '''
+        if out is None:
+            out = sys.stdout
+
+        if limits is None:
+            limits = ResourceLimits()
+
+        cache_key = None
+        if cache is not None and os.path.isfile(oracle_binary):
+            comparison = comparator.signature() if comparator is not None else None
+            cache_key = cache.key(submission_binary, self.filepath, oracle_binary, limits,
+                                  scene_digest=self.digest(), comparison=comparison)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if output_mode is None:
+            output_mode = SCENE_OUTPUT_MODE
+        if output_file is not None:
+            output_mode = DISK_OUTPUT
+        if comparator is not None and output_mode == FIFO_OUTPUT:
+            output_mode = MEMORY_OUTPUT
+
+        if scratch_dir is None and output_mode == MEMORY_OUTPUT and \
+                os.path.isdir(MEMORY_SCRATCH_DIRECTORY):
+            scratch_dir = MEMORY_SCRATCH_DIRECTORY
+
+        # wait for a CPU token (see cpu_budget.py) before starting anything.
+        with acquire_tokens(1) as tokens:
+            scratch = tempfile.mkdtemp(prefix="scene_{}_".format(hashstr), dir=scratch_dir)
+            try:
+                if output_file is None:
+                    output_file = os.path.join(scratch, "output_" + hashstr + ".bin")
+
+                result = self._run_in(scratch, os.path.abspath(submission_binary),
+                        os.path.abspath(oracle_binary), os.path.abspath(output_file), out, limits,
+                        output_mode, comparator, usage, tokens, group)
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+        if cache_key is not None and not (group is not None and group.stopped):
+            cache.put(cache_key, result)
+
+        return result
+
+    def _record_usage(self, usage, prefix, process):
+        if usage is not None and process.usage is not None:
+            for key, value in process.usage.items():
+                usage[prefix + key] = value
+
+    def _student_args(self, submission_binary, output_file):
+        return [submission_binary, "-s", os.path.abspath(self.filepath), "-d", "0", "-o", output_file]
+
+    def _oracle_args(self, oracle_binary, output_file):
+        return [oracle_binary, "-s", os.path.abspath(self.filepath), "-d", "0", "-i", output_file]
+
+    def _start_student(self, submission_binary, output_file, scratch, limits, tokens=None, group=None):
+        '''
+        Starts the student binary, with only the tail of what it prints kept
+        (in the returned OutputTail), to tell an out-of-memory crash from
+        any other.
+        '''
+        args = self._student_args(submission_binary, output_file)
+        if tokens is not None:
+            args = tokens.pin(args)
+        student = LimitedProcess(args, limits, group, stdout=PIPE, stderr=STDOUT, cwd=scratch)
+        student_output = OutputTail(student.process.stdout)
+        student_output.start()
+        return student, student_output
+
+    def _start_oracle(self, oracle_binary, output_file, scratch, limits, tokens=None, group=None):
+        args = self._oracle_args(oracle_binary, output_file)
+        if tokens is not None:
+            args = tokens.pin(args)
+        # errors are watched too, for FIFO_ERROR_MARKERS.
+        oracle = LimitedProcess(args, limits, group, stdout=PIPE, stderr=STDOUT, cwd=scratch)
+        oracle_output = OracleOutput(oracle)
+        oracle_output.start()
+        return oracle, oracle_output
+
+    def _student_outcome(self, student, student_output, out, limits):
+        '''
+        Returns (True, None) if the student binary exited normally, otherwise
+        (False, result) with the result of the scene, explained on out.
+        '''
+        verdict = student.verdict(student_output.text())
+        if verdict is not None:
+            out.write("Student executable was stopped ({}, limits {}).\n".format(verdict, limits))
+            return False, verdict
+
+        result_code = student.process.returncode
         if result_code != 0:
-            sys.stdout.write(bold(      "[N/A ]\n"))
-            print(("Student executable crashed (exit code {}).").format(result_code, submission_binary))
-            return None
+            out.write(bold(      "[N/A ]\n"))
+            out.write("Student executable crashed (exit code {}).\n".format(result_code))
+            return False, None
 
-        if not os.path.isfile(output_file):
-            sys.stdout.write(bold(      "[N/A ]\n"))
-            print("Failed to generate output file '{}'.".format(output_file))
-            return None
+        return True, None
+
+    def _oracle_outcome(self, oracle, oracle_output, out, limits):
+        '''
+        The verdict the oracle gave, even if it had to be killed after giving
+        it; otherwise TIMEOUT or OOM if it was stopped, or None.
+        '''
+        if oracle_output.result is not None:
+            return oracle_output.result
 
+        verdict = oracle.verdict(oracle_output.text())
+        if verdict is not None:
+            out.write("Oracle was stopped ({}, limits {}).\n".format(verdict, limits))
+            return verdict
+
+        return None
+
+    def _run_in(self, scratch, submission_binary, oracle_binary, output_file, out, limits,
+            output_mode, comparator=None, usage=None, tokens=None, group=None):
         if not os.path.isfile(oracle_binary):
-            sys.stdout.write(bold(      "[N/A ]\n"))
-            print("Failed to open oracle '{}'.".format(oracle_binary))
+            out.write(bold(      "[N/A ]\n"))
+            out.write("Failed to open oracle '{}'.\n".format(oracle_binary))
             return None
 
-        # run the oracle to grade the output file
-        out, err = Popen([oracle_binary, "-s", self.filepath, "-d", "0", "-i", output_file], stdout=PIPE).communicate()
+        if output_mode == FIFO_OUTPUT and oracle_binary not in _unstreamable_oracles:
+            result = self._run_streamed(scratch, submission_binary, oracle_binary, output_file, out, limits,
+                                        usage, tokens, group)
+            if result is not STREAM_UNSUPPORTED:
+                return result
+
+            if os.path.exists(output_file):
+                os.remove(output_file)
+
+            return self._run_sequential(scratch, submission_binary, oracle_binary, output_file, out, limits,
+                                        usage=usage, tokens=tokens, group=group)
 
-        os.remove(output_file)
-        os.remove(residual_file)
+        return self._run_sequential(scratch, submission_binary, oracle_binary, output_file, out, limits,
+                                    comparator, usage, tokens, group)
 
-        if "Overall success: Passed" in out:
+    def _run_sequential(self, scratch, submission_binary, oracle_binary, output_file, out, limits,
+            comparator=None, usage=None, tokens=None, group=None):
+        '''
+        Runs the student binary to completion, then the oracle on the output
+        file it left behind.
+        '''
+        # run the submission binary to generate the output file.
+        student, student_output = self._start_student(submission_binary, output_file, scratch, limits,
+                                                      tokens, group)
+        student.wait()
+        self._record_usage(usage, "student_", student)
+
+        ok, result = self._student_outcome(student, student_output, out, limits)
+        if not ok:
+            return result
+
+        if not os.path.isfile(output_file):
+            out.write(bold(      "[N/A ]\n"))
+            out.write("Failed to generate output file '{}'.\n".format(output_file))
+            return None
+
+        if comparator is not None and comparator(output_file) is True:
+            os.remove(output_file)
             return True
-        elif "Overall success: Failed" in out:
+
+        # run the oracle to grade the output file; it leaves its residual.txt
+        # in the scratch directory, which is removed along with the output.
+        oracle, oracle_output = self._start_oracle(oracle_binary, output_file, scratch, limits,
+                                                   tokens, group)
+        oracle_output.finish()
+        self._record_usage(usage, "oracle_", oracle)
+
+        if os.path.isfile(output_file):
+            os.remove(output_file)
+
+        return self._oracle_outcome(oracle, oracle_output, out, limits)
+
+    def _run_streamed(self, scratch, submission_binary, oracle_binary, output_file, out, limits,
+            usage=None, tokens=None, group=None):
+        '''
+        Runs the student binary and the oracle at the same time, passing the
+        output through a FIFO instead of the filesystem. Returns
+        STREAM_UNSUPPORTED if the FIFO itself got in the way, in which case
+        the scene should be run again with an output file: it couldn't be
+        made, the oracle closed it on the student without a verdict, or the
+        oracle failed to read it (see FIFO_ERROR_MARKERS), which also keeps
+        that oracle off FIFOs from then on. Any other result stands.
+        '''
+        try:
+            os.mkfifo(output_file)
+        except OSError:
+            return STREAM_UNSUPPORTED
+
+        # the oracle's output is read by its own thread, which finishes once
+        # the oracle closes its stdout.
+        oracle, reader = self._start_oracle(oracle_binary, output_file, scratch, limits, tokens, group)
+
+        student, student_output = self._start_student(submission_binary, output_file, scratch, limits,
+                                                      tokens, group)
+
+        while student.poll() is None and reader.is_alive():
+            reader.join(0.1)
+
+        if not reader.is_alive():
+            # the oracle is done early; keep the student from blocking on a
+            # FIFO that nobody reads anymore.
+            drain_fifo(output_file, student)
+        student.wait()
+        self._record_usage(usage, "student_", student)
+
+        if student.process.returncode == -signal.SIGPIPE:
+            # the oracle stopped reading before the student was done writing.
+            reader.finish()
+            if self._fifo_failed(oracle_binary, reader) or reader.result is None:
+                return STREAM_UNSUPPORTED
+            self._record_usage(usage, "oracle_", oracle)
+            return reader.result
+
+        ok, result = self._student_outcome(student, student_output, out, limits)
+        if not ok:
+            oracle.kill()
+            reader.finish()
+            return result
+
+        # give the oracle its end of file, even if the student never opened
+        # the output.
+        release_fifo_reader(output_file, reader)
+        reader.finish()
+        self._record_usage(usage, "oracle_", oracle)
+
+        result = self._oracle_outcome(oracle, reader, out, limits)
+        if result is None and self._fifo_failed(oracle_binary, reader):
+            return STREAM_UNSUPPORTED
+
+        return result
+
+    def _fifo_failed(self, oracle_binary, reader):
+        '''
+        Whether the oracle's output shows it couldn't read from the FIFO, in
+        which case it's kept off FIFOs from then on.
+        '''
+        if reader.result is not None:
             return False
-        else:
-            return None
+
+        text = reader.text()
+        if not any(marker in text for marker in FIFO_ERROR_MARKERS):
+            return False
+
+        _unstreamable_oracles.add(oracle_binary)
+        return True
 
 class Student(Base):
     __tablename__ = "students"
+    __table_args__ = (Index("ix_students_uni", "uni", unique=True),)
 
     id  = Column(Integer, primary_key=True)
     uni = Column(String)
@@ -77,12 +551,21 @@ class Student(Base):
     def best_submission_on(self, assignment):
         return self.submissions.outerjoin(TestSceneRun)\
                         .filter(TestSceneRun.success == True)\
+                        .filter(TestSceneRun.superseded == False)\
                         .all()
 
+    def latest_submission_on(self, assignment):
+        latest = object_session(self).query(LatestSubmission).get((self.id, assignment.id))
+        if latest is not None:
+            return latest.submission
+
+        # submitted before latest_submissions was kept, or never.
+        return self.submissions.filter(Submission.assignment == assignment)\
+                               .order_by(Submission.submission_time.desc())\
+                               .first()
+
     def grade_on(self, assignment):
-        submission =  self.submissions.filter(Submission.assignment == assignment)\
-                                      .order_by(Submission.submission_time.desc())\
-                                      .first()
+        submission = self.latest_submission_on(assignment)
         if submission is None:
             return 0.0
         else:
@@ -107,6 +590,20 @@ class Assignment(Base):
     start_date = Column(DateTime)
     due_date = Column(DateTime)
 
+    # per-scene limits on the student binary and the oracle, in seconds and
+    # megabytes. None falls back to the defaults in sandbox.py.
+    cpu_time_limit  = Column(Integer)
+    wall_time_limit = Column(Integer)
+    memory_limit    = Column(Integer)
+
+    # if set, each scene's oracle output is precomputed (see references.py)
+    # and student outputs that match it pass without the oracle: those
+    # within this tolerance of it if the assignment declares the layout of
+    # its outputs as a numpy dtype of one record (say "i4,f8,f8"), otherwise
+    # only identical ones.
+    reference_tolerance = Column(Float)
+    reference_layout    = Column(String)
+
     submissions = relationship("Submission", backref='assignment')
     directories = relationship("AssignmentAssetDirectory", backref='assignment')
 
@@ -115,9 +612,9 @@ class Assignment(Base):
 
     def set_dict(self, theme=None, milestone=None, deliverable=None,
             oracle_path=None, template_path=None, start_date=None,
-            due_date=None, directories=None):
-        self.tests = None
-
+            due_date=None, directories=None, cpu_time_limit=None,
+            wall_time_limit=None, memory_limit=None, reference_tolerance=None,
+            reference_layout=None):
         self.theme = theme
         self.milestone = milestone
         self.deliverable = deliverable
@@ -125,6 +622,11 @@ class Assignment(Base):
         self.template_path = template_path
         self.start_date = start_date
         self.due_date = due_date
+        self.cpu_time_limit = cpu_time_limit
+        self.wall_time_limit = wall_time_limit
+        self.memory_limit = memory_limit
+        self.reference_tolerance = reference_tolerance
+        self.reference_layout = reference_layout
 
         if directories is not None:
             pass
@@ -139,6 +641,11 @@ class Assignment(Base):
             "template_path":self.template_path,
             "start_date":self.start_date,
             "due_date":self.due_date,
+            "cpu_time_limit":self.cpu_time_limit,
+            "wall_time_limit":self.wall_time_limit,
+            "memory_limit":self.memory_limit,
+            "reference_tolerance":self.reference_tolerance,
+            "reference_layout":self.reference_layout,
             "asset_directories":[d.__json__() for d in self.directories]
         }
 
@@ -168,6 +675,18 @@ class Assignment(Base):
                                         .all()
 
 
+    def scene_limits(self):
+        '''
+        The ResourceLimits every process of a test scene is run under.
+        '''
+        def or_default(value, default):
+            return default if value is None else value
+
+        return ResourceLimits(
+                cpu_time=or_default(self.cpu_time_limit, DEFAULT_CPU_TIME_LIMIT),
+                wall_time=or_default(self.wall_time_limit, DEFAULT_WALL_TIME_LIMIT),
+                memory=or_default(self.memory_limit, DEFAULT_MEMORY_LIMIT))
+
     def is_creative_scene(self):
         return self.deliverable == CREATIVE_SCENE
 
@@ -190,11 +709,31 @@ class Assignment(Base):
 
         return tests
 
+    def scene_durations(self):
+        '''
+        The mean duration of each scene, by path, over the runs of the
+        DURATION_HISTORY latest submissions to the assignment that timed it.
+        '''
+        ses = object_session(self)
+        if ses is None:
+            return {}
+
+        latest = ses.query(Submission.id).filter(Submission.assignment_id == self.id)\
+                                         .order_by(Submission.submission_time.desc())\
+                                         .limit(DURATION_HISTORY)
+
+        return dict(ses.query(TestSceneRun.scene_path, func.avg(TestSceneRun.duration))
+                       .filter(TestSceneRun.submission_id.in_(latest))
+                       .filter(TestSceneRun.superseded == False)
+                       .filter(TestSceneRun.duration != None)
+                       .group_by(TestSceneRun.scene_path))
+
 class AssignmentAssetDirectory(Base):
     '''
     A directory of test assets (scene files) associated with an assignment.
     '''
     __tablename__ = "assignment_asset_directories"
+    __table_args__ = (Index("ix_assignment_asset_directories_assignment", "assignment_id"),)
 
     id  = Column(Integer, primary_key=True)
 
@@ -234,23 +773,22 @@ class AssignmentAssetDirectory(Base):
         Returns an array of TestScenes, one for each scene file in this
         directory (and all its subdirectories).
         '''
-        tests = []
-
-        for root, dirnames, filenames in os.walk(self.path):
-            for filename in filenames:
-                if (os.path.splitext(filename)[1] == TEST_EXTENSION):
-                    tests.append(
-                        TestScene(os.path.join(root, filename),
-                             graded=self.graded,
-                             hidden=self.hidden))
+        scenes = preloaded_scenes.get(self.path)
+        if scenes is None:
+            scenes = find_scenes(self.path)
 
-        return tests
+        return [TestScene(s.path, graded=self.graded, hidden=self.hidden, entry=s)
+                for s in scenes]
 
 class Submission(Base):
     '''
     Metadata associated with a student's submitted assignment.
     '''
     __tablename__ = "submissions"
+    __table_args__ = (Index("ix_submissions_student_assignment_time",
+                            "student_id", "assignment_id", "submission_time"),
+                      Index("ix_submissions_assignment_time", "assignment_id", "submission_time"),
+                      Index("ix_submissions_folder_name", "folder_name"))
 
     id  = Column(Integer, primary_key=True)
     assignment_id  = Column(Integer, ForeignKey('assignments.id'))
@@ -266,6 +804,26 @@ class Submission(Base):
 
     submission_time = Column(DateTime, default=datetime.datetime.utcnow)
 
+    # counts of test_runs, written once when the submission is made (see
+    # count_runs), so that grading it doesn't load its runs. None on
+    # submissions made before they existed.
+    passed_count        = Column(Integer)
+    total_count         = Column(Integer)
+    graded_passed_count = Column(Integer)
+    graded_total_count  = Column(Integer)
+
+    # seconds spent copying the submission into its folder, building it,
+    # running its tests and recording it in the database.
+    prepare_time = Column(Float)
+    compile_time = Column(Float)
+    test_time    = Column(Float)
+    persist_time = Column(Float)
+
+    # the name of the folder it was graded in, under SUBMISSIONS_DIRECTORY,
+    # by which storage.py pack finds the submission of a folder left there.
+    # None on submissions made before it was recorded.
+    folder_name = Column(String)
+
     test_runs = relationship("TestSceneRun", backref='submission')
 
     def __init__(self, assignment=None, student=None, difficulty_rating=None,
@@ -288,20 +846,83 @@ class Submission(Base):
         self.days_spent_on = days_spent_on
 
     def __str__(self):
-        return "<Submission by {}: {} / {}>".format(self.student.uni,
-                len(self.passed_runs()), len(self.test_runs))
+        passed, total = self.counts()
+        return "<Submission by {}: {} / {}>".format(self.student.uni, passed, total)
+
+    def current_runs(self):
+        '''
+        The test_runs that aren't superseded by a regrade.
+        '''
+        return [tr for tr in self.test_runs if not tr.superseded]
 
     def passed_runs(self):
-        return filter(lambda tr: tr.success, self.test_runs)
+        return filter(lambda tr: tr.success, self.current_runs())
+
+    def count_runs(self, runs):
+        '''
+        Stores the counts of runs, which are to be this submission's test_runs.
+        '''
+        graded = [r for r in runs if r.graded is not False]
+
+        self.passed_count = len([r for r in runs if r.success])
+        self.total_count = len(runs)
+        self.graded_passed_count = len([r for r in graded if r.success])
+        self.graded_total_count = len(graded)
+
+    def counts(self):
+        '''
+        The number of passed and total test runs.
+        '''
+        if self.total_count is None:
+            return len(self.passed_runs()), len(self.current_runs())
+        return self.passed_count, self.total_count
 
     def grade(self):
-        if len(self.test_runs) == 0:
+        passed, total = self.counts()
+        if total == 0:
             return None
 
-        return len(self.passed_runs()) / float(len(self.test_runs))
+        return passed / float(total)
+
+class LatestSubmission(Base):
+    '''
+    The latest submission of each student to each assignment, kept up to
+    date by grader.perform_submission.
+    '''
+    __tablename__ = "latest_submissions"
+
+    student_id     = Column(Integer, ForeignKey('students.id'), primary_key=True)
+    assignment_id  = Column(Integer, ForeignKey('assignments.id'), primary_key=True)
+    submission_id  = Column(Integer, ForeignKey('submissions.id'))
+
+    submission = relationship("Submission")
+
+    def __init__(self, submission):
+        self.student_id = submission.student_id
+        self.assignment_id = submission.assignment_id
+        self.submission_id = submission.id
+
+    @staticmethod
+    def record(ses, submission):
+        '''
+        Makes the submission its student's latest to its assignment, unless
+        a later one (with a higher id) already is, in a single statement, so
+        that concurrent submissions always leave the latest one behind.
+        '''
+        ses.execute(text(
+            "INSERT INTO latest_submissions (student_id, assignment_id, submission_id) "
+            "VALUES (:student_id, :assignment_id, :submission_id) "
+            "ON CONFLICT (student_id, assignment_id) DO UPDATE SET submission_id = "
+            "CASE WHEN excluded.submission_id > latest_submissions.submission_id "
+            "THEN excluded.submission_id ELSE latest_submissions.submission_id END"),
+            {"student_id": submission.student_id,
+             "assignment_id": submission.assignment_id,
+             "submission_id": submission.id})
 
 class TestSceneRun(Base):
     __tablename__ = "test_scene_runs"
+    __table_args__ = (Index("ix_test_scene_runs_submission_success", "submission_id", "success"),
+                      Index("ix_test_scene_runs_job", "job_id"))
 
     id            = Column(Integer, primary_key=True)
     submission_id = Column(Integer, ForeignKey("submissions.id"))
@@ -312,13 +933,163 @@ class TestSceneRun(Base):
 
     success       = Column(Boolean)
 
-    def __init__(self, path="", success=None):
+    # PASSED, FAILED, TIMEOUT or OOM.
+    verdict       = Column(String)
+
+    # whether the scene counts toward the grade, as its asset directory said
+    # at the time.
+    graded        = Column(Boolean)
+
+    # the build job whose scene jobs produced this run, if it was graded by
+    # job_queue.py workers. such runs get their submission_id once the
+    # student submits.
+    job_id        = Column(Integer, ForeignKey("grading_jobs.id"))
+
+    # resources used by the student binary and the oracle: seconds of wall
+    # clock, user and system CPU time, and peak RSS in kilobytes. None if
+    # the process didn't run (a cached verdict, or no oracle needed).
+    student_wall_time   = Column(Float)
+    student_user_time   = Column(Float)
+    student_system_time = Column(Float)
+    student_max_rss     = Column(Integer)
+    oracle_wall_time    = Column(Float)
+    oracle_user_time    = Column(Float)
+    oracle_system_time  = Column(Float)
+    oracle_max_rss      = Column(Integer)
+
+    # seconds from starting the scene to having its result, cache lookups
+    # and comparisons included.
+    duration            = Column(Float)
+
+    # digests of the scene file and the oracle the run was graded with, so
+    # that regrade.py knows which runs a new oracle or scene makes stale.
+    # None on runs made before they were recorded.
+    scene_digest        = Column(String)
+    oracle_digest       = Column(String)
+
+    # whether regrade.py has since run the scene again for the submission.
+    # only the runs that aren't superseded count; the others are kept for
+    # the record.
+    superseded          = Column(Boolean, default=False)
+
+    def __init__(self, path="", success=None, verdict=None, graded=True, usage=None):
+        if verdict is None and success is not None:
+            verdict = PASSED if success else FAILED
+
         self.scene_path = path
         self.success = success
+        self.verdict = verdict
+        self.graded = graded
+        self.superseded = False
         self.run_time = datetime.datetime.now()
 
+        for key, value in (usage or {}).items():
+            setattr(self, key, value)
+
+class SubmissionArchive(Base):
+    '''
+    A submission folder packed into storage.py's blob store once graded. The
+    manifest (relative to STORAGE_DIRECTORY) lists its files and their
+    blobs. Folders packed before submissions recorded their folder_name
+    have no submission.
+    '''
+    __tablename__ = "submission_archives"
+    __table_args__ = (Index("ix_submission_archives_submission", "submission_id", unique=True),)
+
+    id            = Column(Integer, primary_key=True)
+    submission_id = Column(Integer, ForeignKey("submissions.id"))
+
+    folder_name   = Column(String)
+    manifest_path = Column(String)
+
+    # the files of the folder and their bytes, and the bytes the folder
+    # added to the store: its manifest and blobs no folder had before.
+    file_count    = Column(Integer)
+    folder_bytes  = Column(Integer)
+    stored_bytes  = Column(Integer)
+
+    archived_time = Column(DateTime, default=datetime.datetime.utcnow)
+
+    submission = relationship("Submission")
+
+    def __init__(self, submission=None, folder_name=None, manifest_path=None,
+            file_count=0, folder_bytes=0, stored_bytes=0):
+        self.submission_id = submission.id if submission is not None else None
+        self.folder_name = folder_name
+        self.manifest_path = manifest_path
+        self.file_count = file_count
+        self.folder_bytes = folder_bytes
+        self.stored_bytes = stored_bytes
+        self.archived_time = datetime.datetime.utcnow()
+
+BUILD_JOB = "build"
+SCENE_JOB = "scene"
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE   = "done"
+JOB_FAILED = "failed"
+
+class GradingJob(Base):
+    '''
+    A unit of grading work for job_queue.py workers: building a submission
+    folder, or running one scene against a build. Workers lease jobs, and a
+    job whose lease runs out is handed to another worker.
+    '''
+    __tablename__ = "grading_jobs"
+    __table_args__ = (Index("ix_grading_jobs_state_kind", "state", "kind"),
+                      Index("ix_grading_jobs_parent", "parent_id"))
+
+    id            = Column(Integer, primary_key=True)
+    kind          = Column(String)
+    parent_id     = Column(Integer, ForeignKey("grading_jobs.id"))
+    assignment_id = Column(Integer, ForeignKey("assignments.id"))
+
+    submission_folder = Column(String)
+    binary_path       = Column(String) # of the build, once it's done
+    scene_path        = Column(String)
+    graded            = Column(Boolean) # whether the scene counts
+
+    state         = Column(String, default=QUEUED)
+    lease_owner   = Column(String)
+    lease_expires = Column(DateTime)
+    attempts      = Column(Integer, default=0)
+
+    # the verdict of a scene job, and whatever a job had to say about how
+    # it went.
+    result        = Column(String)
+    message       = Column(Text)
+
+    created_time  = Column(DateTime, default=datetime.datetime.utcnow)
+    finished_time = Column(DateTime)
+
+    scenes = relationship("GradingJob", backref=backref("parent", remote_side=[id]),
+                          order_by="GradingJob.id")
+    assignment = relationship("Assignment")
+
+    def __init__(self, kind=BUILD_JOB, assignment=None, submission_folder=None,
+            parent=None, scene_path=None, graded=True):
+        self.kind = kind
+        self.assignment_id = assignment.id if assignment is not None else None
+        self.submission_folder = submission_folder
+        self.parent_id = parent.id if parent is not None else None
+        self.scene_path = scene_path
+        self.graded = graded
+        self.state = QUEUED
+        self.attempts = 0
+        self.created_time = datetime.datetime.utcnow()
+
+    def __str__(self):
+        return "<GradingJob {} {} {}>".format(self.id, self.kind, self.state)
+
 def main():
+    '''
+    Creates the database, or brings an existing one up to date.
+    '''
+    from migrations import upgrade
+
     Base.metadata.create_all(engine)
+    upgrade(engine)
 
 if __name__ == '__main__':
     main()
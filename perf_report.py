@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+'''
+How long grading takes, from the history recorded in test_scene_runs and
+submissions: the slowest scenes of each assignment, percentiles of scene
+and submission latency, submissions per hour around the due date, and the
+time spent in each stage of grading a submission.
+
+    python perf_report.py [-j] [-a <assignment name>] [-n <number of scenes>]
+
+prints the report as tables, or as JSON with -j. Everything is computed
+with aggregate queries; percentiles take a count and one ordered lookup
+each.
+
+Submission times are stored in UTC and due dates in local time, as they
+were entered; due dates are converted to UTC before they're compared, and
+hours are given in UTC.
+'''
+
+import datetime
+import json
+import math
+import sys
+import time
+
+from sqlalchemy import func
+
+from models import Assignment, Session, Submission, TestSceneRun
+
+PERCENTILES = [0.5, 0.95, 0.99]
+
+# scenes listed per assignment by default.
+SLOWEST_SCENES = 10
+
+# how far before the due date submissions per hour are counted, in hours.
+DEADLINE_WINDOW = 48
+
+STAGES = ["prepare_time", "compile_time", "test_time", "persist_time"]
+
+def submission_latency():
+    '''
+    The seconds spent grading and recording a submission, not counting the
+    time the student took to answer.
+    '''
+    return sum(func.coalesce(getattr(Submission, stage), 0.0) for stage in STAGES)
+
+def percentiles(query):
+    '''
+    The PERCENTILES of the single, non-null column selected by query.
+    '''
+    column = query.column_descriptions[0]["expr"]
+    query = query.filter(column != None)
+
+    count = query.count()
+    values = {}
+    for p in PERCENTILES:
+        if count == 0:
+            values[p] = None
+            continue
+        offset = max(0, int(math.ceil(p * count)) - 1)
+        values[p] = query.order_by(column).offset(offset).limit(1).scalar()
+    return values
+
+def scene_latency(ses, assignment):
+    return percentiles(ses.query(TestSceneRun.duration)
+                          .join(Submission, TestSceneRun.submission_id == Submission.id)
+                          .filter(Submission.assignment_id == assignment.id)
+                          .filter(TestSceneRun.superseded == False))
+
+def submission_latencies(ses, assignment):
+    latency = submission_latency()
+    return percentiles(ses.query(latency)
+                          .filter(Submission.assignment_id == assignment.id)
+                          .filter(Submission.test_time != None))
+
+def slowest_scenes(ses, assignment, limit=SLOWEST_SCENES):
+    average = func.avg(TestSceneRun.duration)
+    query = ses.query(TestSceneRun.scene_path,
+                      func.count(TestSceneRun.id),
+                      average,
+                      func.max(TestSceneRun.duration),
+                      func.avg(TestSceneRun.student_user_time + TestSceneRun.student_system_time),
+                      func.avg(TestSceneRun.oracle_user_time + TestSceneRun.oracle_system_time),
+                      func.max(TestSceneRun.student_max_rss))\
+               .join(Submission, TestSceneRun.submission_id == Submission.id)\
+               .filter(Submission.assignment_id == assignment.id)\
+               .filter(TestSceneRun.superseded == False)\
+               .filter(TestSceneRun.duration != None)\
+               .group_by(TestSceneRun.scene_path)\
+               .order_by(average.desc())\
+               .limit(limit)
+
+    return [{"scene": path,
+             "runs": runs,
+             "mean_duration": mean,
+             "max_duration": longest,
+             "mean_student_cpu": student_cpu,
+             "mean_oracle_cpu": oracle_cpu,
+             "max_student_rss_kb": rss}
+            for path, runs, mean, longest, student_cpu, oracle_cpu, rss in query]
+
+def local_to_utc(when):
+    '''
+    The UTC time of a naive local time.
+    '''
+    return datetime.datetime.utcfromtimestamp(time.mktime(when.timetuple()))
+
+def throughput_by_hour(ses, assignment):
+    '''
+    Submissions per hour (in UTC) from DEADLINE_WINDOW hours before the due
+    date to the end of the late window, with the mean grading latency of
+    each hour. Hours are counted here rather than by the database, which
+    has no portable way to truncate a time to the hour.
+    '''
+    if assignment.due_date is None:
+        return []
+
+    due = local_to_utc(assignment.due_date)
+    start = due - datetime.timedelta(hours=DEADLINE_WINDOW)
+    end = due + Assignment.get_late_window()
+
+    query = ses.query(Submission.submission_time, submission_latency())\
+               .filter(Submission.assignment_id == assignment.id)\
+               .filter(Submission.submission_time >= start)\
+               .filter(Submission.submission_time < end)\
+               .yield_per(1000)
+
+    hours = {} # hour -> [submissions, latency total, latencies]
+    for submitted, latency in query:
+        hour = submitted.replace(minute=0, second=0, microsecond=0)
+        counts = hours.setdefault(hour, [0, 0.0, 0])
+        counts[0] += 1
+        if latency is not None:
+            counts[1] += latency
+            counts[2] += 1
+
+    return [{"hour": hour.strftime("%Y-%m-%d %H:00"),
+             "hours_to_due": (due - hour).total_seconds() / 3600.0,
+             "submissions": count,
+             "mean_latency": total / timed if timed else None}
+            for hour, (count, total, timed) in sorted(hours.items())]
+
+def stage_times(ses, assignment):
+    columns = [getattr(Submission, stage) for stage in STAGES]
+    row = ses.query(func.count(Submission.id),
+                    *([func.avg(c) for c in columns] + [func.sum(c) for c in columns]))\
+             .filter(Submission.assignment_id == assignment.id)\
+             .filter(Submission.test_time != None)\
+             .one()
+
+    count = row[0]
+    means = row[1:1 + len(STAGES)]
+    totals = row[1 + len(STAGES):]
+    return {"submissions": count,
+            "mean": dict(zip(STAGES, means)),
+            "total": dict(zip(STAGES, totals))}
+
+def report(ses, assignments, scenes=SLOWEST_SCENES):
+    return [{"assignment": a.name(),
+             "scene_latency": scene_latency(ses, a),
+             "submission_latency": submission_latencies(ses, a),
+             "slowest_scenes": slowest_scenes(ses, a, scenes),
+             "throughput": throughput_by_hour(ses, a),
+             "stages": stage_times(ses, a)}
+            for a in assignments]
+
+def seconds(value):
+    return "-" if value is None else "{:.2f}s".format(value)
+
+def print_table(headers, rows):
+    widths = [max(len(str(h)), *[len(str(r[i])) for r in rows]) if rows else len(str(h))
+              for i, h in enumerate(headers)]
+    line = "  ".join("{{:<{}}}".format(w) for w in widths)
+
+    print(line.format(*headers))
+    print(line.format(*["-" * w for w in widths]))
+    for row in rows:
+        print(line.format(*row))
+    print("")
+
+def print_report(assignment_reports):
+    for r in assignment_reports:
+        print("=" * 72)
+        print("  {}".format(r["assignment"]))
+        print("=" * 72)
+        print("")
+
+        print_table(["latency"] + ["p{:g}".format(p * 100) for p in PERCENTILES],
+                    [["scene"] + [seconds(r["scene_latency"][p]) for p in PERCENTILES],
+                     ["submission"] + [seconds(r["submission_latency"][p]) for p in PERCENTILES]])
+
+        stages = r["stages"]
+        print_table(["stage", "mean", "total"],
+                    [[stage, seconds(stages["mean"][stage]), seconds(stages["total"][stage])]
+                     for stage in STAGES])
+
+        print_table(["slowest scene", "runs", "mean", "max", "student cpu", "oracle cpu", "max rss"],
+                    [[s["scene"], s["runs"], seconds(s["mean_duration"]), seconds(s["max_duration"]),
+                      seconds(s["mean_student_cpu"]), seconds(s["mean_oracle_cpu"]),
+                      "-" if s["max_student_rss_kb"] is None else "{}MB".format(s["max_student_rss_kb"] // 1024)]
+                     for s in r["slowest_scenes"]])
+
+        if r["throughput"]:
+            print_table(["hour", "hours to due", "submissions", "mean latency"],
+                        [[t["hour"], "{:.0f}".format(t["hours_to_due"]), t["submissions"],
+                          seconds(t["mean_latency"])]
+                         for t in r["throughput"]])
+
+def usage():
+    print("Usage: {} [-j] [-a <assignment name>] [-n <number of scenes>]".format(sys.argv[0]))
+    sys.exit(0)
+
+def main():
+    args = sys.argv[1:]
+    as_json = False
+    assignment_name = None
+    scenes = SLOWEST_SCENES
+
+    while args:
+        option = args.pop(0)
+        if option == '-j':
+            as_json = True
+        elif option == '-a' and args:
+            assignment_name = args.pop(0)
+        elif option == '-n' and args:
+            scenes = int(args.pop(0))
+        else:
+            usage()
+
+    ses = Session()
+    assignments = ses.query(Assignment).order_by(Assignment.theme,
+                                                 Assignment.milestone,
+                                                 Assignment.deliverable).all()
+    if assignment_name is not None:
+        assignments = [a for a in assignments if a.name() == assignment_name]
+        if not assignments:
+            print("No assignment named '{}'.".format(assignment_name))
+            sys.exit(1)
+
+    assignment_reports = report(ses, assignments, scenes)
+
+    if as_json:
+        for r in assignment_reports:
+            for key in ("scene_latency", "submission_latency"):
+                r[key] = dict(("p{:g}".format(p * 100), v) for p, v in r[key].items())
+        json.dump(assignment_reports, sys.stdout, indent=2)
+        print("")
+    else:
+        print_report(assignment_reports)
+
+if __name__ == '__main__':
+    main()
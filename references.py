@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+'''
+Reference outputs of the oracle, simulated once per scene and stored next to
+the scene file, so that grading a student's output can be a comparison
+instead of another simulation.
+
+An output passes if it's byte for byte the reference. Only an assignment
+that declares the layout of its outputs (Assignment.reference_layout, a
+numpy dtype of one record, such as "i4,f8,f8") has its doubles compared
+within reference_tolerance, and the rest of each record exactly: read as
+doubles, integers and flags of other layouts would be denormals that any
+tolerance lets through. The comparison can only ever pass a scene;
+anything else is still graded by the oracle, which has the final word.
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+from subprocess import STDOUT
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from cache import file_digest
+from sandbox import LimitedProcess
+
+REFERENCE_EXTENSION = ".reference.bin"
+METADATA_EXTENSION  = ".reference.json"
+
+# number of records (or bytes, without a layout) compared at a time, so
+# memory use doesn't depend on the size of the outputs.
+COMPARISON_CHUNK = 1 << 20
+
+def reference_path(scene_path):
+    return scene_path + REFERENCE_EXTENSION
+
+def metadata_path(scene_path):
+    return scene_path + METADATA_EXTENSION
+
+def _metadata(scene_path, oracle_path, scene_digest=None):
+    return {"scene": scene_digest or file_digest(scene_path), "oracle": file_digest(oracle_path)}
+
+def has_reference(scene_path, oracle_path, scene_digest=None):
+    '''
+    Whether the scene has a reference output made by this exact oracle from
+    this exact scene file. scene_digest, if given, is trusted as the digest
+    of the scene file.
+    '''
+    if not os.path.isfile(reference_path(scene_path)):
+        return False
+
+    try:
+        with open(metadata_path(scene_path)) as f:
+            metadata = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+
+    return metadata == _metadata(scene_path, oracle_path, scene_digest)
+
+def precompute_reference(scene, oracle_path, limits=None):
+    '''
+    Runs the oracle on the scene and stores its output as the scene's
+    reference. Returns whether that succeeded.
+    '''
+    scene_path = os.path.abspath(scene.filepath)
+    scratch = tempfile.mkdtemp(prefix="reference_")
+    try:
+        output_file = os.path.join(scratch, "reference.bin")
+        with open(os.devnull, 'wb') as devnull:
+            oracle = LimitedProcess([os.path.abspath(oracle_path), "-s", scene_path, "-d", "0", "-o", output_file],
+                                    limits, stdout=devnull, stderr=STDOUT, cwd=scratch)
+            if oracle.wait() != 0 or not os.path.isfile(output_file):
+                return False
+
+        # copy next to the scene, then rename, so no grader sees half a file.
+        staged = reference_path(scene_path) + ".tmp"
+        shutil.copyfile(output_file, staged)
+        os.rename(staged, reference_path(scene_path))
+
+        with open(metadata_path(scene_path), 'w') as f:
+            json.dump(_metadata(scene_path, oracle_path), f)
+
+        return True
+    except (IOError, OSError):
+        return False
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def precompute_references(assignment, out=None):
+    '''
+    Makes sure every test scene of the assignment has an up-to-date reference
+    output. Does nothing for assignments without a reference_tolerance.
+    '''
+    if out is None:
+        out = sys.stdout
+
+    if assignment.reference_tolerance is None or assignment.oracle_path is None:
+        return
+
+    if not os.path.isfile(assignment.oracle_path):
+        out.write("Can't precompute references of {}: no oracle at '{}'.\n".format(
+            assignment.name(), assignment.oracle_path))
+        return
+
+    limits = assignment.scene_limits()
+    for scene in assignment.tests():
+        if has_reference(scene.filepath, assignment.oracle_path, scene.digest()):
+            continue
+
+        out.write("Precomputing reference output of '{}'... ".format(scene.filepath))
+        out.flush()
+        if precompute_reference(scene, assignment.oracle_path, limits):
+            out.write("done.\n")
+        else:
+            out.write("failed.\n")
+
+def same_bytes(output_file, reference_file):
+    '''
+    True if both files hold the same bytes, otherwise None.
+    '''
+    if os.path.getsize(output_file) != os.path.getsize(reference_file):
+        return None
+
+    with open(output_file, 'rb') as output:
+        with open(reference_file, 'rb') as reference:
+            while True:
+                chunk = output.read(COMPARISON_CHUNK)
+                if chunk != reference.read(COMPARISON_CHUNK):
+                    return None
+                if not chunk:
+                    return True
+
+def _fields_match(output, reference, tolerance):
+    if output.dtype.kind == 'f':
+        return numpy.allclose(output, reference, rtol=0, atol=tolerance)
+    return numpy.array_equal(output, reference)
+
+def matches_reference(output_file, reference_file, tolerance, layout):
+    '''
+    True if both files hold the same number of records of layout (a numpy
+    dtype), with every floating point field within tolerance (absolute) of
+    the reference and every other field equal, otherwise None.
+    '''
+    size = os.path.getsize(output_file)
+    if size != os.path.getsize(reference_file) or size % layout.itemsize != 0:
+        return None
+    if size == 0:
+        return True
+
+    output = numpy.memmap(output_file, dtype=layout, mode='r')
+    reference = numpy.memmap(reference_file, dtype=layout, mode='r')
+
+    for start in range(0, len(output), COMPARISON_CHUNK):
+        end = start + COMPARISON_CHUNK
+        if layout.names is None:
+            matched = _fields_match(output[start:end], reference[start:end], tolerance)
+        else:
+            matched = all(_fields_match(output[name][start:end], reference[name][start:end], tolerance)
+                          for name in layout.names)
+        if not matched:
+            return None
+
+    return True
+
+def reference_layout(layout):
+    '''
+    The numpy dtype of an Assignment.reference_layout, or None if it has
+    none (or numpy doesn't understand it, or there's no numpy).
+    '''
+    if numpy is None or not layout:
+        return None
+    try:
+        return numpy.dtype(str(layout))
+    except (TypeError, ValueError):
+        return None
+
+class ReferenceComparator(object):
+    '''
+    Called with a student's output file, returns True if it matches the
+    reference output (see the top of this file), or None if the oracle has
+    to decide.
+    '''
+    def __init__(self, reference_file, tolerance, layout=None):
+        self.reference_file = reference_file
+        self.tolerance = tolerance
+        self.layout = reference_layout(layout)
+
+    def __call__(self, output_file):
+        if self.layout is None:
+            return same_bytes(output_file, self.reference_file)
+        return matches_reference(output_file, self.reference_file, self.tolerance, self.layout)
+
+    def signature(self):
+        '''
+        What a verdict reached through this comparison depends on, for
+        cache.VerdictCache.key: the reference itself, and how it's compared.
+        '''
+        return "{} {!r} {}".format(file_digest(self.reference_file), self.tolerance,
+                                   self.layout.str if self.layout is not None else "bytes")
+
+def reference_comparator(scene, oracle_path, tolerance, layout=None):
+    '''
+    A ReferenceComparator of the scene's reference output, or None if there
+    is no usable reference to compare against.
+    '''
+    if tolerance is None or not os.path.isfile(oracle_path):
+        return None
+
+    if not has_reference(scene.filepath, oracle_path, scene.digest()):
+        return None
+
+    return ReferenceComparator(reference_path(scene.filepath), tolerance, layout)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+'''
+Regrades the submissions to an assignment after its oracle is fixed or
+scenes are added to its asset directories, without students resubmitting.
+
+    python regrade.py [-A] [-f] [-n] [-j <processes>] <assignment name>
+
+regrades the latest submission of every student, or every submission with
+-A. Only the affected scenes of a submission are run again: those it has
+no run of, and those whose latest run was graded with a different scene
+file or oracle than the current ones (or isn't known to have been; see
+TestSceneRun.scene_digest). -f runs every scene again, really running
+each rather than taking its verdict from the verdict cache, and -n only
+shows how many would be run.
+
+Each submission's folder is restored from storage.py's blob store (or,
+if it was never packed, copied from the submissions directory) and built
+as grader.py would, so a build cache entry or a warm build is reused
+whenever there is one. Its scenes run on a pool of processes (TEST_WORKERS
+by default), while the next submissions are built. The new runs are
+written in bulk, in the same transaction as the submission's new counts
+and as marking the runs they replace superseded (see
+TestSceneRun.superseded), which are kept but no longer count anywhere.
+
+Every submission is committed on its own, so an interrupted regrade is
+resumed by running it again: the submissions already done have no affected
+scenes left. Submissions whose folder is neither archived nor still in
+the submissions directory can't be rebuilt and are skipped.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from multiprocessing import Pool
+from uuid import uuid4
+
+import grader
+import models
+from cache import VerdictCache, file_digest
+from models import (Assignment,
+                    LatestSubmission,
+                    Session,
+                    Submission,
+                    SubmissionArchive,
+                    TestScene,
+                    TestSceneRun,
+                    SKIPPED,
+                    retry_on_lock)
+from storage import ARCHIVE_EXCLUDED, restore_archive
+from workspace import copy_folder
+
+# submissions built ahead of the one whose scenes are being waited for.
+REGRADE_AHEAD = int(os.environ.get("GRADER_REGRADE_AHEAD", 2))
+
+def latest_runs(ses, submission):
+    '''
+    The latest run of each scene of the submission, by scene path.
+    '''
+    runs = {}
+    for run in ses.query(TestSceneRun).filter(TestSceneRun.submission_id == submission.id)\
+                                      .filter(TestSceneRun.superseded == False)\
+                                      .order_by(TestSceneRun.id):
+        runs[run.scene_path] = run
+    return runs
+
+def is_stale(run, test, oracle_digest):
+    return (run is None
+            or run.verdict == SKIPPED
+            or run.scene_digest is None or run.scene_digest != test.digest()
+            or run.oracle_digest is None or run.oracle_digest != oracle_digest)
+
+def affected_tests(tests, runs, oracle_digest, force=False):
+    '''
+    The tests whose latest run (in runs, by scene path) is missing or stale.
+    '''
+    if force:
+        return list(tests)
+    return [t for t in tests if is_stale(runs.get(t.filepath), t, oracle_digest)]
+
+def submissions_to_regrade(ses, assignment, every_submission=False):
+    if every_submission:
+        query = ses.query(Submission).filter(Submission.assignment_id == assignment.id)
+    else:
+        query = ses.query(Submission).join(LatestSubmission,
+                                           LatestSubmission.submission_id == Submission.id)\
+                                     .filter(LatestSubmission.assignment_id == assignment.id)
+    return query.order_by(Submission.id).all()
+
+_worker_assignments = {}
+
+def init_worker():
+    # connections made before the fork belong to the parent.
+    models.engine.dispose()
+
+def run_scene(task):
+    '''
+    Runs a test scene in a pool process. Returns its result, log and usage
+    (see grader.scene_runner). Without use_cache, the scene really runs
+    even if the verdict cache holds a verdict for it.
+    '''
+    assignment_id, binary_path, scene_path, use_cache = task
+
+    assignment = _worker_assignments.get(assignment_id)
+    if assignment is None:
+        assignment = Session().query(Assignment).get(assignment_id)
+        _worker_assignments[assignment_id] = assignment
+
+    cache = VerdictCache() if use_cache else None
+    run_test = grader.scene_runner(binary_path, assignment, uuid4().hex, cache)
+    return run_test(TestScene(scene_path))
+
+def live_folder_of(assignment, submission):
+    '''
+    The folder the submission was graded in, if it's still in the
+    submissions directory (see Submission.folder_name), or None.
+    '''
+    if submission.folder_name is None:
+        return None
+
+    folder = os.path.join(grader.SUBMISSIONS_DIRECTORY,
+                          "t{}m{}".format(assignment.theme, assignment.milestone),
+                          submission.folder_name)
+    return folder if os.path.isdir(folder) else None
+
+def copy_live_folder(live_folder, folder):
+    '''
+    Copies the live folder into folder, leaving out what storage.py doesn't
+    archive either, such as its old build.
+    '''
+    for name in os.listdir(live_folder):
+        if name in ARCHIVE_EXCLUDED:
+            continue
+        path = os.path.join(live_folder, name)
+        if os.path.isdir(path):
+            copy_folder(path, os.path.join(folder, name))
+        else:
+            shutil.copy2(path, os.path.join(folder, name))
+
+def build_for_regrade(ses, assignment, submission):
+    '''
+    Restores the submission's folder into a temporary folder, or copies it
+    there from the submissions directory if it was never archived, and
+    builds it. Returns the folder, the binary and None, or the folder (or
+    None) and None and a message explaining why it couldn't be built.
+    '''
+    archive = ses.query(SubmissionArchive)\
+                 .filter(SubmissionArchive.submission_id == submission.id).first()
+    live_folder = live_folder_of(assignment, submission) if archive is None else None
+    if archive is None and live_folder is None:
+        return None, None, "Its folder was never archived, and isn't in the submissions directory."
+
+    folder = tempfile.mkdtemp(prefix="regrade_{}_".format(submission.id))
+    try:
+        if archive is not None:
+            restore_archive(archive, folder)
+        else:
+            copy_live_folder(live_folder, folder)
+    except (IOError, OSError) as e:
+        return folder, None, "Its folder couldn't be restored: {}".format(e)
+
+    binary_path, error = grader.build_submission(folder, assignment.template_path)
+    return folder, binary_path, error
+
+def record_regrade(ses, submission, runs, new_runs):
+    '''
+    Writes the new runs of the submission, marks the runs (in runs, by scene
+    path) they replace superseded, and stores its counts over the runs left
+    current, as gradebook.py counts them.
+    '''
+    latest = dict(runs)
+    latest.update((r.scene_path, r) for r in new_runs)
+    current = list(latest.values())
+
+    def record():
+        for r in new_runs:
+            r.submission_id = submission.id
+            if r.scene_path in runs:
+                runs[r.scene_path].superseded = True
+        ses.bulk_save_objects(new_runs)
+        submission.count_runs(current)
+        ses.commit()
+
+    retry_on_lock(ses, record)
+
+def regrade(ses, assignment, submissions, workers=None, force=False, dry_run=False, out=None):
+    '''
+    Regrades the affected tests of the submissions (see the top of this
+    file). Returns the number of submissions regraded.
+    '''
+    if out is None:
+        out = sys.stdout
+    if workers is None:
+        workers = grader.TEST_WORKERS
+
+    tests = assignment.tests()
+    oracle_digest = file_digest(assignment.oracle_path)
+
+    def report(submission, message):
+        out.write("Submission {} by {}: {}\n".format(submission.id, submission.student.uni, message))
+        out.flush()
+
+    if dry_run:
+        for submission in submissions:
+            affected = affected_tests(tests, latest_runs(ses, submission), oracle_digest, force)
+            report(submission, "{} of {} scenes to run.".format(len(affected), len(tests)))
+        return 0
+
+    pool = Pool(max(1, workers), initializer=init_worker)
+    pending = deque() # (submission, runs, affected, folder, results)
+    regraded = [0]
+
+    def finish(submission, runs, affected, folder, results):
+        try:
+            outcomes = [r.get() for r in results]
+        except Exception as e:
+            report(submission, "Running its scenes failed: {}".format(e))
+            return
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        before = submission.counts()
+        new_runs = []
+        for t, (result, log, usage) in zip(affected, outcomes):
+            # an undetermined result leaves the scene affected for next time.
+            run = grader.scene_run_of(t.filepath, result, t.graded, usage)
+            if run is not None:
+                new_runs.append(run)
+
+        record_regrade(ses, submission, runs, new_runs)
+        regraded[0] += 1
+        report(submission, "{} scenes run, {} / {} passed, now {} / {}.".format(
+            len(new_runs), before[0], before[1], *submission.counts()))
+
+    try:
+        for submission in submissions:
+            runs = latest_runs(ses, submission)
+            affected = affected_tests(tests, runs, oracle_digest, force)
+            if not affected:
+                continue
+
+            folder, binary_path, error = build_for_regrade(ses, assignment, submission)
+            if binary_path is None:
+                if folder is not None:
+                    shutil.rmtree(folder, ignore_errors=True)
+                report(submission, "Skipped. {}".format(error))
+                continue
+
+            # a forced regrade is for when the verdicts can't be trusted.
+            results = [pool.apply_async(run_scene,
+                                        ((assignment.id, binary_path, t.filepath, not force),))
+                       for t in affected]
+            pending.append((submission, runs, affected, folder, results))
+
+            # record whatever is done, and wait once enough is built ahead.
+            while pending and (len(pending) > REGRADE_AHEAD or
+                               all(r.ready() for r in pending[0][4])):
+                finish(*pending.popleft())
+
+        while pending:
+            finish(*pending.popleft())
+    finally:
+        pool.terminate()
+        pool.join()
+        for entry in pending:
+            shutil.rmtree(entry[3], ignore_errors=True)
+
+    return regraded[0]
+
+def usage():
+    print("Usage: {} [-A] [-f] [-n] [-j <processes>] <assignment name>".format(sys.argv[0]))
+    sys.exit(0)
+
+def main():
+    args = sys.argv[1:]
+    every_submission = False
+    force = False
+    dry_run = False
+    workers = None
+    assignment_name = None
+
+    while args:
+        option = args.pop(0)
+        if option == '-A':
+            every_submission = True
+        elif option == '-f':
+            force = True
+        elif option == '-n':
+            dry_run = True
+        elif option == '-j' and args:
+            workers = int(args.pop(0))
+        elif not option.startswith('-') and assignment_name is None:
+            assignment_name = option
+        else:
+            usage()
+
+    if assignment_name is None:
+        usage()
+
+    ses = Session()
+    assignment = next((a for a in ses.query(Assignment) if a.name() == assignment_name), None)
+    if assignment is None:
+        print("No assignment named '{}'.".format(assignment_name))
+        sys.exit(1)
+    if assignment.is_creative_scene():
+        print("Creative scenes aren't graded by scenes, so there's nothing to regrade.")
+        sys.exit(1)
+    if not os.path.isfile(assignment.oracle_path):
+        print("Failed to open oracle '{}'.".format(assignment.oracle_path))
+        sys.exit(1)
+
+    submissions = submissions_to_regrade(ses, assignment, every_submission)
+
+    started = time.time()
+    regraded = regrade(ses, assignment, submissions, workers, force, dry_run)
+    if not dry_run:
+        print("Regraded {} of {} submissions in {:.1f}s.".format(
+            regraded, len(submissions), time.time() - started))
+
+if __name__ == '__main__':
+    main()
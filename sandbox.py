@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+'''
+Runs untrusted binaries (student builds, and the oracle on student output)
+under CPU-time, wall-time and address-space limits.
+
+Processes are started through this file as an exec wrapper,
+
+    python sandbox.py <cpu time> <memory> <program> [arguments ...]
+
+which applies the limits (either may be "none") and execs the program, as
+the graders fork from threads, where a preexec_fn isn't safe.
+'''
+
+import errno
+import os
+import resource
+import select
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from subprocess import Popen
+
+# defaults used when an assignment doesn't configure its own limits.
+DEFAULT_CPU_TIME_LIMIT  = 300  # seconds
+DEFAULT_WALL_TIME_LIMIT = 600  # seconds
+DEFAULT_MEMORY_LIMIT    = 4096 # megabytes
+
+# verdicts of a run that had to be stopped.
+TIMEOUT = "TIMEOUT"
+OOM     = "OOM"
+
+# what a C/C++ program typically prints when an allocation fails because of
+# RLIMIT_AS.
+OOM_MARKERS = ["std::bad_alloc", "Cannot allocate memory", "out of memory"]
+
+# how much of the end of a process's output is kept, and searched for
+# OOM_MARKERS.
+OOM_MARKER_WINDOW = 64 * 1024
+
+# how much output is read from a pipe at a time.
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# how long the output of a process that has exited is waited for, in case
+# something it started still holds the pipe, in seconds.
+OUTPUT_CLOSE_TIMEOUT = 5
+
+# this file, run as the exec wrapper; resolved once, as graders change
+# directories.
+WRAPPER_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+
+class ResourceLimits(object):
+    '''
+    Limits on a single process. Any limit may be None to leave it unbounded.
+    '''
+    def __init__(self, cpu_time=DEFAULT_CPU_TIME_LIMIT,
+            wall_time=DEFAULT_WALL_TIME_LIMIT, memory=DEFAULT_MEMORY_LIMIT):
+        self.cpu_time = cpu_time
+        self.wall_time = wall_time
+        self.memory = memory
+
+    def __str__(self):
+        return "<ResourceLimits cpu={}s wall={}s memory={}MB>".format(
+                self.cpu_time, self.wall_time, self.memory)
+
+    def apply(self):
+        '''
+        Run by the exec wrapper before it execs the program. The program gets
+        its own process group, so that it can be killed along with anything
+        it spawned.
+        '''
+        os.setsid()
+
+        # python ignores SIGPIPE, and children inherit that; a binary writing
+        # to a reader that has gone away should die the usual way.
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+        if self.cpu_time is not None:
+            # SIGXCPU at the soft limit, SIGKILL a second later.
+            resource.setrlimit(resource.RLIMIT_CPU,
+                    (self.cpu_time, self.cpu_time + 1))
+
+        if self.memory is not None:
+            memory_bytes = self.memory * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+    def wrap(self, args):
+        '''
+        args, run through the exec wrapper under these limits. The wall time
+        is enforced by the LimitedProcess instead.
+        '''
+        def arg(value):
+            return "none" if value is None else str(value)
+
+        return [sys.executable, "-S", WRAPPER_PATH, arg(self.cpu_time), arg(self.memory)] + list(args)
+
+class ProcessGroup(object):
+    '''
+    The LimitedProcesses started for one piece of work, such as the scenes
+    of a submission, so that they can all be killed at once. Once stopped,
+    any process still started for it is killed right away.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.stopped = False
+
+    def add(self, process):
+        with self.lock:
+            self.processes.add(process)
+            stopped = self.stopped
+        if stopped:
+            process.kill()
+
+    def discard(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            processes = list(self.processes)
+        for process in processes:
+            process.kill()
+
+class LimitedProcess(object):
+    '''
+    A Popen started under ResourceLimits. If it outlives the wall-time limit,
+    its whole process group is killed and timed_out is set.
+
+    It is reaped with wait4 rather than through the Popen, so use its own
+    wait and poll; once it has exited, usage holds its
+    wall_time, user_time and system_time in seconds and its max_rss in
+    kilobytes.
+
+    If group (a ProcessGroup) is given, the process belongs to it until it
+    is reaped.
+    '''
+    def __init__(self, args, limits=None, group=None, **kwargs):
+        if limits is None:
+            limits = ResourceLimits()
+
+        self.limits = limits
+        self.timed_out = False
+        self.usage = None
+        self.started = time.time()
+        self.process = Popen(limits.wrap(args), **kwargs)
+
+        self.group = group
+        if group is not None:
+            group.add(self)
+
+        self.timer = None
+        if limits.wall_time is not None:
+            self.timer = threading.Timer(limits.wall_time, self._on_timeout)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _on_timeout(self):
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        if self.process.returncode is not None:
+            return # reaped; its pid may belong to someone else by now
+
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # the wrapper may not have made its process group yet.
+            try:
+                os.kill(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass # already exited
+
+    def _stop_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def _reap(self, options):
+        '''
+        Reaps the process if it has exited (or, without WNOHANG, once it
+        does), recording its returncode and usage. Returns the returncode.
+        '''
+        if self.process.returncode is not None:
+            return self.process.returncode
+
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.process.pid, options)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+        if pid == 0:
+            return None
+
+        self._stop_timer()
+        if self.group is not None:
+            self.group.discard(self)
+        self.usage = {"wall_time": time.time() - self.started,
+                      "user_time": rusage.ru_utime,
+                      "system_time": rusage.ru_stime,
+                      "max_rss": rusage.ru_maxrss}
+
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        return self.process.returncode
+
+    def poll(self):
+        return self._reap(os.WNOHANG)
+
+    def wait(self):
+        try:
+            return self._reap(0)
+        finally:
+            self._stop_timer()
+
+    def verdict(self, output=""):
+        '''
+        TIMEOUT or OOM if the process was stopped by one of its limits,
+        otherwise None. output is the tail of whatever the process printed.
+        '''
+        code = self.process.returncode
+
+        if self.timed_out or code == -signal.SIGXCPU:
+            return TIMEOUT
+
+        # a SIGKILL nobody asked for may come from the kernel's OOM killer,
+        # or from anyone else; without a marker it's just a crash.
+        if self.limits.memory is not None and code != 0:
+            if any(marker in output for marker in OOM_MARKERS):
+                return OOM
+
+        return None
+
+class OutputTail(threading.Thread):
+    '''
+    Reads a process's output pipe until end of file, keeping only the last
+    size bytes. However much the process prints, it never blocks on a full
+    pipe, and its output never takes more memory than that. Subclasses may
+    look at the output as it comes in (see received).
+    '''
+    def __init__(self, pipe, size=OOM_MARKER_WINDOW):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pipe = pipe
+        self.size = size
+        self.chunks = deque()
+        self.length = 0
+        self.lock = threading.Lock()
+
+    def run(self):
+        fd = self.pipe.fileno()
+        try:
+            for chunk in iter(lambda: os.read(fd, OUTPUT_CHUNK_SIZE), b""):
+                self.received(chunk)
+                with self.lock:
+                    self.chunks.append(chunk)
+                    self.length += len(chunk)
+                    while self.length - len(self.chunks[0]) >= self.size:
+                        self.length -= len(self.chunks.popleft())
+        finally:
+            self.pipe.close()
+
+    def received(self, chunk):
+        pass
+
+    def text(self, timeout=OUTPUT_CLOSE_TIMEOUT):
+        '''
+        The tail of the output, once the pipe is closed or timeout seconds
+        have passed. Call it once the process has exited.
+        '''
+        self.join(timeout)
+        with self.lock:
+            return b"".join(self.chunks)[-self.size:].decode('utf-8', 'replace')
+
+def drain_fifo(path, process):
+    '''
+    Reads and discards whatever process (a LimitedProcess) writes to the
+    FIFO at path until it exits, so that it can't block on a FIFO that
+    nobody else reads.
+    '''
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while process.poll() is None:
+            ready, _, _ = select.select([fd], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                if not os.read(fd, 1 << 16):
+                    time.sleep(0.05) # no writer has opened it yet
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+    finally:
+        os.close(fd)
+
+def release_fifo_reader(path, reader):
+    '''
+    Opens and closes the write end of the FIFO at path, so that a process
+    still waiting for a writer sees end of file. reader is the thread
+    collecting that process's output; this returns once it has the FIFO
+    open, or once it's done.
+    '''
+    while reader.is_alive():
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            reader.join(0.05) # no reader has opened it (yet)
+        else:
+            os.close(fd)
+            return
+
+def main():
+    args = sys.argv[1:]
+    if len(args) < 3:
+        sys.stderr.write("Usage: {} <cpu time> <memory> <program> [arguments ...]\n".format(sys.argv[0]))
+        sys.exit(2)
+
+    def limit(value):
+        return None if value == "none" else int(value)
+
+    ResourceLimits(cpu_time=limit(args[0]), wall_time=None, memory=limit(args[1])).apply()
+    try:
+        os.execvp(args[2], args[2:])
+    except OSError as e:
+        sys.stderr.write("Failed to run '{}': {}\n".format(args[2], e))
+        os._exit(127)
+
+if __name__ == '__main__':
+    main()
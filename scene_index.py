@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+'''
+A persisted index of the scene files in each asset directory, so that
+finding an assignment's tests doesn't walk (and stat every file of) asset
+directories that live on a network home.
+
+An index records every directory of the tree with its modification time,
+and every scene with its size, modification time and digest. It is trusted
+for as long as none of its directories has changed, which takes one stat
+per directory. Adding, removing or renaming a scene changes the mtime of
+its directory; a scene edited in place doesn't, but its digest is only
+trusted while the scene's own size and mtime match (see
+SceneEntry.current_digest). Indexes can also be rebuilt by hand:
+
+    python scene_index.py [asset directory ...]
+
+rebuilds the indexes of the given directories, or of every asset directory
+in the database.
+'''
+
+import json
+import os
+import sys
+from uuid import uuid4
+
+from cache import file_digest, sha1_of
+
+SCENE_INDEX_DIRECTORY = os.environ.get("GRADER_SCENE_INDEX", "./scene_index")
+
+SCENE_EXTENSION = ".xml"
+
+# bumped whenever the format of an index changes, so old ones are rebuilt.
+INDEX_VERSION = 1
+
+class SceneEntry(object):
+    def __init__(self, path, size, mtime, digest):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+
+    def current_digest(self):
+        '''
+        The digest of the scene file, trusting the index only while the
+        file's size and mtime still match it: a scene edited in place
+        leaves its directory, and so its index, untouched.
+        '''
+        st = os.stat(self.path)
+        if (st.st_size, st.st_mtime) == (self.size, self.mtime):
+            return self.digest
+        return file_digest(self.path)
+
+class SceneIndex(object):
+    '''
+    The index of one asset directory. Paths of scenes are joined onto the
+    directory as it was given, like os.walk would.
+    '''
+    def __init__(self, directory, index_directory=SCENE_INDEX_DIRECTORY):
+        self.directory = directory
+        self.index_path = os.path.join(index_directory,
+                                       sha1_of(os.path.abspath(directory)) + ".json")
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if index.get("version") != INDEX_VERSION:
+            return None
+        return index
+
+    def _is_current(self, index):
+        for relpath, mtime in index["directories"].items():
+            try:
+                if os.stat(os.path.join(self.directory, relpath)).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def _save(self, index):
+        parent = os.path.dirname(self.index_path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass # created concurrently
+
+        tmp = "{}.{}.tmp".format(self.index_path, uuid4().hex)
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp, self.index_path)
+
+    def rebuild(self, previous=None):
+        '''
+        Walks the directory and saves a fresh index. Digests of scenes whose
+        size and mtime are unchanged since previous are reused.
+        '''
+        known = {}
+        if previous is not None:
+            known = dict((relpath, (size, mtime, digest))
+                         for relpath, size, mtime, digest in previous["scenes"])
+
+        directories = {}
+        scenes = []
+
+        for root, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            relroot = os.path.relpath(root, self.directory)
+            directories[relroot] = os.stat(root).st_mtime
+
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1] != SCENE_EXTENSION:
+                    continue
+
+                path = os.path.join(root, filename)
+                relpath = os.path.normpath(os.path.join(relroot, filename))
+                st = os.stat(path)
+
+                size, mtime, digest = known.get(relpath, (None, None, None))
+                if (size, mtime) != (st.st_size, st.st_mtime):
+                    digest = file_digest(path)
+
+                scenes.append([relpath, st.st_size, st.st_mtime, digest])
+
+        index = {"version": INDEX_VERSION,
+                 "directory": os.path.abspath(self.directory),
+                 "directories": directories,
+                 "scenes": scenes}
+        self._save(index)
+        return index
+
+    def scenes(self):
+        '''
+        A SceneEntry for every scene file in the directory, from the saved
+        index if it is still current.
+        '''
+        index = self._load()
+        if index is None or not self._is_current(index):
+            index = self.rebuild(index)
+
+        return [SceneEntry(os.path.join(self.directory, relpath), size, mtime, digest)
+                for relpath, size, mtime, digest in index["scenes"]]
+
+def find_scenes(directory):
+    '''
+    A SceneEntry for every scene file in directory and its subdirectories.
+    '''
+    if not os.path.isdir(directory):
+        return []
+    return SceneIndex(directory).scenes()
+
+def main():
+    directories = sys.argv[1:]
+    if not directories:
+        from models import Session, AssignmentAssetDirectory
+
+        ses = Session()
+        directories = sorted(set(d.path for d in ses.query(AssignmentAssetDirectory)))
+        ses.close()
+
+    for directory in directories:
+        if not os.path.isdir(directory):
+            print("Skipping '{}': not a directory.".format(directory))
+            continue
+
+        index = SceneIndex(directory)
+        index.rebuild(index._load())
+        print("Indexed {} scenes in '{}'.".format(len(index.scenes()), directory))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+'''
+Decides which waiting submission gets the next free worker slot of the
+grading daemon:
+
+    1. submissions to an assignment whose deadline is close (or whose late
+       window is running) go first, the closest deadline first,
+    2. then students who have had the least grading recently, so that
+       resubmitting over and over doesn't starve anyone else,
+    3. then first come, first served.
+
+The scheduler does no I/O and takes its time from a clock function, so it
+can be driven with fake workloads; see simulate().
+'''
+
+import heapq
+import sys
+import time
+
+# submissions whose absolute deadline (due date plus late window) is at most
+# this far away are urgent, in seconds.
+DEADLINE_HORIZON = 6 * 60 * 60
+
+# how far back a student's grading counts against them, in seconds.
+FAIRNESS_WINDOW = 60 * 60
+
+# expected length of a job before any has finished, in seconds.
+DEFAULT_JOB_DURATION = 120.0
+
+# weight of the latest job in the running average of job durations.
+DURATION_SMOOTHING = 0.2
+
+# how long an order is reused while no job is submitted, started or
+# finished, in seconds; the daemon asks for it once per waiting student.
+ORDER_CACHE_INTERVAL = 1.0
+
+class Job(object):
+    def __init__(self, job_id, uni, deadline, sequence, submitted):
+        self.job_id = job_id
+        self.uni = uni
+        self.deadline = deadline # seconds since the epoch, or None
+        self.sequence = sequence
+        self.submitted = submitted
+        self.started = None
+
+class FairShareScheduler(object):
+    def __init__(self, workers, clock=time.time):
+        self.workers = workers
+        self.clock = clock
+        self.waiting = {}
+        self.running = {}
+        self.history = [] # (start time, uni) of recently started jobs
+        self.sequence = 0
+        self.average_duration = DEFAULT_JOB_DURATION
+
+        # bumped on every change to the jobs, to know when a cached order
+        # is stale.
+        self.version = 0
+        self.cached_order = None # (version, time, order)
+
+    def submit(self, job_id, uni, deadline=None):
+        '''
+        Queues a job. deadline is when the assignment stops accepting
+        submissions, in seconds since the epoch.
+        '''
+        self.sequence += 1
+        self.waiting[job_id] = Job(job_id, uni, deadline, self.sequence, self.clock())
+        self.version += 1
+
+    def cancel(self, job_id):
+        if self.waiting.pop(job_id, None) is not None:
+            self.version += 1
+
+    def _recent_usage(self, now):
+        '''
+        How many jobs each student has running or started recently.
+        '''
+        self.history = [(t, u) for (t, u) in self.history if now - t <= FAIRNESS_WINDOW]
+
+        usage = {}
+        for uni in [j.uni for j in self.running.values()] + [u for (t, u) in self.history]:
+            usage[uni] = usage.get(uni, 0) + 1
+        return usage
+
+    def _urgency(self, job, now):
+        '''
+        Sorts urgent jobs first, closest deadline first, then the others.
+        '''
+        if job.deadline is not None and job.deadline - now <= DEADLINE_HORIZON:
+            return (0, job.deadline)
+        return (1, 0)
+
+    def order(self):
+        '''
+        The waiting jobs, in the order they would be started.
+        '''
+        now = self.clock()
+        if self.cached_order is not None:
+            version, computed, ordered = self.cached_order
+            if version == self.version and 0 <= now - computed < ORDER_CACHE_INTERVAL:
+                return ordered
+
+        usage = self._recent_usage(now)
+
+        # a student's own jobs go in order of urgency and arrival; which
+        # student goes next also depends on how much they've had, which
+        # only changes for the one picked.
+        queues = {}
+        for job in self.waiting.values():
+            queues.setdefault(job.uni, []).append(job)
+        for uni, jobs in queues.items():
+            jobs.sort(key=lambda j: (self._urgency(j, now), j.sequence), reverse=True)
+
+        def head_of(uni):
+            job = queues[uni][-1]
+            return (self._urgency(job, now), usage.get(uni, 0), job.sequence, uni)
+
+        heads = [head_of(uni) for uni in queues]
+        heapq.heapify(heads)
+
+        ordered = []
+        while heads:
+            uni = heapq.heappop(heads)[-1]
+            ordered.append(queues[uni].pop())
+            # whoever goes next has had one more turn than before.
+            usage[uni] = usage.get(uni, 0) + 1
+            if queues[uni]:
+                heapq.heappush(heads, head_of(uni))
+
+        self.cached_order = (self.version, now, ordered)
+        return ordered
+
+    def start_next(self):
+        '''
+        Starts and returns the id of the next job, or None if every worker is
+        busy or nothing is waiting.
+        '''
+        if len(self.running) >= self.workers or not self.waiting:
+            return None
+
+        job = self.order()[0]
+        del self.waiting[job.job_id]
+
+        job.started = self.clock()
+        self.running[job.job_id] = job
+        self.history.append((job.started, job.uni))
+        self.version += 1
+
+        return job.job_id
+
+    def finish(self, job_id):
+        job = self.running.pop(job_id, None)
+        if job is None:
+            return
+        self.version += 1
+
+        duration = self.clock() - job.started
+        self.average_duration += DURATION_SMOOTHING * (duration - self.average_duration)
+
+    def estimated_start(self, job_id):
+        '''
+        When the waiting job is expected to start, in seconds since the
+        epoch, assuming every job takes the average duration.
+        '''
+        now = self.clock()
+
+        # when each worker is expected to be free.
+        free = sorted(max(now, j.started + self.average_duration) for j in self.running.values())
+        free += [now] * (self.workers - len(free))
+
+        for job in self.order():
+            free.sort()
+            start = free[0]
+            if job.job_id == job_id:
+                return start
+            free[0] = start + self.average_duration
+
+        return None
+
+    def position(self, job_id):
+        '''
+        How many waiting jobs will start before this one.
+        '''
+        ids = [j.job_id for j in self.order()]
+        return ids.index(job_id) if job_id in ids else None
+
+class FakeClock(object):
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def simulate(arrivals, workers):
+    '''
+    Runs a fake workload through the scheduler. arrivals is a list of
+    (arrival time, uni, deadline, duration). Returns a list of
+    (uni, arrival time, start time) in the order jobs started.
+    '''
+    clock = FakeClock()
+    scheduler = FairShareScheduler(workers, clock)
+
+    pending = sorted(enumerate(arrivals), key=lambda a: a[1][0])
+    ends = {} # job id -> end time
+    started = []
+
+    while pending or scheduler.waiting or scheduler.running:
+        # advance to the next arrival or completion.
+        events = [a[1][0] for a in pending[:1]] + list(ends.values())
+        clock.now = max(clock.now, min(events))
+
+        for job_id, end in list(ends.items()):
+            if end <= clock.now:
+                scheduler.finish(job_id)
+                del ends[job_id]
+
+        while pending and pending[0][1][0] <= clock.now:
+            job_id, (arrival, uni, deadline, duration) = pending.pop(0)
+            scheduler.submit(job_id, uni, deadline)
+
+        job_id = scheduler.start_next()
+        while job_id is not None:
+            arrival, uni, deadline, duration = arrivals[job_id]
+            ends[job_id] = clock.now + duration
+            started.append((uni, arrival, clock.now))
+            job_id = scheduler.start_next()
+
+    return started
+
+def main():
+    '''
+    Simulates a deadline rush: one student resubmitting constantly while
+    others submit once, and prints how long each waited.
+    '''
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    deadline = 3600.0
+
+    arrivals = [(i * 10.0, "spammer", deadline, 60.0) for i in range(30)]
+    arrivals += [(30.0 + i * 20.0, "student{}".format(i), deadline, 60.0) for i in range(10)]
+
+    for uni, arrival, start in simulate(arrivals, workers):
+        print("{:<10} arrived {:>6.0f}s, waited {:>6.0f}s".format(uni, arrival, start - arrival))
+
+if __name__ == '__main__':
+    main()
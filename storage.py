@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+'''
+Compact storage for graded submission folders. Once a submission is
+recorded, its folder can be packed into STORAGE_DIRECTORY and removed, by
+pack below (run from cron, say), or by the grader itself right after the
+submission with GRADER_ARCHIVE=1:
+
+    blobs/ab/cd/<sha1>[.gz]      the contents of every file ever packed, once,
+                                 gzipped unless already compressed
+    manifests/ab/<folder>.json.gz  the files of one folder: path, mode, size
+                                 and blob
+
+Files are deduplicated across every submission, so the template files each
+folder holds and a student's unchanged resubmissions take no space, and the
+build/ folder is dropped altogether. The submission_archives table maps
+submissions to their manifests.
+
+    python storage.py restore <submission id> <destination folder>
+    python storage.py restore --folder <folder name> <destination folder>
+    python storage.py pack [<submissions directory>]
+    python storage.py stats
+
+restore rebuilds a submission's folder, or a packed folder by its name.
+pack packs every folder in the submissions directory that hasn't changed
+in PACK_MIN_AGE, and links it to the submission that recorded it
+(see Submission.folder_name). Folders no submission recorded, such as
+those graded before submissions did, are left where they are.
+'''
+
+import gzip
+import json
+import os
+import shutil
+import sys
+import time
+from uuid import uuid4
+
+from sqlalchemy import func, inspect
+
+from cache import file_digest, sha1_of, walk_files
+from models import Session, Submission, SubmissionArchive, retry_on_lock
+
+STORAGE_DIRECTORY = os.environ.get("GRADER_STORAGE", "./storage")
+
+# top-level folders of a submission folder that aren't kept.
+ARCHIVE_EXCLUDED = ['build']
+
+# files that don't get any smaller gzipped.
+UNCOMPRESSED_EXTENSIONS = ['.mpeg', '.mpg', '.mov', '.mkv', '.avi', '.mp4',
+                           '.png', '.jpg', '.jpeg', '.gif', '.gz', '.zip', '.bz2', '.xz']
+
+# folders that changed more recently than this (in seconds) may still be
+# being graded, so pack leaves them alone.
+PACK_MIN_AGE = 24 * 60 * 60
+
+MANIFEST_VERSION = 1
+
+def _make_parent(path):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            pass # created concurrently
+
+def _atomic_write(path, write):
+    '''
+    Calls write(f) on a temporary file that then replaces path, so that
+    readers never see a partial file.
+    '''
+    _make_parent(path)
+    tmp = "{}.{}.tmp".format(path, uuid4().hex)
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.rename(tmp, path)
+
+def blob_path(digest, compressed, directory=STORAGE_DIRECTORY):
+    return os.path.join(directory, "blobs", digest[:2], digest[2:4],
+                        digest + (".gz" if compressed else ""))
+
+def find_blob(digest, directory=STORAGE_DIRECTORY):
+    '''
+    The path of the blob and whether it's compressed, or None and None.
+    '''
+    for compressed in (True, False):
+        path = blob_path(digest, compressed, directory)
+        if os.path.isfile(path):
+            return path, compressed
+    return None, None
+
+def store_blob(path, directory=STORAGE_DIRECTORY):
+    '''
+    Adds the contents of the file at path to the blob store, unless they're
+    there already. Returns their digest and the bytes added to the store.
+    '''
+    digest = file_digest(path)
+    if find_blob(digest, directory)[0] is not None:
+        return digest, 0
+
+    compressed = os.path.splitext(path)[1].lower() not in UNCOMPRESSED_EXTENSIONS
+    stored_path = blob_path(digest, compressed, directory)
+
+    def write(f):
+        with open(path, 'rb') as original:
+            if compressed:
+                with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as packed:
+                    shutil.copyfileobj(original, packed)
+            else:
+                shutil.copyfileobj(original, f)
+
+    _atomic_write(stored_path, write)
+    return digest, os.path.getsize(stored_path)
+
+def manifest_path_of(folder_name):
+    '''
+    Where the manifest of a folder goes, relative to STORAGE_DIRECTORY.
+    '''
+    return os.path.join("manifests", sha1_of(folder_name)[:2], folder_name + ".json.gz")
+
+def pack_folder(folder, directory=STORAGE_DIRECTORY):
+    '''
+    Stores the files of folder, except those in ARCHIVE_EXCLUDED, and writes
+    its manifest. Returns a SubmissionArchive (without a submission) to
+    record it with.
+    '''
+    folder = os.path.abspath(folder)
+    folder_name = os.path.basename(folder.rstrip(os.sep))
+
+    files = []
+    folder_bytes = 0
+    stored_bytes = 0
+    for relpath in walk_files(folder, ARCHIVE_EXCLUDED):
+        path = os.path.join(folder, relpath)
+        if os.path.islink(path) and not os.path.exists(path):
+            continue # dangling
+
+        st = os.stat(path)
+        digest, added = store_blob(path, directory)
+        files.append([relpath, digest, st.st_mode & 0o777, st.st_size])
+        folder_bytes += st.st_size
+        stored_bytes += added
+
+    manifest = {"version": MANIFEST_VERSION,
+                "folder": folder_name,
+                "files": files}
+    manifest_path = manifest_path_of(folder_name)
+
+    def write(f):
+        with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as packed:
+            packed.write(json.dumps(manifest).encode('utf-8'))
+
+    _atomic_write(os.path.join(directory, manifest_path), write)
+    stored_bytes += os.path.getsize(os.path.join(directory, manifest_path))
+
+    return SubmissionArchive(folder_name=folder_name,
+                             manifest_path=manifest_path,
+                             file_count=len(files),
+                             folder_bytes=folder_bytes,
+                             stored_bytes=stored_bytes)
+
+def record_archive(ses, archive):
+    def record():
+        # a rolled-back attempt leaves the id it inserted behind.
+        if inspect(archive).transient:
+            archive.id = None
+        ses.add(archive)
+        ses.commit()
+
+    retry_on_lock(ses, record)
+
+def archive_submission(ses, submission, folder, directory=STORAGE_DIRECTORY):
+    '''
+    Packs the folder of a recorded submission, records where, and removes
+    the folder. Returns the SubmissionArchive.
+    '''
+    archive = pack_folder(folder, directory)
+    archive.submission_id = submission.id
+    record_archive(ses, archive)
+
+    shutil.rmtree(folder, ignore_errors=True)
+    return archive
+
+def read_manifest(archive, directory=STORAGE_DIRECTORY):
+    with gzip.open(os.path.join(directory, archive.manifest_path), 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+def restore_archive(archive, destination, directory=STORAGE_DIRECTORY):
+    '''
+    Recreates the packed folder at destination, without its build folder.
+    '''
+    manifest = read_manifest(archive, directory)
+
+    for relpath, digest, mode, size in manifest["files"]:
+        path, compressed = find_blob(digest, directory)
+        if path is None:
+            raise IOError("Blob {} of '{}' is missing.".format(digest, relpath))
+
+        target = os.path.join(destination, relpath)
+        _make_parent(target)
+        opener = gzip.open if compressed else open
+        with opener(path, 'rb') as blob:
+            with open(target, 'wb') as f:
+                shutil.copyfileobj(blob, f)
+        os.chmod(target, mode)
+
+def submission_folders(submissions_directory):
+    '''
+    The submission folders under submissions_directory, which holds one
+    folder per theme and milestone.
+    '''
+    for group in sorted(os.listdir(submissions_directory)):
+        group_path = os.path.join(submissions_directory, group)
+        if not os.path.isdir(group_path):
+            continue
+        for name in sorted(os.listdir(group_path)):
+            path = os.path.join(group_path, name)
+            if os.path.isdir(path):
+                yield path
+
+def last_change(folder):
+    latest = os.stat(folder).st_mtime
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for name in dirnames + filenames:
+            try:
+                latest = max(latest, os.lstat(os.path.join(dirpath, name)).st_mtime)
+            except OSError:
+                pass
+    return latest
+
+def pack_submissions_directory(ses, submissions_directory, out=None):
+    '''
+    Packs and removes every folder in the submissions directory that hasn't
+    changed in PACK_MIN_AGE and belongs to a submission. Returns the number
+    packed.
+    '''
+    if out is None:
+        out = sys.stdout
+
+    packed = 0
+    for folder in submission_folders(submissions_directory):
+        if time.time() - last_change(folder) < PACK_MIN_AGE:
+            continue
+
+        folder_name = os.path.basename(folder)
+        submission = ses.query(Submission).filter(Submission.folder_name == folder_name).first()
+        if submission is None:
+            # removing it would leave nothing to restore it by.
+            out.write("Left '{}': no submission was recorded from it.\n".format(folder_name))
+            continue
+
+        archived = ses.query(SubmissionArchive)\
+                      .filter(SubmissionArchive.submission_id == submission.id).first()
+        if archived is None:
+            archived = archive_submission(ses, submission, folder)
+            out.write("Packed '{}': {} files, {} bytes into {} new bytes.\n".format(
+                folder_name, archived.file_count, archived.folder_bytes, archived.stored_bytes))
+            packed += 1
+        else:
+            # packed already, but not removed.
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return packed
+
+def usage():
+    print("Usage: {0} restore <submission id> <destination folder>\n"
+          "       {0} restore --folder <folder name> <destination folder>\n"
+          "       {0} pack [<submissions directory>]\n"
+          "       {0} stats".format(sys.argv[0]))
+    sys.exit(0)
+
+def main():
+    args = sys.argv[1:]
+    if not args:
+        usage()
+
+    ses = Session()
+    command = args.pop(0)
+
+    if command == 'restore' and len(args) == 3 and args[0] == '--folder':
+        archive = ses.query(SubmissionArchive).filter(SubmissionArchive.folder_name == args[1])\
+                                              .order_by(SubmissionArchive.id.desc()).first()
+        if archive is None:
+            print("No folder named '{}' was archived.".format(args[1]))
+            sys.exit(1)
+        restore_archive(archive, args[2])
+        print("Restored '{}' to '{}'.".format(archive.folder_name, args[2]))
+
+    elif command == 'restore' and len(args) == 2:
+        archive = ses.query(SubmissionArchive).filter(SubmissionArchive.submission_id == int(args[0]))\
+                                              .first()
+        if archive is None:
+            print("Submission {} wasn't archived.".format(args[0]))
+            sys.exit(1)
+        restore_archive(archive, args[1])
+        print("Restored '{}' to '{}'.".format(archive.folder_name, args[1]))
+
+    elif command == 'pack' and len(args) <= 1:
+        from grader import SUBMISSIONS_DIRECTORY
+
+        directory = args[0] if args else SUBMISSIONS_DIRECTORY
+        print("Packed {} folders.".format(pack_submissions_directory(ses, directory)))
+
+    elif command == 'stats' and not args:
+        count, files, folder_bytes, stored_bytes = ses.query(
+                func.count(SubmissionArchive.id),
+                func.sum(SubmissionArchive.file_count),
+                func.sum(SubmissionArchive.folder_bytes),
+                func.sum(SubmissionArchive.stored_bytes)).one()
+        print("{} archived folders: {} files, {} bytes stored in {} bytes.".format(
+            count, files or 0, folder_bytes or 0, stored_bytes or 0))
+
+    else:
+        usage()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+'''
+Builds submissions in build trees kept warm between submissions, so that
+only the sources a student changed are compiled again.
+
+A warm build is a copy of the assignment template that has been configured
+with CMake and built once. Each submission's FOSSSim folder is synced into
+it: only files whose contents differ from what the tree holds are replaced,
+so make rebuilds those (and whatever includes them) and relinks. Every
+other template object is reused, even for a student's first submission.
+
+There are WARM_BUILD_SLOTS warm builds per template (and toolchain and
+CMake flags), each used by one build at a time under a lock file, so
+graders on the same machine can share them. Setting GRADER_WARM_BUILDS to
+an empty string builds every submission from scratch in its own folder.
+'''
+
+import fcntl
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+
+from cache import BuildCache, sha1_of, toolchain_signature, walk_files
+from cpu_budget import acquire_tokens, COMPILE_TOKENS
+from workspace import materialize_template
+
+WARM_BUILD_DIRECTORY = os.environ.get("GRADER_WARM_BUILDS", "./warm_builds")
+
+# warm builds kept per template; more let more submissions build at once.
+WARM_BUILD_SLOTS = int(os.environ.get("GRADER_WARM_BUILD_SLOTS", 4))
+
+# template folders that aren't part of a warm build's sources.
+WARM_BUILD_EXCLUDED = ['Creative', 'build']
+
+class WarmSlot(object):
+    '''
+    One warm build: the template sources in src/, built in build/.
+    '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.source = os.path.join(self.path, "src")
+        self.build = os.path.join(self.path, "build")
+        self.stamp_path = os.path.join(self.path, "stamp.json")
+        self.lock_file = None
+
+    def acquire(self, blocking=True):
+        '''
+        Locks the slot for this process. Returns whether it did; only
+        without blocking can it fail to.
+        '''
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass # created concurrently
+
+        self.lock_file = open(self.path + ".lock", 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        return True
+
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def stamp(self):
+        try:
+            with open(self.stamp_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def prepare(self, template_path, cmake_flags, stamp):
+        '''
+        Makes the slot a configured and built copy of the template, unless
+        it already is one with the same stamp. Returns whether the slot can
+        be built in.
+        '''
+        if self.stamp() == stamp:
+            return True
+
+        if os.path.exists(self.stamp_path):
+            os.remove(self.stamp_path)
+        for folder in (self.source, self.build):
+            shutil.rmtree(folder, ignore_errors=True)
+
+        materialize_template(template_path, self.source)
+        for excluded in WARM_BUILD_EXCLUDED:
+            shutil.rmtree(os.path.join(self.source, excluded), ignore_errors=True)
+        os.mkdir(self.build)
+
+        with open(os.devnull, 'wb') as devnull:
+            if self.configure(cmake_flags, devnull) != 0:
+                return False
+            # the template alone may not build; whatever does is kept.
+            with acquire_tokens(COMPILE_TOKENS) as tokens:
+                subprocess.call(tokens.make_args() + ['-k'], cwd=self.build,
+                                stdout=devnull, stderr=devnull)
+
+        with open(self.stamp_path, 'w') as f:
+            json.dump(stamp, f)
+        return True
+
+    def configure(self, cmake_flags, out=None):
+        return subprocess.call(['cmake'] + shlex.split(cmake_flags) + [self.source],
+                               cwd=self.build, stdout=out)
+
+def same_contents(path, other):
+    '''
+    Whether the two files hold the same bytes, read from both rather than
+    judged by size and modification time: those of an edited file can stay
+    the same on a filesystem with coarse timestamps.
+    '''
+    if os.path.getsize(path) != os.path.getsize(other):
+        return False
+
+    with open(path, 'rb') as f, open(other, 'rb') as g:
+        while True:
+            chunk = f.read(1 << 20)
+            if chunk != g.read(1 << 20):
+                return False
+            if not chunk:
+                return True
+
+def sync_folder(original_folder, destination):
+    '''
+    Makes destination hold exactly the files of original_folder, replacing
+    only those whose contents differ, so that make sees nothing else as
+    changed. Returns whether any file was added or removed.
+    '''
+    wanted = set(walk_files(original_folder))
+    present = set(walk_files(destination)) if os.path.isdir(destination) else set()
+
+    for relpath in present - wanted:
+        os.remove(os.path.join(destination, relpath))
+
+    for relpath in wanted:
+        src = os.path.join(original_folder, relpath)
+        dst = os.path.join(destination, relpath)
+        if relpath in present and same_contents(src, dst):
+            continue
+
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        if os.path.lexists(dst):
+            os.remove(dst) # never write through a link to the template
+        # a fresh mtime, so make knows to rebuild it.
+        shutil.copyfile(src, dst)
+        shutil.copymode(src, dst)
+
+    return wanted != present
+
+def acquire_slot(family):
+    '''
+    Locks and returns a free slot of the family, waiting for a random one if
+    all of them are in use.
+    '''
+    slots = [WarmSlot(os.path.join(family, "slot{}".format(i))) for i in range(WARM_BUILD_SLOTS)]
+    for slot in slots:
+        if slot.acquire(blocking=False):
+            return slot
+
+    slot = random.choice(slots)
+    slot.acquire()
+    return slot
+
+def warm_build(template_path, submission_folder, cmake_flags, binary_path):
+    '''
+    Builds the FOSSSim folder of the submission in a warm build of its
+    template, and copies the binary to binary_path. Returns binary_path and
+    None, or None and a message explaining why it couldn't be built. Returns
+    None and None if no warm build could be made, in which case the
+    submission should be built on its own.
+    '''
+    template_digest = BuildCache().template_digest(template_path)
+    stamp = {"template": template_digest,
+             "toolchain": toolchain_signature(),
+             "cmake_flags": cmake_flags}
+    family = os.path.join(WARM_BUILD_DIRECTORY, sha1_of(*sorted(stamp.values())))
+
+    slot = acquire_slot(family)
+    try:
+        if not slot.prepare(template_path, cmake_flags, stamp):
+            return None, None
+
+        added_or_removed = sync_folder(os.path.join(submission_folder, 'FOSSSim'),
+                                       os.path.join(slot.source, 'FOSSSim'))
+
+        built_binary = os.path.join(slot.build, "FOSSSim", "FOSSSim")
+        if os.path.exists(built_binary):
+            os.remove(built_binary) # never hand out the previous student's
+
+        # sources found by a glob are only picked up by configuring again.
+        if added_or_removed and slot.configure(cmake_flags) != 0:
+            return None, "Compilation failed."
+
+        with acquire_tokens(COMPILE_TOKENS) as tokens:
+            compilation_result = subprocess.call(tokens.make_args(), cwd=slot.build)
+        if compilation_result != 0:
+            return None, "Compilation failed."
+
+        if not os.path.isfile(built_binary):
+            return None, "Binary executable wasn't found in '{0}'.".format(built_binary)
+
+        if not os.path.isdir(os.path.dirname(binary_path)):
+            os.makedirs(os.path.dirname(binary_path))
+        shutil.copy2(built_binary, binary_path)
+        return binary_path, None
+    finally:
+        slot.release()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+'''
+Materializes submission folders from the assignment template without
+copying it: template files are reflinked (copy-on-write) where the
+filesystem allows it, hardlinked otherwise, and only really copied as a last
+resort. The student's own folders are always really copied.
+'''
+
+import errno
+import fcntl
+import os
+import shutil
+import threading
+
+# ioctl request of FICLONE from linux/fs.h; makes dst share src's extents.
+FICLONE = 0x40049409
+
+# template folders that are written to while grading, and so must never
+# share inodes with the template.
+PRIVATE_TEMPLATE_FOLDERS = ['build']
+
+# mode of the folders and template copies in a submission folder, so that
+# TAs can inspect and remove them.
+WORKSPACE_MODE = 0o777
+
+CLONED = "cloned"
+LINKED = "linked"
+COPIED = "copied"
+
+# errors meaning "this filesystem can't do that", as opposed to a failure
+# specific to one file.
+_UNSUPPORTED = set([errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EINVAL,
+                    errno.ENOTTY, errno.EMLINK])
+
+_lock = threading.Lock()
+_unsupported = set()
+
+def _supported(method, device):
+    with _lock:
+        return (method, device) not in _unsupported
+
+def _mark_unsupported(method, device):
+    with _lock:
+        _unsupported.add((method, device))
+
+def _reflink(src, dst):
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except (IOError, OSError):
+                d.close()
+                os.remove(dst)
+                raise
+    shutil.copystat(src, dst)
+
+def clone_file(src, dst):
+    '''
+    Makes dst a copy of src as cheaply as the filesystem allows. Returns
+    CLONED, LINKED or COPIED. Only a LINKED dst shares its inode (and so its
+    permissions) with src.
+    '''
+    device = os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+
+    for method, attempt in ((CLONED, _reflink), (LINKED, os.link)):
+        if not _supported(method, device):
+            continue
+        try:
+            attempt(src, dst)
+            return method
+        except (IOError, OSError) as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            _mark_unsupported(method, device)
+
+    shutil.copy2(src, dst)
+    return COPIED
+
+def _make_folder(path, mode=None):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if mode is not None:
+        os.chmod(path, mode)
+
+def materialize_template(template_path, submission_folder, mode=WORKSPACE_MODE):
+    '''
+    Recreates template_path at submission_folder, sharing file contents with
+    the template wherever possible. Folders and every file that doesn't
+    share an inode with the template are given mode.
+    '''
+    template_path = os.path.abspath(template_path)
+
+    for dirpath, dirnames, filenames in os.walk(template_path, followlinks=True):
+        rel = os.path.relpath(dirpath, template_path)
+        target = os.path.normpath(os.path.join(submission_folder, rel))
+        _make_folder(target, mode)
+
+        private = rel.split(os.sep)[0] in PRIVATE_TEMPLATE_FOLDERS
+
+        for filename in filenames:
+            src = os.path.realpath(os.path.join(dirpath, filename))
+            dst = os.path.join(target, filename)
+
+            if private:
+                shutil.copy2(src, dst)
+                method = COPIED
+            else:
+                method = clone_file(src, dst)
+
+            if method != LINKED:
+                os.chmod(dst, mode)
+
+def copy_folder(original_folder, destination):
+    '''
+    Really copies original_folder over destination, replacing (never writing
+    through) any file already there, since it may be linked to the template.
+    '''
+    original_folder = os.path.abspath(original_folder)
+
+    for dirpath, dirnames, filenames in os.walk(original_folder, followlinks=True):
+        target = os.path.normpath(os.path.join(destination,
+                os.path.relpath(dirpath, original_folder)))
+        _make_folder(target)
+
+        for filename in filenames:
+            dst = os.path.join(target, filename)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            shutil.copy2(os.path.join(dirpath, filename), dst)